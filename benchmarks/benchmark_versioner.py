@@ -0,0 +1,492 @@
+"""
+Benchmark natcap.versioner against synthetic repositories.
+
+Git repositories, mercurial repositories and ``.hg_archival.txt`` archives
+are generated with a given number of commits, tags and branches, and the
+time taken by ``vcs_version()``, ``get_version()`` (in a fresh interpreter
+and in a warm one) and each ``VCSQuerier`` property is measured.
+
+Results are written as JSON so that runs from different commits can be
+compared::
+
+    python benchmarks/benchmark_versioner.py --output before.json
+    git checkout my-branch
+    python benchmarks/benchmark_versioner.py --output after.json \\
+        --compare before.json
+
+Generated repositories are kept in ``--workspace`` (a temporary directory
+by default) and reused between runs, since the larger sizes take minutes to
+build.  Use ``--sizes 10,1000,100000,1000000`` for the full suite.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from natcap.versioner import versioning  # noqa: E402
+
+VCS_GIT = 'git'
+VCS_HG = 'hg'
+VCS_ARCHIVE = 'archive'
+
+# The properties timed for each querier, each on a freshly constructed
+# querier so that no memoized data is reused.
+PROPERTIES = ['latest_tag', 'tag_distance', 'branch', 'node', 'build_id',
+              'release_version', 'version', 'pep440']
+
+# (vcs, querier class, backends) of the queriers benchmarked.
+QUERIERS = [
+    (VCS_GIT, versioning.GitRepo,
+     [versioning.BACKEND_CLI, versioning.BACKEND_PYTHON]),
+    (VCS_HG, versioning.HgRepo,
+     [versioning.BACKEND_CLI, versioning.BACKEND_CMDSERVER]),
+    (VCS_ARCHIVE, versioning.HgArchive, [None]),
+]
+
+_BACKEND_NAMES = {
+    None: 'default',
+    versioning.BACKEND_CLI: 'cli',
+    versioning.BACKEND_PYTHON: 'python',
+    versioning.BACKEND_CMDSERVER: 'cmdserver',
+}
+
+_GIT_AUTHOR = 'Example Name <name@example.com>'
+
+# Run in a fresh interpreter to time get_version() with a cold import.
+# Prints the seconds taken by the import and by get_version().
+_COLD_SCRIPT = '''
+import sys, time
+start = time.time()
+import natcap.versioner
+imported = time.time()
+natcap.versioner.get_version(
+    'natcap_versioner_benchmark_no_such_package', root=sys.argv[1])
+print('%r %r' % (imported - start, time.time() - imported))
+'''
+
+
+def _tag_positions(commits, tags):
+    """Spread ``tags`` tags evenly over a history of ``commits`` commits.
+
+    The last tag is placed a few commits before the tip so that the tag
+    distance is nonzero.
+
+    Returns:
+        A sorted list of 1-based commit numbers."""
+    if tags <= 0:
+        return []
+    last = max(1, commits - min(5, commits - 1))
+    step = float(last) / tags
+    return sorted(set(max(1, int(round(step * (index + 1))))
+                      for index in range(tags)))
+
+
+def _branch_positions(commits, branches):
+    """The 1-based commits that each extra branch forks from."""
+    extra = branches - 1
+    if extra <= 0:
+        return []
+    step = float(commits) / (extra + 1)
+    return [max(1, int(step * (index + 1))) for index in range(extra)]
+
+
+def make_git_repo(path, commits, tags, branches):
+    """
+    Build a git repository with ``git fast-import``.
+
+    Every commit is empty.  Tags alternate between annotated and
+    lightweight, and each extra branch has one commit of its own.
+
+    Returns:
+        None.
+    """
+    os.makedirs(path)
+    subprocess.check_call(['git', 'init', '-q', path])
+
+    tag_positions = set(_tag_positions(commits, tags))
+    branch_positions = _branch_positions(commits, branches)
+    stream = tempfile.TemporaryFile()
+
+    def _write(text):
+        stream.write(text.encode('utf-8'))
+
+    timestamp = 1500000000
+    for number in range(1, commits + 1):
+        _write('commit refs/heads/master\nmark :%d\n' % number)
+        _write('committer %s %d +0000\n' % (_GIT_AUTHOR, timestamp + number))
+        _write('data 0\n')
+        if number > 1:
+            _write('from :%d\n' % (number - 1))
+        _write('\n')
+        if number in tag_positions:
+            name = '%d.%d' % (number // 1000, number % 1000)
+            if number % 2:
+                _write('tag %s\nfrom :%d\ntagger %s %d +0000\ndata 0\n\n' % (
+                    name, number, _GIT_AUTHOR, timestamp + number))
+            else:
+                _write('reset refs/tags/%s\nfrom :%d\n\n' % (name, number))
+
+    for index, number in enumerate(branch_positions):
+        _write('commit refs/heads/branch%d\n' % index)
+        _write('committer %s %d +0000\n' % (_GIT_AUTHOR,
+                                              timestamp + number))
+        _write('data 0\nfrom :%d\n\n' % number)
+
+    stream.seek(0)
+    subprocess.check_call(['git', 'fast-import', '--quiet'],
+                          stdin=stream, cwd=path)
+    stream.close()
+    subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                          cwd=path)
+
+
+def make_hg_repo(path, commits, tags, branches):
+    """
+    Build a mercurial repository with ``hg debugbuilddag``.
+
+    Tags are committed to ``.hgtags`` in a final commit, and each extra
+    branch is a named branch with one commit of its own.
+
+    Returns:
+        None.
+    """
+    os.makedirs(path)
+    subprocess.check_call(['hg', 'init', path])
+
+    tag_positions = _tag_positions(commits, tags)
+    branch_positions = _branch_positions(commits, branches)
+    labels = set(tag_positions) | set(branch_positions)
+
+    dag = []
+    previous = 0
+    for number in sorted(labels):
+        dag.append('+%d :c%d' % (number - previous, number))
+        previous = number
+    if commits > previous:
+        dag.append('+%d' % (commits - previous))
+    dag.append(':head')
+    for index, number in enumerate(branch_positions):
+        dag.append('@branch%d *c%d' % (index, number))
+    # Move back to the mainline; the .hgtags commit goes on top.
+    dag.append('@default')
+
+    subprocess.check_call(['hg', 'debugbuilddag', ' '.join(dag)], cwd=path)
+    local_tags = {}
+    localtags_path = os.path.join(path, '.hg', 'localtags')
+    with open(localtags_path) as localtags_file:
+        for line in localtags_file:
+            node, label = line.split()
+            local_tags[label] = node
+    os.remove(localtags_path)
+
+    subprocess.check_call(['hg', 'update', '-q', local_tags['head']],
+                          cwd=path)
+    with open(os.path.join(path, '.hgtags'), 'w') as hgtags_file:
+        for number in tag_positions:
+            hgtags_file.write('%s %d.%d\n' % (
+                local_tags['c%d' % number], number // 1000, number % 1000))
+    subprocess.check_call(
+        ['hg', 'commit', '-q', '-A', '-u', _GIT_AUTHOR, '-m', 'tags'],
+        cwd=path)
+
+
+def make_archive(path, commits, tags, branches):
+    """
+    Write a ``.hg_archival.txt`` like ``hg archive`` would.
+
+    Returns:
+        None.
+    """
+    os.makedirs(path)
+    tag_positions = _tag_positions(commits, tags)
+    with open(os.path.join(path, '.hg_archival.txt'), 'w') as archival:
+        archival.write('repo: %s\n' % ('0' * 40))
+        archival.write('node: %040x\n' % commits)
+        archival.write('branch: default\n')
+        if tag_positions:
+            number = tag_positions[-1]
+            archival.write('latesttag: %d.%d\n' % (number // 1000,
+                                                   number % 1000))
+            archival.write('latesttagdistance: %d\n' % (commits - number))
+            archival.write('changessincelatesttag: %d\n' % (commits - number))
+        else:
+            archival.write('latesttag: null\n')
+            archival.write('latesttagdistance: %d\n' % commits)
+
+
+_BUILDERS = {
+    VCS_GIT: make_git_repo,
+    VCS_HG: make_hg_repo,
+    VCS_ARCHIVE: make_archive,
+}
+
+
+def get_repo(workspace, vcs, commits, tags, branches):
+    """Get the path to a generated repository, building it if needed."""
+    path = os.path.join(workspace, '%s-c%d-t%d-b%d' % (
+        vcs, commits, tags, branches))
+    complete_marker = path + '.complete'
+    if not os.path.exists(complete_marker):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        start = time.time()
+        _BUILDERS[vcs](path, commits, tags, branches)
+        open(complete_marker, 'w').close()
+        print('built %s in %.1fs' % (os.path.basename(path),
+                                     time.time() - start), file=sys.stderr)
+    return path
+
+
+def _time(function, repeat):
+    """Call ``function`` ``repeat`` times.
+
+    Returns:
+        A dict of the min, median and max seconds taken."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+    }
+
+
+def _property_getter(querier_class, path, backend, name):
+    def _get():
+        kwargs = {}
+        if backend is not None:
+            kwargs['backend'] = backend
+        with querier_class(path, **kwargs) as repo:
+            value = getattr(repo, name)
+            if callable(value):
+                value()
+    return _get
+
+
+def _cold_get_version(path, repeat):
+    """Time get_version() in fresh interpreters."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    imports = []
+    calls = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _COLD_SCRIPT, path], env=env)
+        import_seconds, call_seconds = output.decode('utf-8').split()
+        imports.append(float(import_seconds))
+        calls.append(float(call_seconds))
+    imports.sort()
+    calls.sort()
+    return ({'min': imports[0], 'median': imports[len(imports) // 2],
+             'max': imports[-1]},
+            {'min': calls[0], 'median': calls[len(calls) // 2],
+             'max': calls[-1]})
+
+
+def benchmark_repo(vcs, path, repeat):
+    """
+    Run every benchmark against one repository.
+
+    Returns:
+        A list of ``(benchmark, backend, timings)`` tuples.
+    """
+    import natcap.versioner
+    from natcap.versioner import cache
+
+    results = []
+
+    def _uncached():
+        natcap.versioner.vcs_version(path, use_cache=False)
+    results.append(('vcs_version', 'uncached', _time(_uncached, repeat)))
+
+    def _cached():
+        natcap.versioner.vcs_version(path, use_cache=True)
+    cache.clear_cache(path)
+    _cached()  # populate the cache
+    results.append(('vcs_version', 'cached', _time(_cached, repeat)))
+    cache.clear_cache(path)
+
+    def _warm():
+        natcap.versioner.get_version(
+            'natcap_versioner_benchmark_no_such_package', root=path)
+    results.append(('get_version', 'warm', _time(_warm, repeat)))
+    cache.clear_cache(path)
+
+    cold_import, cold_call = _cold_get_version(path, repeat)
+    results.append(('import', 'cold', cold_import))
+    results.append(('get_version', 'cold', cold_call))
+    cache.clear_cache(path)
+
+    for querier_vcs, querier_class, backends in QUERIERS:
+        if querier_vcs != vcs:
+            continue
+        for backend in backends:
+            for name in PROPERTIES:
+                results.append((
+                    '%s.%s' % (querier_class.__name__, name),
+                    _BACKEND_NAMES[backend],
+                    _time(_property_getter(querier_class, path, backend,
+                                           name), repeat)))
+    return results
+
+
+def _vcs_version_string(args):
+    try:
+        return subprocess.check_output(
+            args, stderr=subprocess.STDOUT).decode('utf-8').splitlines()[0]
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata():
+    """Describe the environment the benchmarks were run in."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'git': _vcs_version_string(['git', '--version']),
+        'hg': _vcs_version_string(['hg', '--version', '--quiet']),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def _result_key(result):
+    return (result['vcs'], result['commits'], result['tags'],
+            result['branches'], result['benchmark'], result['backend'])
+
+
+def compare(baseline, results):
+    """
+    Compare the median timings of two runs.
+
+    Parameters:
+        baseline (dict): The output of an earlier run.
+        results (dict): The output of this run.
+
+    Returns:
+        A list of lines, one per benchmark in both runs, giving the ratio
+        of this run's median to the baseline's.
+    """
+    baseline_medians = dict(
+        (_result_key(result), result['seconds']['median'])
+        for result in baseline['results'])
+    lines = []
+    for result in results['results']:
+        key = _result_key(result)
+        if key not in baseline_medians or not baseline_medians[key]:
+            continue
+        ratio = result['seconds']['median'] / baseline_medians[key]
+        lines.append('%-8s %8d commits %4d tags %3d branches  %-28s %-9s '
+                     '%9.2fms -> %9.2fms  x%.2f' % (
+                         key + (baseline_medians[key] * 1000,
+                                result['seconds']['median'] * 1000, ratio)))
+    return lines
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    """
+    Run the benchmarks and write the results.
+
+    Parameters:
+        argv=None (list or None): Command-line arguments.  If None,
+            ``sys.argv[1:]`` is used.
+
+    Returns:
+        The exit code.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--sizes', type=_int_list, default=[10, 1000],
+        help='Comma-separated commit counts (default: 10,1000).  The full '
+             'suite is 10,1000,100000,1000000.')
+    parser.add_argument('--tags', type=_int_list, default=[0, 10],
+                        help='Comma-separated tag counts (default: 0,10).')
+    parser.add_argument('--branches', type=_int_list, default=[1, 10],
+                        help='Comma-separated branch counts (default: 1,10).')
+    parser.add_argument(
+        '--vcs', default=','.join([VCS_GIT, VCS_HG, VCS_ARCHIVE]),
+        help='Comma-separated repository types (default: git,hg,archive).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Times to run each benchmark (default: 5).')
+    parser.add_argument('--workspace', default=None,
+                        help='Directory to build and keep repositories in. '
+                             'Default: a temporary directory.')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--compare', default=None,
+                        help='A previous JSON output to compare against.')
+    args = parser.parse_args(argv)
+
+    workspace = args.workspace
+    remove_workspace = workspace is None
+    if workspace is None:
+        workspace = tempfile.mkdtemp(prefix='natcap-versioner-benchmark-')
+    elif not os.path.isdir(workspace):
+        os.makedirs(workspace)
+
+    results = {'metadata': _metadata(), 'results': []}
+    try:
+        for vcs in args.vcs.split(','):
+            for commits in args.sizes:
+                for tags in args.tags:
+                    for branches in args.branches:
+                        path = get_repo(workspace, vcs, commits, tags,
+                                        branches)
+                        for benchmark, backend, seconds in benchmark_repo(
+                                vcs, path, args.repeat):
+                            results['results'].append({
+                                'vcs': vcs,
+                                'commits': commits,
+                                'tags': tags,
+                                'branches': branches,
+                                'benchmark': benchmark,
+                                'backend': backend,
+                                'repeat': args.repeat,
+                                'seconds': seconds,
+                            })
+    finally:
+        if remove_workspace:
+            shutil.rmtree(workspace)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        for line in compare(baseline, results):
+            print(line, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
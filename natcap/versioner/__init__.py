@@ -1,9 +1,13 @@
 from __future__ import absolute_import
 import os
 import sys
-import pkg_resources
 import importlib
 import logging
+import struct
+import subprocess
+import zlib
+
+from . import profiling
 
 LOGGER = logging.getLogger('natcap.versioner')
 LOGGER.setLevel(logging.ERROR)
@@ -20,12 +24,18 @@ SCM_ALLOW = 'allow scm fallback'
 SCM_DISALLOW = 'disallow scm fallback'
 SCM_NOTFROZEN = 'allow scm in non-frozen enviroments (disallow when frozen)'
 
+# The keys of the dicts returned by get_version_info().
+VERSION_INFO_FIELDS = ('version', 'latest_tag', 'tag_distance', 'branch',
+                       'node', 'build_id', 'scm', 'build_time')
+
 
 def get_version(package, root='.', ver_module=None, allow_scm=SCM_NOTFROZEN):
     """
     Get the version string for the target package.
 
     If `package` is not available for import, check the root for git or hg.
+    Versions found without a VCS, and failures to find them, are memoized
+    for the life of the process (see ``natcap.versioner.registry``).
 
     Parameters:
         package (string): The package name to check for (e.g. 'natcap.invest')
@@ -39,23 +49,100 @@ def get_version(package, root='.', ver_module=None, allow_scm=SCM_NOTFROZEN):
     Returns:
         A DVCS-aware versioning string.
     """
+    with profiling.logged_profile('get_version(%r)' % package):
+        return _get_version(package, root, ver_module, allow_scm)
+
+
+def get_version_info(package, root='.', ver_module=None,
+                     allow_scm=SCM_NOTFROZEN):
+    """
+    Get every version field of the target package.
+
+    The fields are found like ``get_version()`` finds the version.  A
+    version module written by ``natcap.versioner.utils.distutils_keyword``
+    holds all of them, so a built package never queries a VCS.  Fields that
+    are unknown (such as everything but the version, for a package installed
+    by another tool) are None.
+
+    Parameters:
+        See ``get_version()``.
+
+    Returns:
+        A dict with the keys in ``VERSION_INFO_FIELDS``:
+
+            * ``version``: the version string.
+            * ``latest_tag``, ``tag_distance``, ``branch``, ``node`` and
+              ``build_id``: the fields of ``VCSQuerier.snapshot()``.
+            * ``scm``: the name of the repository type the fields were read
+              from.
+            * ``build_time``: when the version module was written, as an
+              ISO 8601 UTC string.
+    """
+    with profiling.logged_profile('get_version_info(%r)' % package):
+        return _get_version(package, root, ver_module, allow_scm,
+                            with_info=True)
+
+
+def _version_info(**fields):
+    """Build a version info dict, with None for any missing fields."""
+    info = dict((field, None) for field in VERSION_INFO_FIELDS)
+    info.update(fields)
+    return info
+
+
+def _import_version_info(full_module):
+    """
+    Import a version module and read its version info.
 
+    Returns:
+        A dict with at least a ``version``, or None if the module can't be
+        imported.
+    """
+    try:
+        module = importlib.import_module(full_module)
+    except ImportError:
+        return None
+    # Version modules written before version_info was added only have the
+    # version.
+    return dict(getattr(module, 'version_info', {'version': module.version}))
+
+
+def _get_version(package, root, ver_module, allow_scm, with_info=False):
+    """Implementation of ``get_version()`` (or, if ``with_info`` is True,
+    of ``get_version_info()``), which may be profiled.
+
+    Versions found in a manifest, version module or metadata are memoized
+    (see ``natcap.versioner.registry``)."""
+    from .registry import REGISTRY
     if ver_module is None:
         ver_module = 'version'
 
+    # A loaded manifest overrides everything else.
+    version_info = REGISTRY.manifest_info(package)
+
     # Prefer to import the version file
     full_module = '.'.join([package, ver_module])
-    try:
-        module = importlib.import_module(full_module)
-        return module.version
-    except ImportError:
-        pass
+    if version_info is None:
+        with profiling.stage(profiling.STAGE_IMPORT, full_module) as stage:
+            version_info = REGISTRY.module_info(full_module,
+                                                _import_version_info)
+            if version_info is None:
+                stage.outcome = profiling.OUTCOME_NOT_FOUND
+    if version_info is not None:
+        if with_info:
+            return _version_info(**version_info)
+        return version_info['version']
 
     # Next, try to get the info from installed package metadata
-    try:
-        return pkg_resources.require(package)[0].version
-    except pkg_resources.DistributionNotFound:
-        pass
+    with profiling.stage(profiling.STAGE_METADATA, package) as stage:
+        metadata_version = REGISTRY.metadata_version(package,
+                                                     _metadata_version)
+        if metadata_version is None:
+            stage.outcome = profiling.OUTCOME_NOT_FOUND
+    if metadata_version is not None:
+        if with_info:
+            return _version_info(version=metadata_version)
+        return metadata_version
 
     if allow_scm == SCM_DISALLOW:
         raise VersionNotFound((
@@ -73,16 +160,53 @@ def get_version(package, root='.', ver_module=None, allow_scm=SCM_NOTFROZEN):
              'Perhaps it needs to be added as a hiddenimport?') % full_module)
 
     # Lastly, get the version from source control
+    if with_info:
+        return _vcs_version_info(root)
     return vcs_version(root)
 
 
+def _metadata_version(package):
+    """
+    Get the version of a package from its installed distribution metadata.
+
+    ``importlib.metadata`` (or its ``importlib_metadata`` backport) is
+    preferred, since importing ``pkg_resources`` scans the whole working
+    set.  ``pkg_resources`` is only used when neither is available.
+
+    Parameters:
+        package (string): The distribution name (e.g. 'natcap.invest')
+
+    Returns:
+        The version string, or None if the distribution is not installed.
+    """
+    try:
+        from importlib import metadata as importlib_metadata
+    except ImportError:
+        try:
+            import importlib_metadata
+        except ImportError:
+            importlib_metadata = None
+
+    if importlib_metadata is not None:
+        try:
+            return importlib_metadata.version(package)
+        except importlib_metadata.PackageNotFoundError:
+            return None
+
+    import pkg_resources
+    try:
+        return pkg_resources.require(package)[0].version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
 def parse_version(root='.'):
     """
     Determine the correct source from which to parse the version.
 
     If PKG-INFO exists, then we're in a source or binary distribution so prefer
-    to extract this metadata first.  Otherwise, If we're in an hg or git repo,
-    get the version from SCM.
+    to extract this metadata first.  Otherwise, If we're in an hg or git repo
+    (or an archive of one), get the version from SCM.
 
     Parameters:
         root='.' (string): The root directory to search for vcs information.
@@ -92,21 +216,47 @@ def parse_version(root='.'):
         A versioning string.
     """
 
-    pkginfo_filepath = os.path.join(root, 'PKG-INFO')
-    if os.path.exists(pkginfo_filepath):
-        with open(pkginfo_filepath) as pkginfo_file:
-            for line in pkginfo_file:
-                if line.startswith('Version'):
-                    return line.split(': ')[1].rstrip()
+    from . import archive
+    try:
+        pkginfo = archive.load(root, archive.PKG_INFO)
+    except IOError:
+        pkginfo = {}
+    if 'Version' in pkginfo:
+        return pkginfo['Version']
 
     return vcs_version(root)
 
 
+def parse_version_info(root='.'):
+    """
+    Get every version field of a source tree, from the same sources as
+    ``parse_version()``.
+
+    When building from a source distribution, only the version is known
+    (from PKG-INFO).
+
+    Parameters:
+        root='.' (string): The root directory to search for vcs information.
+
+    Returns:
+        A dict like ``get_version_info()``, without ``build_time``.
+    """
+    from . import archive
+    try:
+        pkginfo = archive.load(root, archive.PKG_INFO)
+    except IOError:
+        pkginfo = {}
+    if 'Version' in pkginfo:
+        return _version_info(version=pkginfo['Version'])
+
+    return _vcs_version_info(root)
+
+
 ERROR_RAISE = 'raise exception on error'
 ERROR_RETURN = 'return a string error message on error'
 
 
-def vcs_version(root='.', on_error=ERROR_RAISE):
+def vcs_version(root='.', on_error=ERROR_RAISE, use_cache=True):
     """
     Get the version string from your VCS.
 
@@ -117,28 +267,91 @@ def vcs_version(root='.', on_error=ERROR_RAISE):
             encountered in the SCM version parsing.  One of ERROR_RAISE,
             ERROR_RETURN.  If ERROR_RAISE, VersionNotFound will be raised.
             If ERROR_RETURN, a string message will be returned instead.
+        use_cache=True (bool): Whether to use the on-disk version cache
+            stored within the repository's ``.git`` or ``.hg`` directory.
+            See ``natcap.versioner.cache``.
+
+    If a ``natcap-versioner serve`` daemon is running, it is asked first
+    (see ``natcap.versioner.daemon``).
+    """
+    with profiling.logged_profile('vcs_version(%r)' % root):
+        return _vcs_version(root, on_error, use_cache)
+
+
+def _vcs_snapshot(root, use_cache):
     """
-    from .versioning import HgArchive, HgRepo, GitRepo
+    Find the repository containing ``root`` and take its snapshot.
 
+    Returns:
+        A tuple of ``(repo, snapshot)``, or ``(None, None)`` if ``root`` is
+        not within a known repository, or its version can't be read (e.g.
+        from a ``.git_archival.txt`` that ``git archive`` didn't fill in).
+    """
+    from .versioning import find_repository
+    from .cache import cached_snapshot
+
+    with profiling.stage(profiling.STAGE_DISCOVERY, root) as stage:
+        scm_class, repo_root = find_repository(root)
+        if scm_class is None:
+            stage.outcome = profiling.OUTCOME_NOT_FOUND
+    if scm_class is None:
+        return None, None
+    try:
+        repo = scm_class(repo_root)
+        if use_cache:
+            return repo, cached_snapshot(repo)
+        return repo, repo.snapshot()
+    except (ValueError, IOError, OSError, subprocess.CalledProcessError,
+            struct.error, zlib.error, IndexError) as error:
+        # Raised when the repository's data is malformed or incomplete, or
+        # can't be read (by us or by the VCS tool).
+        LOGGER.debug('Could not version %s: %s', repo_root, error)
+        return None, None
+
+
+def _vcs_version_info(root, use_cache=True):
+    """
+    Get every version field of the repository containing ``root``.
+
+    Returns:
+        A dict like ``get_version_info()``, without ``build_time``.
+
+    Raises:
+        VersionNotFound: when ``root`` is not within a known repository.
+    """
+    repo, snapshot = _vcs_snapshot(root, use_cache)
+    if snapshot is None:
+        raise VersionNotFound((
+            'A version could not be loaded from scm in %s' %
+            os.path.abspath(root)))
+    return _version_info(
+        version=snapshot.pep440(branch=False), scm=repo.name,
+        **snapshot._asdict())
+
+
+def _daemon_version(root, use_cache):
+    """
+    Ask a running ``natcap-versioner serve`` daemon for the version.
+
+    Returns:
+        The version string, or None if no daemon answered.
+    """
+    from . import daemon
+    try:
+        return daemon.query(root, use_cache=use_cache)
+    except daemon.DaemonError as error:
+        LOGGER.debug('Not using a daemon: %s', error)
+        return None
+
+
+def _vcs_version(root, on_error, use_cache):
+    """Implementation of ``vcs_version()``, which may be profiled."""
     error = False
-    version = None
-    repo = None
-    nested_path = ''
-    for scm_class in [HgArchive, HgRepo, GitRepo]:
-        try:
-            repo = scm_class(root)
-            repo_root = os.path.abspath(repo._repo_path)
-            # Check that this repo's path is the deepest one available.
-            if ((repo_root.startswith(nested_path) and repo_root != nested_path)
-                    or nested_path == None):
-                nested_path = repo._repo_path
-                repo = repo
-            # If no error raised, we've found a match!
-            version = repo.pep440(branch=False)
-            break
-        except ValueError:
-            # Raised when the repo type is not found.
-            pass
+    version = _daemon_version(root, use_cache)
+    if version is None:
+        snapshot = _vcs_snapshot(root, use_cache)[1]
+        if snapshot is not None:
+            version = snapshot.pep440(branch=False)
     if version == None:
         version = 'UNKNOWN'
         error = True
@@ -151,4 +364,277 @@ def vcs_version(root='.', on_error=ERROR_RAISE):
     return version
 
 
-__version__ = get_version('natcap.versioner')
+def async_vcs_version(root='.', on_error=ERROR_RAISE, use_cache=True):
+    """
+    Coroutine counterpart of ``vcs_version()``.  Requires python 3.5+.
+
+    VCS commands are run with ``asyncio.create_subprocess_exec`` instead of
+    blocking the event loop, so many repositories can be resolved
+    concurrently.
+
+    Example:
+        version = await natcap.versioner.async_vcs_version(root)
+
+    Parameters:
+        See ``vcs_version()``.
+    """
+    from . import aio
+    return aio.vcs_version(root, on_error=on_error, use_cache=use_cache)
+
+
+def subtree_version(root='.', on_error=ERROR_RAISE):
+    """
+    Get the version string of a subtree of a repository.
+
+    Unlike ``vcs_version()``, which versions the whole repository, the
+    version only reflects the commits that touched ``root`` (see
+    ``natcap.versioner.subtree``).  This suits the subprojects of a
+    monorepo.
+
+    Parameters:
+        root='.' (string): The directory to version, anywhere within a git
+            or mercurial repository.
+        on_error=ERROR_RAISE (string): See ``vcs_version()``.
+    """
+    return subtree_versions([root], on_error=on_error)[root]
+
+
+def _subtree_versions(repo_root, scm_class, roots):
+    """
+    Version several subtrees of one repository in one history pass.
+
+    Returns:
+        A dict mapping each of ``roots`` to a tuple of ``(succeeded,
+        version_or_error_message)``.
+    """
+    try:
+        with scm_class(repo_root) as repo:
+            snapshots = repo.subtree_snapshots(roots)
+    except Exception as error:
+        message = '%s: %s' % (type(error).__name__, error)
+        return dict((root, (False, message)) for root in roots)
+
+    results = {}
+    for root, snapshot in snapshots.items():
+        if snapshot is None:
+            results[root] = (False, 'No commit touched %s' %
+                             os.path.abspath(root))
+        else:
+            results[root] = (True, snapshot.pep440(branch=False))
+    return results
+
+
+def subtree_versions(roots, on_error=ERROR_RAISE):
+    """
+    Get the version strings of many subtrees.
+
+    Subtrees within the same repository share a single pass over its
+    history (one ``git log`` or ``hg log``), however many there are.
+
+    Parameters:
+        roots (iterable): Paths to directories to version.  See
+            ``subtree_version()``.
+        on_error=ERROR_RAISE (string): One of ERROR_RAISE or ERROR_RETURN.
+            If ERROR_RAISE, VersionNotFound is raised (after every root has
+            been attempted) if any root could not be versioned.  If
+            ERROR_RETURN, the version of such a root is 'UNKNOWN'.
+
+    Returns:
+        A dict mapping each root (as given) to its version string.
+    """
+    from .versioning import find_repository
+
+    roots = list(roots)
+    repositories = {}
+    results = {}
+    for root in roots:
+        scm_class, repo_root = find_repository(root)
+        if scm_class is None:
+            results[root] = (False, (
+                'A version could not be loaded from scm in %s' %
+                os.path.abspath(root)))
+        else:
+            repositories.setdefault((scm_class, repo_root), []).append(root)
+
+    for (scm_class, repo_root), repo_roots in repositories.items():
+        results.update(_subtree_versions(repo_root, scm_class, repo_roots))
+
+    versions = {}
+    errors = []
+    for root in roots:
+        succeeded, value = results[root]
+        if succeeded:
+            versions[root] = value
+        else:
+            LOGGER.warning('Could not version %s: %s', root, value)
+            errors.append('%s (%s)' % (root, value))
+            versions[root] = 'UNKNOWN'
+
+    if errors and on_error == ERROR_RAISE:
+        raise VersionNotFound(
+            'Versions could not be loaded for: %s' % ', '.join(errors))
+    return versions
+
+
+def iter_versions(root='.', rev_range=None):
+    """
+    Stream the version string of every commit in a range of history.
+
+    The commits are read oldest first from a single ``git rev-list`` or
+    ``hg log`` process, so versioning a long range costs about as much as
+    listing it, and nothing is checked out.  See
+    ``natcap.versioner.history``.
+
+    Example:
+        for node, version in natcap.versioner.iter_versions(
+                root, '0.1..0.2'):
+            print(node, version)
+
+    Parameters:
+        root='.' (string): A path within a git or mercurial repository.
+        rev_range=None (string or None): The commits to version, as a git
+            revision range (e.g. '0.1..0.2') or a mercurial revset (e.g.
+            '0.1::0.2').  If None, every ancestor of the working copy.
+
+    Returns:
+        A generator of ``(node, version)`` tuples, where ``node`` is the
+        full commit id.
+
+    Raises:
+        VersionNotFound: when ``root`` is not within a git or mercurial
+            repository.
+    """
+    from .versioning import find_repository
+
+    scm_class, repo_root = find_repository(root)
+    repo = None if scm_class is None else scm_class(repo_root)
+    if repo is None or repo.is_archive:
+        raise VersionNotFound(
+            'A version history could not be loaded from scm in %s' %
+            os.path.abspath(root))
+    return repo.iter_versions(rev_range)
+
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+
+
+def _repo_root(root):
+    """
+    Find the root of the repository ``vcs_version(root)`` would query.
+
+    Parameters:
+        root (string): A path within a repository.
+
+    Returns:
+        The absolute path to the repository root, or None if ``root`` is not
+        within a known repository.
+    """
+    from .versioning import find_repository
+    return find_repository(root)[1]
+
+
+def _pooled_vcs_version(repo_root, use_cache):
+    """
+    Resolve one repository's version inside an executor.
+
+    Exceptions are returned as strings so that results can always be sent
+    back from a worker process.
+
+    Returns:
+        A tuple of ``(succeeded, version_or_error_message)``.
+    """
+    try:
+        return True, vcs_version(repo_root, on_error=ERROR_RAISE,
+                                 use_cache=use_cache)
+    except Exception as error:
+        return False, '%s: %s' % (type(error).__name__, error)
+
+
+def vcs_version_many(roots, max_workers=None, executor=EXECUTOR_THREAD,
+                     on_error=ERROR_RAISE, use_cache=True):
+    """
+    Get the version strings of many directories concurrently.
+
+    Roots within the same repository are grouped so that each repository is
+    queried only once.
+
+    Parameters:
+        roots (iterable): Paths to directories to version.  See
+            ``vcs_version()``.
+        max_workers=None (int or None): The maximum number of concurrent
+            queries.  If None, the executor's default is used.
+        executor=EXECUTOR_THREAD (string): One of EXECUTOR_THREAD or
+            EXECUTOR_PROCESS.
+        on_error=ERROR_RAISE (string): One of ERROR_RAISE or ERROR_RETURN.
+            If ERROR_RAISE, VersionNotFound is raised (after every root has
+            been attempted) if any root could not be versioned.  If
+            ERROR_RETURN, the version of such a root is 'UNKNOWN'.
+        use_cache=True (bool): Whether to use the on-disk version cache.
+
+    Returns:
+        A dict mapping each root (as given) to its version string.
+    """
+    assert executor in [EXECUTOR_THREAD, EXECUTOR_PROCESS], (
+        'Executor %s not valid') % executor
+    from concurrent import futures
+
+    roots = list(roots)
+    repo_roots = {}
+    for root in roots:
+        repo_roots[root] = _repo_root(root)
+    unique_repo_roots = sorted(set(
+        repo_root for repo_root in repo_roots.values()
+        if repo_root is not None))
+
+    if executor == EXECUTOR_THREAD:
+        pool_class = futures.ThreadPoolExecutor
+    else:
+        pool_class = futures.ProcessPoolExecutor
+
+    results = {}
+    if unique_repo_roots:
+        with pool_class(max_workers=max_workers) as pool:
+            pending = dict(
+                (repo_root, pool.submit(_pooled_vcs_version, repo_root,
+                                        use_cache))
+                for repo_root in unique_repo_roots)
+            for repo_root, future in pending.items():
+                results[repo_root] = future.result()
+
+    versions = {}
+    errors = []
+    for root in roots:
+        repo_root = repo_roots[root]
+        if repo_root is None:
+            succeeded, value = False, (
+                'A version could not be loaded from scm in %s' %
+                os.path.abspath(root))
+        else:
+            succeeded, value = results[repo_root]
+
+        if succeeded:
+            versions[root] = value
+        else:
+            LOGGER.warning('Could not version %s: %s', root, value)
+            errors.append('%s (%s)' % (root, value))
+            versions[root] = 'UNKNOWN'
+
+    if errors and on_error == ERROR_RAISE:
+        raise VersionNotFound(
+            'Versions could not be loaded for: %s' % ', '.join(errors))
+    return versions
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        """Compute ``__version__`` on first access rather than at import."""
+        if name == '__version__':
+            version = get_version('natcap.versioner')
+            globals()['__version__'] = version
+            return version
+        raise AttributeError(
+            'module %r has no attribute %r' % (__name__, name))
+else:
+    # Module-level __getattr__ is not supported before python 3.7.
+    __version__ = get_version('natcap.versioner')
@@ -0,0 +1,278 @@
+"""
+Coroutine counterparts of the version queries, built on asyncio.
+
+Commands are started with ``asyncio.create_subprocess_exec`` so that the
+event loop is never blocked, and many repositories can be queried
+concurrently without a thread per query.  Reading files (stat signatures,
+HEAD, the commit-graph, the on-disk cache, ...) runs in the loop's default
+executor.  This module requires python 3.5+;
+use ``natcap.versioner.async_vcs_version()`` or ``VCSQuerier.async_pep440()``
+rather than importing it directly.
+"""
+import asyncio
+import functools
+import logging
+import os
+import subprocess
+
+from . import cache
+from . import daemon
+from . import executors
+from . import profiling
+from . import versioning
+
+LOGGER = logging.getLogger('natcap.versioner.aio')
+LOGGER.setLevel(logging.ERROR)
+
+
+def _running_loop():
+    """Get the event loop running the current coroutine."""
+    # asyncio.get_running_loop() is new in python 3.7.
+    get_running_loop = getattr(asyncio, 'get_running_loop',
+                               asyncio.get_event_loop)
+    return get_running_loop()
+
+
+async def _in_thread(function, *args):
+    """Call ``function(*args)`` in the loop's default executor, so that its
+    file reads don't block the event loop."""
+    return await _running_loop().run_in_executor(
+        None, functools.partial(function, *args))
+
+
+async def run_command(args, cwd=None, timeout=None):
+    """
+    Run a command without a shell and collect its output.
+
+    Commands are run with ``executors.hardened_environment()``.
+
+    Parameters:
+        args (list): The program and its arguments.
+        cwd=None (string or None): The working directory for the command.
+        timeout=None (float or None): The number of seconds the command may
+            run for.  If None, there is no limit.
+
+    Returns:
+        The stripped, decoded stdout and stderr of the command.
+
+    Raises:
+        subprocess.CalledProcessError: when the command exits nonzero.
+        executors.CommandTimeout: when the command runs past ``timeout``.
+    """
+    with profiling.stage(profiling.STAGE_SUBPROCESS, args[0]):
+        return await _run_command(args, cwd, timeout)
+
+
+async def _run_command(args, cwd, timeout):
+    process = await asyncio.create_subprocess_exec(
+        *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, cwd=cwd,
+        env=executors.hardened_environment())
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise executors.CommandTimeout(
+            'Command %r timed out after %s seconds' % (
+                ' '.join(args), timeout))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, args, output)
+    return output.strip().decode('utf-8')
+
+
+async def _run(repo, args):
+    """Run a command in the repository, counting it against the querier."""
+    repo.process_count += 1
+    with profiling.stage(profiling.STAGE_COMMAND, ' '.join(args[:2])):
+        return await run_command(args, cwd=repo._repo_path,
+                                 timeout=repo.command_timeout)
+
+
+async def _git_snapshot_fields(repo):
+    # Branch and node are read from disk, so only describe (and, without
+    # tags, the commit count) need a process.
+    try:
+        describe = await _run(
+            repo, ['git', 'describe', '--tags', '--long', '--always'])
+    except subprocess.CalledProcessError:
+        raise IOError('Could not describe HEAD: no commits')
+
+    tag, distance, abbrev = repo._parse_describe(describe)
+    count = None
+    if tag is None:
+        count = await _in_thread(repo._graph_ancestor_count)
+        if count is None:
+            count = int(await _run(
+                repo, ['git', 'rev-list', '--count', 'HEAD']))
+    repo._set_described(tag, distance, abbrev, count)
+    branch, node = await _in_thread(_head_fields, repo)
+
+    return {
+        'latest_tag': repo._latest_tag,
+        'tag_distance': repo._tag_distance,
+        'branch': branch,
+        'node': node,
+        'build_id': '%s:%s [%s]' % (repo._tag_distance, repo._latest_tag,
+                                    repo._commit_hash),
+    }
+
+
+def _head_fields(repo):
+    """Read the branch and node of a GitRepo from disk."""
+    return repo.branch, repo.node
+
+
+async def _hg_snapshot_fields(repo):
+    separator = repr(repo.field_separator)[1:-1]
+    template = separator.join([keyword for _, keyword in repo.log_fields])
+    output = await _run(
+        repo, ['hg', 'log', '-r', '.', '--config', 'ui.report_untrusted=False',
+               '--template', template])
+    values = output.split(repo.field_separator)
+    if len(values) != len(repo.log_fields):
+        raise ValueError('Unexpected output from hg log: %r' % values)
+    values = dict(zip([name for name, _ in repo.log_fields], values))
+    return {
+        'latest_tag': values['latesttag'],
+        'tag_distance': int(values['latesttagdistance']),
+        'branch': values['branch'],
+        'node': values['node'],
+        'build_id': '{latesttagdistance}:{latesttag} [{node}]'.format(
+            **values),
+    }
+
+
+async def snapshot(repo):
+    """
+    Coroutine counterpart of ``VCSQuerier.snapshot()``.
+
+    The querier's memoized snapshot is shared with the synchronous API.
+
+    Parameters:
+        repo (VCSQuerier): The repository to query.
+
+    Returns:
+        A ``natcap.versioner.versioning.VersionSnapshot`` instance.
+    """
+    signature = await _in_thread(repo._state_signature)
+    if (signature is not None and repo._snapshot is not None and
+            repo._snapshot[0] == signature):
+        repo.last_process_count = 0
+        return repo._snapshot[1]
+
+    repo.refresh()
+    process_count = repo.process_count
+    spawns = isinstance(repo._get_executor(), executors.SubprocessExecutor)
+    if (spawns and isinstance(repo, versioning.GitRepo) and
+            repo.backend == versioning.BACKEND_CLI):
+        fields = await _git_snapshot_fields(repo)
+    elif (spawns and isinstance(repo, versioning.HgRepo) and
+            repo.backend == versioning.BACKEND_CLI):
+        fields = await _hg_snapshot_fields(repo)
+    else:
+        # Archives and the on-disk readers don't start processes, the
+        # command server is a single shared process, and custom executors
+        # (e.g. replays) only have a synchronous interface, so run them in
+        # a worker thread.
+        fields = await _in_thread(repo._snapshot_fields)
+
+    result = versioning.VersionSnapshot(**fields)
+    repo.last_process_count = repo.process_count - process_count
+    if signature is not None:
+        repo._snapshot = (signature, result)
+    return result
+
+
+async def pep440(repo, branch=True, method='post'):
+    """
+    Coroutine counterpart of ``VCSQuerier.pep440()``.
+    """
+    return (await snapshot(repo)).pep440(branch=branch, method=method)
+
+
+async def _daemon_version(root, use_cache):
+    """
+    Ask a running ``natcap-versioner serve`` daemon for the version, over
+    an asyncio connection.
+
+    Returns:
+        The version string, or None if no daemon answered.
+    """
+    try:
+        socket_path = daemon.default_socket_path()
+        await _in_thread(daemon._check_socket, socket_path)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(socket_path),
+                daemon.CONNECT_TIMEOUT)
+        except OSError as error:
+            daemon._forget_socket(socket_path, error)
+            raise
+        try:
+            writer.write(daemon._encode_query(root, use_cache))
+            line = await asyncio.wait_for(reader.readline(),
+                                          daemon.QUERY_TIMEOUT)
+        finally:
+            writer.close()
+            # StreamWriter.wait_closed() is new in python 3.7.
+            if hasattr(writer, 'wait_closed'):
+                try:
+                    await writer.wait_closed()
+                except OSError as error:
+                    LOGGER.debug('Could not close the connection: %s',
+                                 error)
+        return daemon._parse_answer(line)
+    except (daemon.DaemonError, OSError, asyncio.TimeoutError) as error:
+        LOGGER.debug('Not using a daemon: %s', error)
+        return None
+
+
+async def vcs_version(root='.', on_error=None, use_cache=True):
+    """
+    Coroutine counterpart of ``natcap.versioner.vcs_version()``.
+
+    Like it, a running ``natcap-versioner serve`` daemon is asked first.
+    """
+    import natcap.versioner
+    if on_error is None:
+        on_error = natcap.versioner.ERROR_RAISE
+
+    version = await _daemon_version(root, use_cache)
+    if version is not None:
+        return version
+
+    with profiling.stage(profiling.STAGE_DISCOVERY, root) as stage:
+        scm_class, repo_root = await _in_thread(
+            versioning.find_repository, root)
+        if scm_class is None:
+            stage.outcome = profiling.OUTCOME_NOT_FOUND
+    result = None
+    if scm_class is not None:
+        try:
+            result = await _cached_snapshot(scm_class(repo_root), use_cache)
+        except ValueError as error:
+            # As in vcs_version(), malformed repository data is no version.
+            LOGGER.debug('Could not version %s: %s', repo_root, error)
+    if result is None:
+        if on_error == natcap.versioner.ERROR_RAISE:
+            raise natcap.versioner.VersionNotFound(
+                'A version could not be loaded from scm in %s' %
+                os.path.abspath(root))
+        return 'UNKNOWN'
+    return result.pep440(branch=False)
+
+
+async def _cached_snapshot(repo, use_cache):
+    """Take a snapshot of ``repo`` through the on-disk version cache."""
+    cache_key, result = None, None
+    if use_cache:
+        with profiling.stage(profiling.STAGE_CACHE, 'lookup') as stage:
+            cache_key, result = await _in_thread(cache.lookup, repo)
+            if result is None:
+                stage.outcome = profiling.OUTCOME_NOT_FOUND
+    if result is None:
+        result = await snapshot(repo)
+        await _in_thread(cache.store, repo, cache_key, result)
+    return result
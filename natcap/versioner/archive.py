@@ -0,0 +1,269 @@
+"""
+Version metadata recorded in source archives and distributions.
+
+Three kinds of files are understood:
+
+    * ``.hg_archival.txt``, written by ``hg archive``.
+    * ``.git_archival.txt``, a stamp file that ``git archive`` fills in
+      when it is marked ``export-subst`` in ``.gitattributes``.
+    * ``PKG-INFO``, the metadata of a source distribution.
+
+Each file is parsed once per process.  Parsed metadata is cached by path
+and reused for as long as the file's modification time, inode and size are
+unchanged.
+"""
+from __future__ import absolute_import
+import io
+import os
+import re
+import threading
+
+from . import pep440
+from . import profiling
+
+HG_ARCHIVAL = '.hg_archival.txt'
+GIT_ARCHIVAL = '.git_archival.txt'
+PKG_INFO = 'PKG-INFO'
+
+# The contents of a .git_archival.txt to commit to a git repository, along
+# with a ``.git_archival.txt export-subst`` line in .gitattributes.
+GIT_ARCHIVAL_TEMPLATE = (
+    'node: $Format:%H$\n'
+    'describe-name: $Format:%(describe:tags=true)$\n'
+    'ref-names: $Format:%D$\n')
+
+# Fields of .hg_archival.txt that hold revision counts.
+_HG_INT_FIELDS = frozenset(['latesttagdistance', 'changessincelatesttag'])
+
+# Fields of .hg_archival.txt written once per tag, when a commit has several.
+_HG_TAG_FIELDS = ('tag', 'latesttag')
+
+# git leaves placeholders it could not expand (or, outside of an archive,
+# all of them) as they are.
+_UNSUBSTITUTED = '$Format:'
+
+_DESCRIBE_PATTERN = re.compile(r'^(.*)-([0-9]+)-g([0-9a-f]+)$')
+
+_METADATA_CACHE = {}
+_METADATA_CACHE_LOCK = threading.Lock()
+
+
+class ArchiveError(ValueError):
+    """
+    Raised when an archive metadata file is malformed or incomplete.
+    """
+    pass
+
+
+def _read_fields(metadata_file, stop_at_blank=False, repeated=()):
+    """Read the ``name: value`` lines of a metadata file.
+
+    Only the first ``': '`` of a line separates the name from the value, so
+    values may contain it too.
+
+    Parameters:
+        metadata_file (file): A text file object.
+        stop_at_blank=False (bool): Whether a blank line ends the fields
+            (as it does the headers of PKG-INFO).
+        repeated=() (iterable): Names of fields that may be given several
+            times, whose values are collected in a list.
+
+    Returns:
+        A dict mapping each field name to its last value, or to the list of
+        its values for the ``repeated`` fields."""
+    repeated = frozenset(repeated)
+    fields = {}
+    for line in metadata_file:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            if stop_at_blank:
+                break
+            continue
+        if line[0] in ' \t':
+            # A continuation of the previous (multi-line) value.
+            continue
+        name, separator, value = line.partition(':')
+        if not separator:
+            continue
+        name = name.strip()
+        if name in repeated:
+            fields.setdefault(name, []).append(value.strip())
+        else:
+            fields[name] = value.strip()
+    return fields
+
+
+def parse_hg_archival(metadata_file):
+    """
+    Parse a ``.hg_archival.txt`` file.
+
+    Parameters:
+        metadata_file (file): The open file.
+
+    Returns:
+        A dict of the attributes of the file (such as ``node``, ``branch``,
+        ``latesttag`` and ``latesttagdistance``, or ``tag`` when the archive
+        was made at a tag).  Revision counts are ints.  When a commit has
+        several tags, the highest version is used (see
+        ``pep440.highest()``).
+    """
+    attributes = _read_fields(metadata_file, repeated=_HG_TAG_FIELDS)
+    for name in _HG_TAG_FIELDS:
+        if name in attributes:
+            attributes[name] = pep440.highest(attributes[name])
+    for name in _HG_INT_FIELDS & set(attributes):
+        try:
+            attributes[name] = int(attributes[name])
+        except ValueError:
+            raise ArchiveError('%s is not a number: %r' % (
+                name, attributes[name]))
+    return attributes
+
+
+def parse_git_archival(metadata_file):
+    """
+    Parse a ``.git_archival.txt`` stamp file filled in by ``git archive``.
+
+    See ``GIT_ARCHIVAL_TEMPLATE`` for the expected fields.
+
+    Parameters:
+        metadata_file (file): The open file.
+
+    Returns:
+        A dict with the keys ``node`` (the full commit id), ``latesttag``,
+        ``latesttagdistance``, ``abbrev`` (the abbreviated commit id git
+        described the commit with) and ``branch`` (``'HEAD'`` if no branch
+        pointed at the archived commit).  As for repositories, the latest
+        tag is ``'null'`` when no tag is reachable; the stamp doesn't record
+        how many commits there are, so the distance is then 1, the fewest
+        there can be.
+
+    Raises:
+        ArchiveError: when the file was not filled in by ``git archive``, or
+            by one too old to describe an untagged commit.
+    """
+    fields = _read_fields(metadata_file)
+    node = fields.get('node', '')
+    if not node or _UNSUBSTITUTED in node:
+        raise ArchiveError('The stamp file was not filled in by git archive')
+
+    ref_names = [ref.strip() for ref in fields.get('ref-names', '').split(',')
+                 if ref.strip() and _UNSUBSTITUTED not in ref]
+    branch = 'HEAD'
+    for ref in ref_names:
+        if ref.startswith('HEAD -> '):
+            branch = ref[len('HEAD -> '):]
+            break
+
+    describe_name = fields.get('describe-name', '')
+    # git older than 2.32 doesn't support %(describe).
+    described = _UNSUBSTITUTED not in describe_name
+    if not described:
+        describe_name = ''
+    match = _DESCRIBE_PATTERN.match(describe_name)
+    if match is not None:
+        latest_tag = match.group(1)
+        distance = int(match.group(2))
+        abbrev = match.group(3)
+    else:
+        tags = [ref[len('tag: '):] for ref in ref_names
+                if ref.startswith('tag: ')]
+        distance = 0
+        abbrev = node[:7]
+        if describe_name:
+            latest_tag = describe_name
+        elif tags:
+            latest_tag = pep440.highest(tags)
+        elif described:
+            latest_tag = 'null'
+            distance = 1
+        else:
+            raise ArchiveError(
+                'git archive could not describe commit %s' % node)
+
+    return {
+        'node': node,
+        'latesttag': latest_tag,
+        'latesttagdistance': distance,
+        'abbrev': abbrev,
+        'branch': branch,
+    }
+
+
+def parse_pkg_info(metadata_file):
+    """
+    Parse the headers of a ``PKG-INFO`` file.
+
+    Parameters:
+        metadata_file (file): The open file.
+
+    Returns:
+        A dict mapping each header (such as ``Name`` and ``Version``) to its
+        last value.
+    """
+    return _read_fields(metadata_file, stop_at_blank=True)
+
+
+_PARSERS = {
+    HG_ARCHIVAL: parse_hg_archival,
+    GIT_ARCHIVAL: parse_git_archival,
+    PKG_INFO: parse_pkg_info,
+}
+
+
+def _signature(path):
+    """Get the stat signature of a file.
+
+    Raises:
+        OSError: when the file does not exist."""
+    stat_result = os.stat(path)
+    return (getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime),
+            stat_result.st_ino, stat_result.st_size)
+
+
+def load(dirpath, filename):
+    """
+    Get the metadata of an archive metadata file, parsing it only if it has
+    changed since it was last loaded.
+
+    Parameters:
+        dirpath (string): The directory containing the file.
+        filename (string): One of HG_ARCHIVAL, GIT_ARCHIVAL or PKG_INFO.
+
+    Returns:
+        A new dict of the metadata (see ``parse_hg_archival``,
+        ``parse_git_archival`` and ``parse_pkg_info``).
+
+    Raises:
+        IOError: when the file cannot be read.
+        ArchiveError: when the file is malformed.
+    """
+    parser = _PARSERS[filename]
+    path = os.path.abspath(os.path.join(dirpath, filename))
+    try:
+        signature = _signature(path)
+    except OSError as error:
+        raise IOError(error.errno, error.strerror, path)
+
+    with _METADATA_CACHE_LOCK:
+        cached = _METADATA_CACHE.get(path)
+    if cached is not None and cached[0] == signature:
+        return dict(cached[1])
+
+    with profiling.stage(profiling.STAGE_ARCHIVE, path):
+        with io.open(path, encoding='utf-8', errors='replace') as metadata_file:
+            metadata = parser(metadata_file)
+    with _METADATA_CACHE_LOCK:
+        _METADATA_CACHE[path] = (signature, metadata)
+    return dict(metadata)
+
+
+def clear_cache():
+    """
+    Forget every cached archive metadata file.
+
+    Returns:
+        None.
+    """
+    with _METADATA_CACHE_LOCK:
+        _METADATA_CACHE.clear()
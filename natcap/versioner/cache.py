@@ -0,0 +1,158 @@
+"""
+A persistent, on-disk cache of version snapshots.
+
+The cache is a small JSON file stored inside the repository's data
+directory (``.git`` or ``.hg``), so it is never committed.  Entries are keyed
+by the state the version depends on (e.g. the commit checked out and a
+fingerprint of the tags), which each ``VCSQuerier`` computes by reading a
+few small files rather than calling the VCS.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import tempfile
+
+from . import profiling
+
+LOGGER = logging.getLogger('natcap.versioner.cache')
+LOGGER.setLevel(logging.ERROR)
+
+CACHE_FILENAME = 'natcap-versioner-cache.json'
+
+# The most entries kept in a single cache file.  Older entries are dropped
+# first.
+MAX_ENTRIES = 64
+
+
+def _load(cache_path):
+    """Load the cache file, returning an empty cache if it's unusable."""
+    try:
+        with open(cache_path) as cache_file:
+            data = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {'entries': []}
+    if not isinstance(data, dict) or not isinstance(
+            data.get('entries'), list):
+        return {'entries': []}
+    return data
+
+
+def _store(cache_path, data):
+    """Atomically write the cache file.  Failures are logged and ignored."""
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        handle, temp_path = tempfile.mkstemp(
+            prefix=CACHE_FILENAME, dir=cache_dir)
+        with os.fdopen(handle, 'w') as temp_file:
+            json.dump(data, temp_file)
+        try:
+            os.replace(temp_path, cache_path)
+        except AttributeError:
+            # python 2 has no os.replace
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            os.rename(temp_path, cache_path)
+    except (IOError, OSError) as error:
+        LOGGER.debug('Could not write version cache %s: %s',
+                     cache_path, error)
+
+
+def lookup(repo):
+    """
+    Look up a repository's snapshot in the on-disk cache.
+
+    Parameters:
+        repo (VCSQuerier): The repository to look up.
+
+    Returns:
+        A tuple of ``(cache_key, snapshot)``.  ``cache_key`` is None when
+        the repository has no cache.  ``snapshot`` is a ``VersionSnapshot``
+        instance, or None on a cache miss.
+    """
+    from .versioning import VersionSnapshot
+
+    cache_path = repo._cache_location()
+    cache_key = repo._cache_key()
+    if cache_path is None or cache_key is None:
+        return None, None
+
+    for key, fields in _load(cache_path)['entries']:
+        if key == cache_key:
+            try:
+                return cache_key, VersionSnapshot(**fields)
+            except TypeError:
+                # Written by an incompatible version; recompute it.
+                break
+    return cache_key, None
+
+
+def store(repo, cache_key, snapshot):
+    """
+    Store a repository's snapshot in the on-disk cache.
+
+    Parameters:
+        repo (VCSQuerier): The repository the snapshot was taken from.
+        cache_key (string or None): The key returned by ``lookup()`` before
+            the snapshot was computed.  If None, nothing is stored.
+        snapshot (VersionSnapshot): The snapshot to store.
+
+    Returns:
+        None.
+    """
+    cache_path = repo._cache_location()
+    if cache_path is None or cache_key is None:
+        return
+
+    entries = [entry for entry in _load(cache_path)['entries']
+               if entry[0] != cache_key]
+    entries.append([cache_key, dict(snapshot._asdict())])
+    _store(cache_path, {'entries': entries[-MAX_ENTRIES:]})
+
+
+def cached_snapshot(repo):
+    """
+    Get a repository's snapshot, from the on-disk cache where possible.
+
+    On a cache miss, the snapshot is computed through the VCS and stored.
+
+    Parameters:
+        repo (VCSQuerier): The repository to query.
+
+    Returns:
+        A ``natcap.versioner.versioning.VersionSnapshot`` instance.
+    """
+    with profiling.stage(profiling.STAGE_CACHE, 'lookup') as stage:
+        cache_key, snapshot = lookup(repo)
+        if snapshot is None:
+            stage.outcome = profiling.OUTCOME_NOT_FOUND
+    if snapshot is None:
+        snapshot = repo.snapshot()
+        store(repo, cache_key, snapshot)
+    return snapshot
+
+
+def clear_cache(root='.'):
+    """
+    Remove the version cache of the repository containing ``root``.
+
+    Parameters:
+        root='.' (string): A path within a git or mercurial repository.
+
+    Returns:
+        A list of the cache files that were removed.
+    """
+    from .versioning import HgRepo, GitRepo
+
+    removed = []
+    for scm_class in [HgRepo, GitRepo]:
+        try:
+            repo = scm_class(root)
+        except ValueError:
+            # Raised when the repo type is not found.
+            continue
+        cache_path = repo._cache_location()
+        if cache_path is not None and os.path.exists(cache_path):
+            os.remove(cache_path)
+            removed.append(cache_path)
+    return removed
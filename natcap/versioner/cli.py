@@ -0,0 +1,88 @@
+"""
+The ``natcap-versioner`` command-line interface.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import sys
+
+
+def _clear_cache(args):
+    from . import cache
+    for cache_path in cache.clear_cache(args.root):
+        print('Removed %s' % cache_path)
+    return 0
+
+
+def _write_manifest(args):
+    from . import registry
+    recorded = registry.write_manifest(args.output, args.packages or None)
+    print('Recorded %s packages in %s' % (len(recorded), args.output))
+    return 0
+
+
+def _serve(args):
+    from . import daemon
+    server = daemon.VersionServer(args.socket)
+    print('Serving versions on %s' % server.socket_path)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def main(argv=None):
+    """
+    Run the command-line interface.
+
+    Parameters:
+        argv=None (list or None): The arguments to parse.  If None,
+            ``sys.argv[1:]`` is used.
+
+    Returns:
+        The integer exit code.
+    """
+    parser = argparse.ArgumentParser(prog='natcap-versioner')
+    subparsers = parser.add_subparsers(dest='command')
+
+    clear_parser = subparsers.add_parser(
+        'clear-cache',
+        help='Remove the on-disk version cache of a repository.')
+    clear_parser.add_argument(
+        'root', nargs='?', default='.',
+        help='A path within the repository (default: the current directory).')
+    clear_parser.set_defaults(func=_clear_cache)
+
+    manifest_parser = subparsers.add_parser(
+        'manifest',
+        help='Write a JSON manifest of package versions for '
+             'natcap.versioner.registry.load_manifest().')
+    manifest_parser.add_argument('output', help='The file to write.')
+    manifest_parser.add_argument(
+        'packages', nargs='*',
+        help='The packages to record (default: every installed '
+             'distribution).')
+    manifest_parser.set_defaults(func=_write_manifest)
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='Answer version queries over a Unix socket until interrupted.')
+    serve_parser.add_argument(
+        '--socket', default=None,
+        help='The socket to listen on (default: $NATCAP_VERSIONER_SOCKET, '
+             'or a socket in $XDG_RUNTIME_DIR or /tmp).')
+    serve_parser.set_defaults(func=_serve)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
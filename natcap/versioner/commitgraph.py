@@ -0,0 +1,542 @@
+"""
+Read git's commit-graph files.
+
+``git commit-graph write`` (run by ``git gc`` and ``git fetch`` with
+``fetch.writeCommitGraph``) stores the parents, commit time and generation
+number of every commit in ``objects/info/commit-graph``, or in a chain of
+files under ``objects/info/commit-graphs/``.  Reading them is far cheaper
+than inflating every commit object, so ancestor counts and tag distances
+over long histories can be computed without calling ``git``.
+
+Columns are decoded into flat arrays with NumPy when it is installed, and
+with the ``array`` module otherwise.  See
+https://git-scm.com/docs/gitformat-commit-graph for the file format.
+"""
+from __future__ import absolute_import
+import array
+import binascii
+import heapq
+import logging
+import os
+import struct
+import sys
+
+# NumPy is optional, and only imported when first needed (see
+# ``_load_numpy()``) so that importing this module stays cheap.
+_NOT_LOADED = object()
+numpy = _NOT_LOADED
+
+LOGGER = logging.getLogger('natcap.versioner.commitgraph')
+LOGGER.setLevel(logging.ERROR)
+
+
+def _load_numpy():
+    """
+    Import NumPy on first use.
+
+    Returns:
+        The numpy module, or None if it isn't installed.
+    """
+    global numpy
+    if numpy is _NOT_LOADED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+_SIGNATURE = b'CGPH'
+_HASH_SHA1 = 1
+_OID_SIZE = 20
+_CDAT_WORDS = 9  # 20-byte tree oid, 2 parents and 8 bytes of gen/time
+
+_PARENT_NONE = 0x70000000
+_PARENT_EXTRA = 0x80000000
+_PARENT_MASK = 0x7fffffff
+
+# Stored in the generation column by git versions that predate generation
+# numbers.
+_GENERATION_ZERO = 0
+
+
+class CommitGraphError(Exception):
+    """
+    Raised when a commit-graph file is malformed or uses an unsupported
+    version.
+    """
+    pass
+
+
+def _read_chunks(data, path):
+    """Validate a graph file's header and map chunk ids to their bytes."""
+    if len(data) < 8 or data[:4] != _SIGNATURE:
+        raise CommitGraphError('Not a commit-graph file: %s' % path)
+    version, hash_version, num_chunks, _ = struct.unpack('>BBBB', data[4:8])
+    if version != 1 or hash_version != _HASH_SHA1:
+        raise CommitGraphError(
+            'Unsupported commit-graph version %s (hash %s): %s' % (
+                version, hash_version, path))
+
+    entries = []
+    for index in range(num_chunks + 1):
+        start = 8 + index * 12
+        chunk_id, offset = struct.unpack('>4sQ', data[start:start + 12])
+        entries.append((chunk_id, offset))
+    chunks = {}
+    for (chunk_id, offset), (_, next_offset) in zip(entries, entries[1:]):
+        chunks[chunk_id] = data[offset:next_offset]
+    for required in (b'OIDF', b'OIDL', b'CDAT'):
+        if required not in chunks:
+            raise CommitGraphError(
+                'Missing %s chunk: %s' % (required.decode('ascii'), path))
+    return chunks
+
+
+def _big_endian_words(data):
+    """Decode big-endian uint32s into an ``array`` of unsigned ints."""
+    words = array.array('I')
+    if words.itemsize != 4:
+        words = array.array('L')
+    try:
+        words.frombytes(bytes(data))
+    except AttributeError:
+        # python 2
+        words.fromstring(bytes(data))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+
+def _time_array(values):
+    """Store commit times, which need more than 32 bits, in an ``array``
+    of int64 (or a list, where the ``array`` module has none)."""
+    try:
+        return array.array('q', values)
+    except ValueError:
+        # python 2
+        return list(values)
+
+
+def _decode_columns(cdat, count):
+    """Decode the parent and generation columns of a CDAT chunk.
+
+    Returns:
+        A tuple of ``(parent1, parent2, generation, commit_time, octopus)``.
+        The first four are int64 NumPy arrays with an item per commit, or
+        ``array`` arrays without NumPy.  The second parent of an octopus
+        merge is stored in the EDGE chunk, so it is replaced by
+        _PARENT_NONE in ``parent2`` and ``octopus`` lists ``(position,
+        edge_index)`` for each of them instead."""
+    if _load_numpy() is not None:
+        words = numpy.frombuffer(
+            cdat, dtype='>u4', count=count * _CDAT_WORDS).reshape(
+                count, _CDAT_WORDS)
+        parent2 = words[:, 6].astype(numpy.int64)
+        octopus = numpy.nonzero(parent2 & _PARENT_EXTRA)[0]
+        edges = (parent2[octopus] & _PARENT_MASK).tolist()
+        parent2[octopus] = _PARENT_NONE
+        high = words[:, 7].astype(numpy.int64)
+        return (words[:, 5].astype(numpy.int64), parent2, high >> 2,
+                ((high & 3) << 32) | words[:, 8],
+                list(zip(octopus.tolist(), edges)))
+
+    words = _big_endian_words(cdat[:count * _CDAT_WORDS * 4])
+    high = words[7::_CDAT_WORDS]
+    parent2 = words[6::_CDAT_WORDS]
+    octopus = []
+    for position, parent in enumerate(parent2):
+        if parent & _PARENT_EXTRA:
+            octopus.append((position, parent & _PARENT_MASK))
+            parent2[position] = _PARENT_NONE
+    return (words[5::_CDAT_WORDS], parent2,
+            array.array(words.typecode, [value >> 2 for value in high]),
+            _time_array(((value & 3) << 32) | low
+                        for value, low in zip(high, words[8::_CDAT_WORDS])),
+            octopus)
+
+
+def _join_columns(pieces):
+    """Join a column decoded from each file of a chain."""
+    if len(pieces) == 1:
+        return pieces[0]
+    if _load_numpy() is not None:
+        return numpy.concatenate(pieces)
+    joined = pieces[0]
+    for piece in pieces[1:]:
+        joined.extend(piece)
+    return joined
+
+
+class _Layer(object):
+    """A single commit-graph file."""
+
+    def __init__(self, path, offset):
+        with open(path, 'rb') as graph_file:
+            data = graph_file.read()
+        chunks = _read_chunks(data, path)
+
+        self.fanout = _big_endian_words(chunks[b'OIDF'][:256 * 4])
+        self.count = self.fanout[255] if len(self.fanout) == 256 else 0
+        self.oids = bytes(chunks[b'OIDL'][:self.count * _OID_SIZE])
+        if (len(self.oids) != self.count * _OID_SIZE or
+                len(chunks[b'CDAT']) < self.count * _CDAT_WORDS * 4):
+            raise CommitGraphError('Truncated commit-graph: %s' % path)
+        self.offset = offset
+        # The parent, generation and commit time columns, taken over by
+        # the CommitGraph.
+        self.columns = _decode_columns(chunks[b'CDAT'], self.count)
+        self.extra_edges = []
+        if b'EDGE' in chunks:
+            self.extra_edges = _big_endian_words(chunks[b'EDGE']).tolist()
+
+    def find(self, binsha):
+        """Binary search for an oid, returning its local position or None."""
+        first_byte = ord(binsha[0:1])
+        low = self.fanout[first_byte - 1] if first_byte else 0
+        high = self.fanout[first_byte]
+        oids = self.oids
+        while low < high:
+            middle = (low + high) // 2
+            current = oids[middle * _OID_SIZE:(middle + 1) * _OID_SIZE]
+            if current < binsha:
+                low = middle + 1
+            elif current > binsha:
+                high = middle
+            else:
+                return middle
+        return None
+
+
+def find_graph_files(objects_dir):
+    """
+    List the commit-graph files of an object directory, base first.
+
+    Like git, a single ``objects/info/commit-graph`` file is preferred over
+    a split chain.
+
+    Parameters:
+        objects_dir (string): The path to a repository's ``objects``
+            directory.
+
+    Returns:
+        A list of paths, which is empty when there is no commit-graph.
+    """
+    single_path = os.path.join(objects_dir, 'info', 'commit-graph')
+    if os.path.exists(single_path):
+        return [single_path]
+
+    graphs_dir = os.path.join(objects_dir, 'info', 'commit-graphs')
+    try:
+        with open(os.path.join(graphs_dir, 'commit-graph-chain')) as chain:
+            hashes = [line.strip() for line in chain if line.strip()]
+    except (IOError, OSError):
+        return []
+    return [os.path.join(graphs_dir, 'graph-%s.graph' % graph_hash)
+            for graph_hash in hashes]
+
+
+def load(objects_dir):
+    """
+    Load the commit-graph of an object directory.
+
+    Parameters:
+        objects_dir (string): The path to a repository's ``objects``
+            directory.
+
+    Returns:
+        A CommitGraph instance, or None if there is no commit-graph.
+
+    Raises:
+        CommitGraphError: when a graph file is malformed or unsupported.
+    """
+    paths = find_graph_files(objects_dir)
+    if not paths:
+        return None
+    try:
+        return CommitGraph(paths)
+    except (IOError, OSError) as error:
+        raise CommitGraphError('Could not read commit-graph: %s' % error)
+
+
+class CommitGraph(object):
+    """
+    The commits of a commit-graph file or chain.
+
+    Commits are identified by their position in the graph: positions in a
+    chain's base files come first, followed by the positions of each later
+    file.  A commit-graph is closed under parents, so every ancestor of a
+    commit in the graph is also in the graph.
+    """
+
+    def __init__(self, paths):
+        """
+        Parameters:
+            paths (list): The graph files of a chain, base first.
+        """
+        self._layers = []
+        self._extra_edges = {}
+        self._runs = None
+
+        columns = []
+        offset = 0
+        for path in paths:
+            layer = _Layer(path, offset)
+            self._layers.append(layer)
+            # Parent positions are already global across the chain.
+            parent1, parent2, generation, commit_time, octopus = (
+                layer.columns)
+            layer.columns = None
+            columns.append((parent1, parent2, generation, commit_time))
+            for local, edge_index in octopus:
+                self._extra_edges[offset + local] = self._read_edges(
+                    layer, edge_index)
+            offset += layer.count
+
+        # Columns stay packed (NumPy or ``array`` arrays), since a list of
+        # ints costs an object per commit.
+        (self.parent1, self.parent2, self.generation,
+         self.commit_time) = [_join_columns(pieces)
+                              for pieces in zip(*columns)]
+        self.count = offset
+        # Painting walks need generation numbers; graphs written before
+        # git 2.18 store zero instead.
+        self.has_generations = _GENERATION_ZERO not in self.generation
+
+    @staticmethod
+    def _read_edges(layer, index):
+        """Read an octopus merge's parents (after the first) from EDGE."""
+        parents = []
+        while True:
+            try:
+                value = layer.extra_edges[index]
+            except IndexError:
+                raise CommitGraphError('Truncated EDGE chunk')
+            parents.append(value & _PARENT_MASK)
+            if value & _PARENT_EXTRA:
+                return parents
+            index += 1
+
+    def position(self, sha):
+        """
+        Find a commit's position in the graph.
+
+        Parameters:
+            sha (string): The hex commit id.
+
+        Returns:
+            The integer position, or None if the commit is not in the graph.
+        """
+        binsha = binascii.unhexlify(sha)
+        for layer in self._layers:
+            local = layer.find(binsha)
+            if local is not None:
+                return layer.offset + local
+        return None
+
+    def sha(self, position):
+        """Get the hex commit id at a position."""
+        for layer in self._layers:
+            if position < layer.offset + layer.count:
+                local = position - layer.offset
+                return binascii.hexlify(
+                    layer.oids[local * _OID_SIZE:(local + 1) * _OID_SIZE]
+                ).decode('ascii')
+        raise IndexError('Commit-graph position out of range: %s' % position)
+
+    def parents(self, position):
+        """Get the positions of a commit's parents."""
+        if position in self._extra_edges:
+            return [int(self.parent1[position])] + self._extra_edges[position]
+        parents = []
+        for parent in (self.parent1[position], self.parent2[position]):
+            if parent != _PARENT_NONE:
+                parents.append(int(parent))
+        return parents
+
+    def _linear_runs(self):
+        """Find runs of commits that each have a single parent, which has
+        no other child.
+
+        Most of a history is linear, so collapsing each run into a single
+        step shrinks a walk over the whole history to roughly one step per
+        merge.  Along a run, generation numbers decrease by exactly one, so
+        once commits are sorted by generation the runs are contiguous
+        slices, which are found with a few vectorized NumPy passes.
+
+        Returns:
+            A tuple of ``(run_length, run_end)`` arrays.  Starting at a
+            commit and following first parents, ``run_length[commit]``
+            commits (inclusive) are visited before reaching
+            ``run_end[commit]``, the last commit of the run, whose parents
+            must then be walked normally."""
+        if self._runs is not None:
+            return self._runs
+
+        numpy = _load_numpy()
+        none = _PARENT_NONE
+        parent1 = self.parent1
+        parent2 = self.parent2
+        generation = self.generation
+        children = numpy.bincount(
+            parent1[parent1 != none], minlength=self.count)
+        children += numpy.bincount(
+            parent2[parent2 != none], minlength=self.count)
+        for parents in self._extra_edges.values():
+            for parent in parents:
+                children[parent] += 1
+
+        # A commit continues its run into its parent when it is the
+        # parent's only child and the parent is its only parent.
+        following = numpy.where(
+            (parent1 != none) & (parent2 == none), parent1, -1)
+        if self._extra_edges:
+            following[list(self._extra_edges)] = -1
+        following[children[numpy.maximum(following, 0)] != 1] = -1
+
+        # With commits in order of decreasing generation, a run continues
+        # as long as each commit's parent is the next commit in the order.
+        # (Commits of equal generation on parallel branches may split a
+        # run into several shorter ones, which is still correct.)
+        order = numpy.argsort(-generation)
+        ends = numpy.ones(self.count, dtype=bool)
+        ends[:-1] = following[order[:-1]] != order[1:]
+        indices = numpy.arange(self.count)
+        end_index = numpy.where(ends, indices, self.count)
+        end_index = numpy.minimum.accumulate(end_index[::-1])[::-1]
+
+        run_length = numpy.empty(self.count, dtype=numpy.int64)
+        run_end = numpy.empty(self.count, dtype=numpy.int64)
+        run_length[order] = end_index - indices + 1
+        run_end[order] = order[end_index]
+        self._runs = (run_length, run_end)
+        return self._runs
+
+    def count_reachable(self, starts):
+        """
+        Count the commits reachable from any of ``starts``, inclusive.
+
+        Parameters:
+            starts (iterable): Commit positions.
+
+        Returns:
+            An int.
+        """
+        if _load_numpy() is not None:
+            return self._count_reachable_runs(starts)
+
+        seen = bytearray(self.count)
+        stack = []
+        for position in starts:
+            if not seen[position]:
+                seen[position] = 1
+                stack.append(position)
+
+        parent1 = self.parent1
+        parent2 = self.parent2
+        extra_edges = self._extra_edges
+        none = _PARENT_NONE
+        while stack:
+            position = stack.pop()
+            # Follow first parents without going through the stack, since
+            # most commits have only one.
+            while True:
+                parent = parent2[position]
+                if parent != none and not seen[parent]:
+                    seen[parent] = 1
+                    stack.append(parent)
+                if extra_edges and position in extra_edges:
+                    for parent in extra_edges[position]:
+                        if not seen[parent]:
+                            seen[parent] = 1
+                            stack.append(parent)
+                parent = parent1[position]
+                if parent == none or seen[parent]:
+                    break
+                seen[parent] = 1
+                position = parent
+        return seen.count(1)
+
+    def _count_reachable_runs(self, starts):
+        """``count_reachable()``, one linear run at a time."""
+        run_length, run_end = self._linear_runs()
+        # Every way into a run ends at the same commit, so the commits
+        # counted from a run are those of its longest entry.
+        counted = {}
+        count = 0
+        stack = list(starts)
+        while stack:
+            position = stack.pop()
+            length = run_length.item(position)
+            end = run_end.item(position)
+            previous = counted.get(end)
+            if previous is None:
+                counted[end] = length
+                count += length
+                stack.extend(self.parents(end))
+            elif length > previous:
+                counted[end] = length
+                count += length - previous
+        return count
+
+    def count_exclusive(self, starts, excludes):
+        """
+        Count the commits reachable from ``starts`` but not from
+        ``excludes``, as ``git rev-list --count starts ^excludes`` does.
+
+        Commits are visited in order of decreasing generation number, so the
+        walk stops as soon as every commit left to visit is reachable from
+        ``excludes``.  For a tag distance, that is after roughly as many
+        commits as the distance itself, rather than the whole history.
+
+        Parameters:
+            starts (iterable): Commit positions to count from.
+            excludes (iterable): Commit positions whose ancestors are not
+                counted.
+
+        Returns:
+            An int.
+        """
+        starts = list(starts)
+        excludes = list(excludes)
+        if not excludes:
+            return self.count_reachable(starts)
+        if not self.has_generations:
+            return (self.count_reachable(starts + excludes) -
+                    self.count_reachable(excludes))
+
+        included, excluded = 1, 2
+        generation = self.generation
+        flags = {}
+        for position in starts:
+            flags[position] = flags.get(position, 0) | included
+        for position in excludes:
+            flags[position] = flags.get(position, 0) | excluded
+        queue = [(-generation[position], position) for position in flags]
+        heapq.heapify(queue)
+        # The number of queued commits that aren't reachable from excludes.
+        # The walk is over when there are none.
+        pending = len([flag for flag in flags.values() if flag == included])
+
+        count = 0
+        while queue and pending:
+            _, position = heapq.heappop(queue)
+            flag = flags[position]
+            if flag == included:
+                pending -= 1
+                count += 1
+            for parent in self.parents(position):
+                old_flag = flags.get(parent)
+                if old_flag is None:
+                    flags[parent] = flag
+                    heapq.heappush(queue, (-generation[parent], parent))
+                    if flag == included:
+                        pending += 1
+                elif old_flag | flag != old_flag:
+                    # Parents have a lower generation, so this one is still
+                    # queued.
+                    flags[parent] = old_flag | flag
+                    if old_flag == included:
+                        pending -= 1
+        return count
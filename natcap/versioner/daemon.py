@@ -0,0 +1,562 @@
+"""
+A daemon that answers version queries over a local Unix socket.
+
+``natcap-versioner serve`` keeps a querier, and the last version found, for
+every repository it has been asked about.  Short-lived processes that call
+``vcs_version()`` (or ``get_version()``, when it falls back to the VCS) ask
+the daemon first, and only resolve the version themselves when no daemon is
+listening.
+
+Answers are dropped when the files the version depends on change (HEAD and
+refs, the dirstate, the changelog, ...; see ``VCSQuerier._state_paths()``).
+On Linux, the directories holding those files are watched with inotify, so
+a memoized answer is returned without touching the filesystem.  Elsewhere,
+or for directories that can't be watched, the files are stat'ed on each
+query instead.
+
+The socket is ``$XDG_RUNTIME_DIR/natcap-versioner.sock`` (or
+``/tmp/natcap-versioner-<uid>/versioner.sock``) unless the environment
+variable ``NATCAP_VERSIONER_SOCKET`` names another path.  Setting it to an
+empty string stops clients from using a daemon.  Clients only connect when
+the socket exists, and not again to a socket that refused a connection
+until a restarted daemon replaces it.  Whoever can replace the socket can
+answer any version, so clients only connect when the socket and its
+directory belong to the current user and no one else can write to them
+(see ``check_private()``); otherwise they resolve versions themselves.
+
+Each connection carries a single query: a line of JSON with the ``root`` to
+version and whether to ``use_cache``, answered by a line of JSON with the
+``version`` or an ``error`` message.
+"""
+from __future__ import absolute_import
+import ctypes
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import threading
+
+from six.moves import socketserver
+
+LOGGER = logging.getLogger('natcap.versioner.daemon')
+LOGGER.setLevel(logging.ERROR)
+
+SOCKET_ENV_VARIABLE = 'NATCAP_VERSIONER_SOCKET'
+
+# The number of seconds a client waits to connect to the daemon, and for an
+# answer.  Answering may need VCS commands, each of which may run for
+# executors.DEFAULT_TIMEOUT seconds.
+CONNECT_TIMEOUT = 1.0
+QUERY_TIMEOUT = 120.0
+
+# inotify(7) constants.
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF)
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+# Maps the path of a socket no daemon was listening on to its _socket_id(),
+# so that clients don't try to connect to it on every query.
+_DEAD_SOCKETS = {}
+
+
+class DaemonError(Exception):
+    """
+    Raised when no daemon answers a query.
+    """
+    pass
+
+
+def default_socket_path():
+    """
+    Get the path of the daemon's socket.
+
+    Returns:
+        The path, or None if daemons are disabled (through
+        ``NATCAP_VERSIONER_SOCKET``) or Unix sockets are unavailable.
+    """
+    path = os.environ.get(SOCKET_ENV_VARIABLE)
+    if path is not None:
+        return path or None
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'natcap-versioner.sock')
+    return '/tmp/natcap-versioner-%s/versioner.sock' % os.getuid()
+
+
+def check_private(path):
+    """
+    Check that a path belongs to the current user, and that no one else can
+    write to it.
+
+    Parameters:
+        path (string): The socket or its directory.
+
+    Returns:
+        None.
+
+    Raises:
+        DaemonError: when ``path`` can't be stat'ed, belongs to another
+            user or is group- or world-writable.
+    """
+    try:
+        stat_result = os.lstat(path)
+    except OSError as error:
+        raise DaemonError('Could not stat %s: %s' % (path, error))
+    if stat_result.st_uid != os.getuid():
+        raise DaemonError('%s belongs to another user' % path)
+    if stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise DaemonError('%s is writable by other users' % path)
+
+
+def query(root, use_cache=True, socket_path=None, timeout=QUERY_TIMEOUT):
+    """
+    Ask the daemon for the version of a directory.
+
+    Parameters:
+        root (string): The directory to version (see ``vcs_version()``).
+        use_cache=True (bool): Whether the daemon may use the on-disk
+            version cache when it has no answer memoized.
+        socket_path=None (string or None): The daemon's socket.  If None,
+            ``default_socket_path()`` is used.
+        timeout=QUERY_TIMEOUT (float): The number of seconds to wait for
+            the answer.
+
+    Returns:
+        The version string.
+
+    Raises:
+        DaemonError: when no daemon is listening, the socket or its
+            directory could be replaced by another user (see
+            ``check_private()``), or the daemon could not version ``root``.
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    _check_socket(socket_path)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(CONNECT_TIMEOUT)
+        try:
+            client.connect(socket_path)
+        except socket.error as error:
+            _forget_socket(socket_path, error)
+            raise
+        client.settimeout(timeout)
+        client.sendall(_encode_query(root, use_cache))
+        client_file = client.makefile('rb')
+        try:
+            line = client_file.readline()
+        finally:
+            client_file.close()
+    except socket.error as error:
+        raise DaemonError('The daemon did not answer: %s' % error)
+    finally:
+        client.close()
+    return _parse_answer(line)
+
+
+def _socket_id(socket_path):
+    """Identify the file at ``socket_path``, or return None if there is
+    none.  A restarted daemon creates a new socket, with another id."""
+    try:
+        stat_result = os.stat(socket_path)
+    except OSError:
+        return None
+    return (stat_result.st_dev, stat_result.st_ino,
+            getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime))
+
+
+def _check_socket(socket_path):
+    """Check that a daemon's socket exists and can be trusted.
+
+    Checking first avoids creating a socket when no daemon is running, and
+    connecting again to a socket a stopped daemon left behind (see
+    ``_forget_socket()``).
+
+    Raises:
+        DaemonError: when ``socket_path`` is None or doesn't exist, no
+            daemon listened on it last time, or it or its directory isn't
+            private (see ``check_private()``)."""
+    socket_id = None if socket_path is None else _socket_id(socket_path)
+    if socket_id is None:
+        raise DaemonError('No daemon is listening')
+    if _DEAD_SOCKETS.get(socket_path) == socket_id:
+        raise DaemonError('No daemon is listening on %s' % socket_path)
+    check_private(os.path.dirname(os.path.abspath(socket_path)))
+    check_private(socket_path)
+
+
+def _forget_socket(socket_path, error):
+    """Remember that no daemon listens on ``socket_path`` if connecting to
+    it failed with ``error``, until the socket is replaced."""
+    if getattr(error, 'errno', None) in (errno.ECONNREFUSED, errno.ENOENT):
+        _DEAD_SOCKETS[socket_path] = _socket_id(socket_path)
+
+
+def _encode_query(root, use_cache):
+    """Build the line of JSON that asks for the version of ``root``."""
+    request = json.dumps({'root': os.path.abspath(root),
+                          'use_cache': bool(use_cache)})
+    return request.encode('utf-8') + b'\n'
+
+
+def _parse_answer(line):
+    """Get the version from a daemon's answer.
+
+    Raises:
+        DaemonError: when the answer is malformed or holds an error."""
+    try:
+        response = json.loads(line.decode('utf-8'))
+    except ValueError as error:
+        raise DaemonError('The daemon did not answer: %s' % error)
+    if 'version' not in response:
+        raise DaemonError(response.get('error', 'No version in the answer'))
+    return response['version']
+
+
+def _is_listening(socket_path):
+    """Check whether anything accepts connections on a Unix socket."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(CONNECT_TIMEOUT)
+        client.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+class _Inotify(object):
+    """
+    Watches directories with inotify (Linux only), through ctypes.
+
+    ``callback(repo_roots)`` is called from a background thread with the
+    set of repositories whose watched files changed, or with None if events
+    were lost and every repository should be considered changed.
+    """
+
+    def __init__(self, callback):
+        """Start watching.
+
+        Raises:
+            OSError: when inotify is unavailable."""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+        except (AttributeError, OSError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = init(_IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._add_watch = libc.inotify_add_watch
+        self._callback = callback
+        self._lock = threading.Lock()
+        # Maps a watch descriptor to {repo_root: names}, where names is the
+        # set of file names in the directory that matter to the repository,
+        # or None if every name does.
+        self._watches = {}
+        self._closed = False
+
+        thread = threading.Thread(target=self._run,
+                                  name='natcap-versioner-inotify')
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, repo_root, paths):
+        """
+        Watch the directories holding a repository's state files.
+
+        Files are watched through their directory, since they are usually
+        replaced by renaming a lockfile over them.
+
+        Parameters:
+            repo_root (string): The repository.
+            paths (list): Its state files and directories.
+
+        Returns:
+            True if every path is watched, False otherwise.
+        """
+        watched = True
+        for path in paths:
+            if os.path.isdir(path):
+                directory, name = path, None
+            else:
+                directory, name = os.path.split(path)
+            if isinstance(directory, bytes):
+                directory_bytes = directory
+            else:
+                directory_bytes = directory.encode(
+                    sys.getfilesystemencoding())
+            descriptor = self._add_watch(self._fd, directory_bytes,
+                                         _WATCH_MASK)
+            if descriptor < 0:
+                # e.g. the directory does not exist yet.
+                watched = False
+                continue
+            with self._lock:
+                repos = self._watches.setdefault(descriptor, {})
+                if name is None:
+                    repos[repo_root] = None
+                elif repos.get(repo_root, set()) is not None:
+                    repos.setdefault(repo_root, set()).add(name)
+        return watched
+
+    def _changed(self, descriptor, mask, name):
+        """Find the repositories affected by an event."""
+        with self._lock:
+            if mask & _IN_IGNORED:
+                # The directory is gone, so is its watch.
+                return set(self._watches.pop(descriptor, {}))
+            repos = self._watches.get(descriptor, {})
+            if not name or mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                return set(repos)
+            return set(repo_root for repo_root, names in repos.items()
+                       if names is None or name in names)
+
+    def close(self):
+        """Stop watching (within a second)."""
+        self._closed = True
+
+    def _run(self):
+        """Read events until closed."""
+        try:
+            while not self._closed:
+                self._read_events()
+        except (OSError, select.error) as error:
+            LOGGER.error('inotify failed: %s', error)
+            self._callback(None)
+        finally:
+            os.close(self._fd)
+
+    def _read_events(self):
+        """Wait up to a second for events, and report them."""
+        try:
+            if not select.select([self._fd], [], [], 1.0)[0]:
+                return
+            data = os.read(self._fd, 65536)
+        except (OSError, select.error) as error:
+            if error.args[0] == errno.EINTR:
+                return
+            raise
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = _INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                changed = None
+                break
+            changed.update(self._changed(
+                descriptor, mask,
+                name.decode(sys.getfilesystemencoding(), 'replace')))
+        if changed is None or changed:
+            self._callback(changed)
+
+
+class _Entry(object):
+    """The querier of a repository and its memoized version."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.lock = threading.Lock()
+        self.version = None
+        # Whether inotify watches the state files.  If not, the stat
+        # signature of the state files when version was found.
+        self.watched = False
+        self.signature = None
+        # Incremented whenever the repository changes.
+        self.generation = 0
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answers a single query."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = {'version': self.server.resolve(
+                request['root'], request.get('use_cache', True))}
+        except Exception as error:
+            LOGGER.debug('Could not answer a query: %s', error)
+            response = {'error': '%s: %s' % (type(error).__name__, error)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class VersionServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """
+    Answers version queries over a Unix socket, memoizing the version of
+    every repository it has been asked about.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, use_inotify=True):
+        """Bind the socket.
+
+        Parameters:
+            socket_path=None (string or None): The socket to listen on.  If
+                None, ``default_socket_path()`` is used.
+            use_inotify=True (bool): Whether to watch repositories with
+                inotify where it's available.  If False, state files are
+                stat'ed on every query.
+
+        Raises:
+            DaemonError: when another daemon is listening on the socket, or
+                other users can write to its directory.
+        """
+        if socket_path is None:
+            socket_path = default_socket_path()
+        if socket_path is None:
+            raise DaemonError('Unix sockets are not available')
+        directory = os.path.dirname(os.path.abspath(socket_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # Clients would refuse to connect anyway.
+        check_private(directory)
+        if os.path.exists(socket_path):
+            if _is_listening(socket_path):
+                raise DaemonError('A daemon is listening on %s' % socket_path)
+            # Left behind by a daemon that was killed.
+            os.remove(socket_path)
+
+        self.socket_path = socket_path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify(self.invalidate)
+            except OSError as error:
+                LOGGER.debug('Polling state files: %s', error)
+
+        # Only the user running the daemon may query it.
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def invalidate(self, repo_roots=None):
+        """
+        Forget the memoized versions of repositories.
+
+        Parameters:
+            repo_roots=None (iterable or None): The repository roots.  If
+                None, every repository is forgotten.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            if repo_roots is None:
+                entries = list(self._entries.values())
+            else:
+                entries = [self._entries[repo_root] for repo_root in repo_roots
+                           if repo_root in self._entries]
+            for entry in entries:
+                entry.version = None
+                entry.generation += 1
+
+    def resolve(self, root, use_cache=True):
+        """
+        Find the version of a directory, as ``vcs_version()`` does.
+
+        Parameters:
+            root (string): The directory to version.
+            use_cache=True (bool): Whether to use the on-disk version cache
+                when no version is memoized.
+
+        Returns:
+            The version string.
+
+        Raises:
+            natcap.versioner.VersionNotFound: when ``root`` is not within a
+                known repository.
+
+        Repositories are discovered again on every query (bypassing the
+        memo of ``find_repository()``), since the daemon outlives the
+        repositories created and removed while it runs.
+        """
+        from . import VersionNotFound
+        from .cache import cached_snapshot
+        from .versioning import find_repository
+
+        scm_class, repo_root = find_repository(root, use_cache=False)
+        if scm_class is None:
+            raise VersionNotFound(
+                'A version could not be loaded from scm in %s' % root)
+
+        with self._lock:
+            entry = self._entries.get(repo_root)
+            if entry is None:
+                entry = _Entry(scm_class(repo_root))
+                self._entries[repo_root] = entry
+
+        # Queriers aren't thread-safe.
+        with entry.lock:
+            repo = entry.repo
+            version = entry.version
+            if version is not None and (
+                    entry.watched or
+                    entry.signature == repo._state_signature()):
+                return version
+
+            generation = entry.generation
+            paths = repo._state_paths()
+            watched = bool(self._inotify is not None and paths and
+                           self._inotify.watch(repo_root, paths))
+            # Taken before the version is found, so that a change made
+            # meanwhile is noticed by the next query.
+            signature = None if watched else repo._state_signature()
+            if use_cache:
+                snapshot = cached_snapshot(repo)
+            else:
+                snapshot = repo.snapshot()
+            version = snapshot.pep440(branch=False)
+            with self._lock:
+                # Only memoize versions of repositories with a signature
+                # (or watched), and that didn't change meanwhile.
+                if (entry.generation == generation and
+                        (watched or signature is not None)):
+                    entry.version = version
+                    entry.watched = watched
+                    entry.signature = signature
+            return version
+
+    def server_close(self):
+        """Close and remove the socket, and stop watching repositories."""
+        if self._inotify is not None:
+            self._inotify.close()
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
@@ -0,0 +1,435 @@
+"""
+Pluggable executors for the commands run by version queriers.
+
+Every ``git`` and ``hg`` command run by a ``VCSQuerier`` goes through an
+executor.  The default ``SubprocessExecutor`` spawns the program directly
+from an argument list (no ``/bin/sh``), stops it after a timeout, and runs
+it with a hardened environment: optional git locks are disabled, mercurial
+runs with ``HGPLAIN`` and no pager or terminal prompt is ever started.
+
+``RecordingExecutor`` and ``ReplayExecutor`` save and play back command
+transcripts, so that tests and benchmarks can run without git or mercurial.
+
+``ReadDeadline`` stops long-running processes (``git cat-file --batch``, the
+mercurial command server, streamed logs) that stop answering.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import profiling
+
+LOGGER = logging.getLogger('natcap.versioner.executors')
+LOGGER.setLevel(logging.ERROR)
+
+# The default number of seconds a single command may run for.
+DEFAULT_TIMEOUT = 60.0
+
+# Environment variables set for every command run by SubprocessExecutor.
+HARDENED_ENVIRONMENT = {
+    # Don't take index.lock for `git status`-style refreshes, so we never
+    # block (or are blocked by) a concurrent git process.
+    'GIT_OPTIONAL_LOCKS': '0',
+    # Fail rather than prompt for credentials.
+    'GIT_TERMINAL_PROMPT': '0',
+    'GIT_PAGER': 'cat',
+    'PAGER': 'cat',
+    # Ignore user configuration that changes mercurial's output.
+    'HGPLAIN': '1',
+    'HGENCODING': 'UTF-8',
+}
+
+
+class CommandTimeout(RuntimeError):
+    """
+    Raised when a command does not finish within its timeout.
+    """
+    pass
+
+
+class ReplayError(LookupError):
+    """
+    Raised when a ReplayExecutor has no recording of a command.
+    """
+    pass
+
+
+def hardened_environment(environ=None):
+    """
+    Build the environment that commands are run with.
+
+    Parameters:
+        environ=None (dict or None): The environment to start from.  If
+            None, ``os.environ`` is used.
+
+    Returns:
+        A new dict of environment variables.
+    """
+    if environ is None:
+        environ = os.environ
+    env = dict(environ)
+    env.update(HARDENED_ENVIRONMENT)
+    return env
+
+
+class CommandExecutor(object):
+    """
+    The interface for running a VCS command.
+
+    Subclasses must implement ``run()``.
+    """
+
+    def run(self, args, cwd=None, timeout=None):
+        """
+        Run a command.
+
+        Parameters:
+            args (list): The program and its arguments.
+            cwd=None (string or None): The working directory for the
+                command.  If None, the current directory is used.
+            timeout=None (float or None): The number of seconds the command
+                may run for.  If None, there is no limit.
+
+        Returns:
+            The command's combined stdout and stderr, decoded and stripped
+            of leading and trailing whitespace.
+
+        Raises:
+            subprocess.CalledProcessError: when the command exits nonzero.
+            CommandTimeout: when the command runs past ``timeout``.
+        """
+        raise NotImplementedError
+
+    def stream(self, args, cwd=None, timeout=None):
+        """
+        Run a command and yield the lines of its output.
+
+        This implementation splits the complete output of ``run()``, so
+        executors that record or replay commands stream them as well.
+
+        Parameters:
+            args (list): The program and its arguments.
+            cwd=None (string or None): The working directory for the
+                command.  If None, the current directory is used.
+            timeout=None (float or None): The number of seconds the command
+                may go without writing a line.  If None, there is no limit.
+
+        Returns:
+            A generator of decoded lines, without line endings.
+
+        Raises:
+            subprocess.CalledProcessError: when the command exits nonzero.
+            CommandTimeout: when the command stops writing for ``timeout``.
+        """
+        for line in self.run(args, cwd=cwd, timeout=timeout).splitlines():
+            yield line
+
+
+class ReadDeadline(object):
+    """
+    Kill a process when a single read of its output takes too long.
+
+    Each read is wrapped in ``with deadline:``.  A watchdog thread, started
+    on the first read, kills the process once a read has been waiting for
+    ``timeout`` seconds, which makes the blocked read return.  Time spent
+    between reads (while the caller handles the output) doesn't count.
+    """
+
+    def __init__(self, process, timeout):
+        """
+        Parameters:
+            process (subprocess.Popen): The process being read from.
+            timeout (float or None): The number of seconds a read may wait.
+                If None, reads may wait forever.
+        """
+        self.process = process
+        self.timeout = timeout
+        self.timed_out = False
+        self._condition = threading.Condition()
+        self._read_started = None
+        self._stopped = False
+        self._thread = None
+
+    def __enter__(self):
+        if self.timeout is None:
+            return self
+        with self._condition:
+            self._read_started = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timeout is not None:
+            with self._condition:
+                self._read_started = None
+
+    def _watch(self):
+        with self._condition:
+            while not self._stopped:
+                if self._read_started is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._read_started + self.timeout - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self.timed_out = True
+                try:
+                    self.process.kill()
+                except OSError:
+                    # Already exited.
+                    pass
+                return
+
+    def stop(self):
+        """Stop the watchdog thread, if it was started."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+class SubprocessExecutor(CommandExecutor):
+    """
+    Run commands as child processes, without a shell.
+    """
+
+    def __init__(self, environ=None):
+        """
+        Parameters:
+            environ=None (dict or None): The environment to harden and run
+                commands with.  If None, ``os.environ`` (as of each call) is
+                used.
+        """
+        self.environ = environ
+
+    def run(self, args, cwd=None, timeout=None):
+        with profiling.stage(profiling.STAGE_SUBPROCESS, args[0]):
+            return self._run(args, cwd, timeout)
+
+    def _run(self, args, cwd, timeout):
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, cwd=cwd,
+            env=hardened_environment(self.environ))
+
+        # A timer thread rather than communicate(timeout=...) so timeouts
+        # work under python 2 as well.
+        timed_out = []
+        timer = None
+        if timeout is not None:
+            def _kill():
+                timed_out.append(True)
+                try:
+                    process.kill()
+                except OSError:
+                    # Already exited.
+                    pass
+            timer = threading.Timer(timeout, _kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            output, _ = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if timed_out:
+            raise CommandTimeout('Command %r timed out after %s seconds' % (
+                ' '.join(args), timeout))
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, args, output)
+        return output.strip().decode('utf-8')
+
+    def stream(self, args, cwd=None, timeout=None):
+        """
+        Run a command and yield the lines of its output as they are written.
+
+        Stderr goes to a temporary file rather than a pipe, which nothing
+        would read until stdout is done: a command filling that pipe would
+        block forever.  The process is killed if the generator is closed
+        early.  See ``CommandExecutor.stream()``.
+        """
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=errors, cwd=cwd, env=hardened_environment(self.environ))
+        process.stdin.close()
+        deadline = ReadDeadline(process, timeout)
+        try:
+            while True:
+                with deadline:
+                    line = process.stdout.readline()
+                if not line:
+                    break
+                yield line.rstrip(b'\r\n').decode('utf-8')
+            process.wait()
+            if deadline.timed_out:
+                raise CommandTimeout(
+                    'Command %r wrote nothing for %s seconds' % (
+                        ' '.join(args), timeout))
+            if process.returncode != 0:
+                errors.seek(0)
+                raise subprocess.CalledProcessError(
+                    process.returncode, args, errors.read())
+        finally:
+            deadline.stop()
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            errors.close()
+
+
+class RecordingExecutor(CommandExecutor):
+    """
+    Run commands through another executor and record a transcript of them.
+    """
+
+    def __init__(self, executor=None):
+        """
+        Parameters:
+            executor=None (CommandExecutor or None): The executor that
+                actually runs the commands.  If None, a new
+                SubprocessExecutor is used.
+        """
+        if executor is None:
+            executor = SubprocessExecutor()
+        self.executor = executor
+        self.transcript = []
+        self._lock = threading.Lock()
+
+    def run(self, args, cwd=None, timeout=None):
+        try:
+            output = self.executor.run(args, cwd=cwd, timeout=timeout)
+            returncode = 0
+        except subprocess.CalledProcessError as error:
+            output = error.output
+            if isinstance(output, bytes):
+                output = output.strip().decode('utf-8', 'replace')
+            returncode = error.returncode
+            self._record(args, returncode, output)
+            raise
+        self._record(args, returncode, output)
+        return output
+
+    def _record(self, args, returncode, output):
+        with self._lock:
+            self.transcript.append({
+                'args': list(args),
+                'returncode': returncode,
+                'output': output,
+            })
+
+    def save(self, path):
+        """
+        Write the transcript to a JSON file.
+
+        Parameters:
+            path (string): The file to write.
+
+        Returns:
+            None.
+        """
+        with open(path, 'w') as transcript_file:
+            json.dump(self.transcript, transcript_file, indent=1,
+                      sort_keys=True)
+
+
+def load_transcript(path):
+    """
+    Load a transcript written by ``RecordingExecutor.save()``.
+
+    Parameters:
+        path (string): The transcript file.
+
+    Returns:
+        A list of transcript entries.
+    """
+    with open(path) as transcript_file:
+        return json.load(transcript_file)
+
+
+class ReplayExecutor(CommandExecutor):
+    """
+    Answer commands from a recorded transcript instead of running them.
+
+    Commands are matched by their arguments only (not their working
+    directory), so a transcript recorded in one checkout can be replayed in
+    another.  When a command was recorded more than once, the recordings
+    are replayed in order and the last one is repeated.
+    """
+
+    def __init__(self, transcript):
+        """
+        Parameters:
+            transcript (list or string): Transcript entries, as in
+                ``RecordingExecutor.transcript``, or the path to a
+                transcript file.
+        """
+        if not isinstance(transcript, list):
+            transcript = load_transcript(transcript)
+        self._recordings = {}
+        for entry in transcript:
+            self._recordings.setdefault(
+                tuple(entry['args']), []).append(entry)
+        self.replayed = []
+        self._lock = threading.Lock()
+
+    def run(self, args, cwd=None, timeout=None):
+        key = tuple(args)
+        with self._lock:
+            recordings = self._recordings.get(key)
+            if not recordings:
+                raise ReplayError('No recording of command %r' % ' '.join(args))
+            entry = recordings[0]
+            if len(recordings) > 1:
+                recordings.pop(0)
+            self.replayed.append(list(args))
+
+        if entry['returncode'] != 0:
+            raise subprocess.CalledProcessError(
+                entry['returncode'], list(args),
+                entry['output'].encode('utf-8'))
+        return entry['output']
+
+
+_DEFAULT_EXECUTOR = SubprocessExecutor()
+
+
+def get_default_executor():
+    """
+    Get the executor used by queriers that weren't given one.
+
+    Returns:
+        A CommandExecutor instance.
+    """
+    return _DEFAULT_EXECUTOR
+
+
+def set_default_executor(executor):
+    """
+    Set the executor used by queriers that weren't given one.
+
+    Parameters:
+        executor (CommandExecutor or None): The new default executor.  If
+            None, a SubprocessExecutor is restored.
+
+    Returns:
+        The previous default executor.
+    """
+    global _DEFAULT_EXECUTOR
+    previous = _DEFAULT_EXECUTOR
+    if executor is None:
+        executor = SubprocessExecutor()
+    _DEFAULT_EXECUTOR = executor
+    return previous
@@ -0,0 +1,205 @@
+"""
+A client for ``git cat-file --batch``.
+
+A single ``git cat-file --batch`` process reads object names from stdin and
+writes each object back, so any number of objects can be read for the cost
+of one process.  ``BatchReader`` reads the objects of a ``GitReader``
+through it, so every object format git supports can be read.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import subprocess
+import threading
+
+from . import executors
+from . import gitreader
+
+LOGGER = logging.getLogger('natcap.versioner.gitbatch')
+LOGGER.setLevel(logging.ERROR)
+
+_TYPES = {
+    b'commit': gitreader.OBJ_COMMIT,
+    b'tree': gitreader.OBJ_TREE,
+    b'blob': gitreader.OBJ_BLOB,
+    b'tag': gitreader.OBJ_TAG,
+}
+
+
+class CatFileError(RuntimeError):
+    """
+    Raised when the cat-file process cannot be started or stops responding.
+    """
+    pass
+
+
+class CatFile(object):
+    """
+    A running ``git cat-file --batch`` process for one repository.
+
+    Instances are also context managers; the process is shut down on exit.
+    """
+
+    def __init__(self, repo_path, git_executable='git',
+                 timeout=executors.DEFAULT_TIMEOUT):
+        """
+        Start the process.
+
+        Parameters:
+            repo_path (string): The path to the repository root.
+            git_executable='git' (string): The git executable to run.
+            timeout=executors.DEFAULT_TIMEOUT (float or None): The number
+                of seconds to wait for an answer before the process is
+                killed.  If None, wait forever.
+
+        Raises:
+            CatFileError: when the process can't be started.
+        """
+        self.repo_path = repo_path
+        self._lock = threading.Lock()
+        self._process = None
+        self._deadline = None
+        # Nothing reads stderr, so it mustn't be a pipe that could fill up.
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                self._process = subprocess.Popen(
+                    [git_executable, 'cat-file', '--batch'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, cwd=repo_path,
+                    env=executors.hardened_environment())
+            except OSError as error:
+                raise CatFileError('Could not start git cat-file: %s' % error)
+        self._deadline = executors.ReadDeadline(self._process, timeout)
+
+    @property
+    def running(self):
+        """Whether the process is still alive."""
+        return self._process is not None and self._process.poll() is None
+
+    def _closed_error(self):
+        if self._deadline.timed_out:
+            return CatFileError('git cat-file stopped responding after %s '
+                                'seconds' % self._deadline.timeout)
+        return CatFileError('git cat-file closed its output')
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            with self._deadline:
+                chunk = self._process.stdout.read(size - len(data))
+            if not chunk:
+                raise self._closed_error()
+            data += chunk
+        return data
+
+    def read(self, name):
+        """
+        Read an object.
+
+        Parameters:
+            name (string): The object id, or any revision name git
+                understands (e.g. an abbreviated id or a tag name).
+
+        Returns:
+            A tuple of ``(sha, type, data)``, where ``sha`` is the full hex
+            object id, ``type`` is one of the ``gitreader.OBJ_*`` constants
+            and ``data`` is a bytearray.  None if there is no such object.
+
+        Raises:
+            CatFileError: when the process has exited or stops answering.
+        """
+        if not name or '\n' in name:
+            return None
+        with self._lock:
+            if not self.running:
+                raise CatFileError('git cat-file is not running')
+            try:
+                self._process.stdin.write(name.encode('utf-8') + b'\n')
+                self._process.stdin.flush()
+            except (IOError, OSError) as error:
+                raise CatFileError('Could not write to git cat-file: %s' %
+                                   error)
+            with self._deadline:
+                header = self._process.stdout.readline()
+            if not header:
+                raise self._closed_error()
+            fields = header.split()
+            if len(fields) != 3:
+                # '<name> missing' or '<name> ambiguous'
+                return None
+            sha, type_name, size = fields
+            data = self._read_exactly(int(size) + 1)[:-1]
+        return sha.decode('ascii'), _TYPES[type_name], bytearray(data)
+
+    def close(self):
+        """Shut down the process.  Safe to call more than once."""
+        process = self._process
+        self._process = None
+        if process is None:
+            return
+        self._deadline.stop()
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            process.wait()
+        finally:
+            process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Interpreter shutdown may have torn down what close() needs.
+            pass
+
+
+class BatchReader(gitreader.GitReader):
+    """
+    A GitReader whose objects are read through ``git cat-file --batch``.
+
+    Refs and the commit-graph are still read from disk.
+    """
+
+    def __init__(self, git_dir, cat_file):
+        """
+        Parameters:
+            git_dir (string): The repository's git directory.
+            cat_file (CatFile): The process to read objects through.
+        """
+        gitreader.GitReader.__init__(self, git_dir)
+        self.cat_file = cat_file
+
+    def read_object(self, sha):
+        result = self.cat_file.read(sha)
+        if result is None:
+            raise gitreader.UnsupportedRepository('Object not found: %s' % sha)
+        return result[1:]
+
+    def resolve(self, name):
+        """
+        Find the commit a name refers to, peeling annotated tags.
+
+        Unlike ``GitReader.resolve()``, any revision name git understands
+        is resolved, by git.
+
+        Returns:
+            The full hex sha of the commit, or None if ``name`` is not a
+            commit of the repository.
+        """
+        result = self.cat_file.read(name)
+        if result is None:
+            return None
+        sha, obj_type, _ = result
+        if obj_type == gitreader.OBJ_TAG:
+            sha, obj_type, _ = self.peel(sha)
+        if obj_type != gitreader.OBJ_COMMIT:
+            return None
+        return sha
@@ -0,0 +1,971 @@
+"""
+Read git repository data directly from disk, without calling ``git``.
+
+Only the subset of the on-disk format needed for versioning is understood:
+``HEAD``, loose refs, ``packed-refs``, loose objects, version 2 pack
+indexes with their packfiles (including both delta encodings) and
+commit-graph files (see ``natcap.versioner.commitgraph``).  Tags are
+looked up through ``natcap.versioner.tagindex``.  Anything
+else (sha256 repositories, shallow clones, reftables, replace refs, ...)
+raises ``UnsupportedRepository`` so that callers can fall back to the
+``git`` command-line interface.
+"""
+from __future__ import absolute_import
+import binascii
+import heapq
+import io
+import itertools
+import logging
+import os
+import string
+import struct
+import zlib
+
+from . import commitgraph
+from . import pep440
+from . import tagindex
+
+LOGGER = logging.getLogger('natcap.versioner.gitreader')
+LOGGER.setLevel(logging.ERROR)
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+_TYPE_NAMES = {
+    b'commit': OBJ_COMMIT,
+    b'tree': OBJ_TREE,
+    b'blob': OBJ_BLOB,
+    b'tag': OBJ_TAG,
+}
+
+# The number of tag candidates considered, same as ``git describe``.
+MAX_CANDIDATES = 10
+
+# Where ref names are looked up, in order, as in git.
+_REF_RULES = ['%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+              'refs/remotes/%s', 'refs/remotes/%s/HEAD']
+
+# Bounds of the abbreviated object ids, as in git.
+MINIMUM_ABBREV = 4
+DEFAULT_ABBREV = 7
+
+
+class UnsupportedRepository(Exception):
+    """
+    Raised when the repository uses a feature this reader cannot handle.
+    """
+    pass
+
+
+def find_git_dir(repo_root):
+    """
+    Locate the git directory for a working tree.
+
+    ``.git`` may either be a directory or, for worktrees and submodules, a
+    file containing a ``gitdir: <path>`` pointer.
+
+    Parameters:
+        repo_root (string): The path to the root of the working tree.
+
+    Returns:
+        The absolute path to the git directory.
+
+    Raises:
+        UnsupportedRepository: when ``.git`` cannot be interpreted.
+    """
+    dot_git = os.path.join(repo_root, '.git')
+    if os.path.isdir(dot_git):
+        return os.path.abspath(dot_git)
+
+    try:
+        with open(dot_git) as dot_git_file:
+            contents = dot_git_file.read().strip()
+    except (IOError, OSError):
+        raise UnsupportedRepository('Cannot read %s' % dot_git)
+
+    if not contents.startswith('gitdir:'):
+        raise UnsupportedRepository('Unrecognized .git file: %s' % dot_git)
+    git_dir = contents[len('gitdir:'):].strip()
+    if not os.path.isabs(git_dir):
+        git_dir = os.path.join(repo_root, git_dir)
+    return os.path.abspath(git_dir)
+
+
+def find_common_dir(git_dir):
+    """
+    Locate the directory holding shared refs and objects.
+
+    Linked worktrees keep ``HEAD`` in their own git directory and everything
+    else in the main repository's git directory, named by ``commondir``.
+
+    Parameters:
+        git_dir (string): The path to a git directory.
+
+    Returns:
+        The absolute path to the common git directory.
+    """
+    commondir_path = os.path.join(git_dir, 'commondir')
+    if not os.path.exists(commondir_path):
+        return git_dir
+
+    with open(commondir_path) as commondir_file:
+        common_dir = commondir_file.read().strip()
+    if not os.path.isabs(common_dir):
+        common_dir = os.path.join(git_dir, common_dir)
+    return os.path.abspath(common_dir)
+
+
+def _read_varint(data, pos):
+    """Read a little-endian base-128 integer as used in delta headers."""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def _apply_delta(base, delta):
+    """
+    Reconstruct an object from its delta base.
+
+    Parameters:
+        base (bytearray): The fully-resolved base object.
+        delta (bytearray): The delta instructions.
+
+    Returns:
+        A bytearray of the reconstructed object.
+    """
+    pos = 0
+    source_size, pos = _read_varint(delta, pos)
+    target_size, pos = _read_varint(delta, pos)
+    if source_size != len(base):
+        raise UnsupportedRepository('Delta base size mismatch')
+
+    result = bytearray()
+    delta_len = len(delta)
+    while pos < delta_len:
+        opcode = delta[pos]
+        pos += 1
+        if opcode & 0x80:
+            # Copy a range out of the base object.
+            offset = 0
+            size = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            result += base[offset:offset + size]
+        elif opcode:
+            # Insert literal data from the delta itself.
+            result += delta[pos:pos + opcode]
+            pos += opcode
+        else:
+            raise UnsupportedRepository('Reserved delta opcode')
+
+    if len(result) != target_size:
+        raise UnsupportedRepository('Delta result size mismatch')
+    return result
+
+
+def _common_prefix(first, second):
+    """Count the leading characters two strings have in common."""
+    length = 0
+    for first_char, second_char in zip(first, second):
+        if first_char != second_char:
+            break
+        length += 1
+    return length
+
+
+class _Pack(object):
+    """A single packfile and its version 2 index."""
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        with open(idx_path, 'rb') as idx_file:
+            index = idx_file.read()
+
+        if index[:4] != b'\xfftOc':
+            raise UnsupportedRepository(
+                'Version 1 pack index not supported: %s' % idx_path)
+        version = struct.unpack('>I', index[4:8])[0]
+        if version != 2:
+            raise UnsupportedRepository(
+                'Pack index version %s not supported' % version)
+
+        self._fanout = struct.unpack('>256I', index[8:8 + 1024])
+        self.num_objects = self._fanout[255]
+        self._sha_start = 8 + 1024
+        self._offset_start = self._sha_start + 24 * self.num_objects
+        self._large_offset_start = self._offset_start + 4 * self.num_objects
+        self._index = index
+
+    def _sha_at(self, position):
+        start = self._sha_start + 20 * position
+        return self._index[start:start + 20]
+
+    def find(self, binsha):
+        """
+        Find the offset of an object within the packfile.
+
+        Parameters:
+            binsha (bytes): The 20-byte binary object id.
+
+        Returns:
+            The integer offset into the packfile, or None if the object is
+            not in this pack.
+        """
+        first_byte = bytearray(binsha[:1])[0]
+        low = self._fanout[first_byte - 1] if first_byte else 0
+        high = self._fanout[first_byte]
+        while low < high:
+            middle = (low + high) // 2
+            middle_sha = self._sha_at(middle)
+            if middle_sha < binsha:
+                low = middle + 1
+            elif middle_sha > binsha:
+                high = middle
+            else:
+                return self._offset_at(middle)
+        return None
+
+    def neighbor_prefix(self, binsha):
+        """
+        Find how many leading hex digits an object id shares with its
+        nearest other object in this pack.
+
+        Parameters:
+            binsha (bytes): The 20-byte binary object id.
+
+        Returns:
+            The length of the longest common hex prefix.
+        """
+        low, high = 0, self.num_objects
+        while low < high:
+            middle = (low + high) // 2
+            if self._sha_at(middle) < binsha:
+                low = middle + 1
+            else:
+                high = middle
+        neighbors = [low - 1, low]
+        if low < self.num_objects and self._sha_at(low) == binsha:
+            neighbors[1] = low + 1
+        hexsha = binascii.hexlify(binsha)
+        longest = 0
+        for position in neighbors:
+            if 0 <= position < self.num_objects:
+                longest = max(longest, _common_prefix(
+                    hexsha, binascii.hexlify(self._sha_at(position))))
+        return longest
+
+    def _offset_at(self, position):
+        start = self._offset_start + 4 * position
+        offset = struct.unpack('>I', self._index[start:start + 4])[0]
+        if offset & 0x80000000:
+            large_start = (self._large_offset_start +
+                           8 * (offset & 0x7fffffff))
+            offset = struct.unpack(
+                '>Q', self._index[large_start:large_start + 8])[0]
+        return offset
+
+    def read_raw(self, offset):
+        """
+        Read the (possibly deltified) entry at ``offset``.
+
+        Returns:
+            A tuple of ``(type, data, base)``, where ``base`` is the base
+            offset for an ofs-delta, the binary base sha for a ref-delta, or
+            None for a whole object.
+        """
+        with open(self.pack_path, 'rb') as pack_file:
+            pack_file.seek(offset)
+            header = bytearray(pack_file.read(32))
+            pos = 0
+            byte = header[pos]
+            pos += 1
+            obj_type = (byte >> 4) & 0x07
+            size = byte & 0x0f
+            shift = 4
+            while byte & 0x80:
+                byte = header[pos]
+                pos += 1
+                size |= (byte & 0x7f) << shift
+                shift += 7
+
+            base = None
+            if obj_type == OBJ_OFS_DELTA:
+                byte = header[pos]
+                pos += 1
+                base_distance = byte & 0x7f
+                while byte & 0x80:
+                    byte = header[pos]
+                    pos += 1
+                    base_distance = ((base_distance + 1) << 7) | (byte & 0x7f)
+                base = offset - base_distance
+            elif obj_type == OBJ_REF_DELTA:
+                base = bytes(header[pos:pos + 20])
+                pos += 20
+
+            pack_file.seek(offset + pos)
+            decompressor = zlib.decompressobj()
+            data = io.BytesIO()
+            while data.tell() < size:
+                chunk = pack_file.read(4096)
+                if not chunk:
+                    break
+                data.write(decompressor.decompress(chunk))
+            data.write(decompressor.flush())
+
+        return obj_type, bytearray(data.getvalue()[:size]), base
+
+
+class GitReader(object):
+    """
+    Resolve refs and objects of a git repository without spawning ``git``.
+
+    Commit objects are immutable, so parsed commits are cached for the
+    lifetime of the reader.  Refs and ``HEAD`` are re-read on every call.
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.common_dir = find_common_dir(git_dir)
+        self.objects_dir = os.path.join(self.common_dir, 'objects')
+
+        self._packs = {}
+        self._commits = {}
+        self._objects_supported = False
+        self._graph = None
+        self._graph_loaded = False
+        # describe_many() results, valid while the tags are unchanged.
+        self._described = {}
+        self._described_fingerprint = None
+
+        if self._config_value('refstorage', 'files') != 'files':
+            raise UnsupportedRepository('Ref storage not supported')
+
+    def _config_value(self, key, default):
+        """Find the (lowercased) value of a key in the repository config.
+
+        Sections are ignored, which is good enough for the few
+        ``extensions`` keys we need to check."""
+        config_path = os.path.join(self.common_dir, 'config')
+        if not os.path.exists(config_path):
+            return default
+        with open(config_path) as config_file:
+            for line in config_file:
+                line = line.strip().lower().replace(' ', '')
+                if line.startswith(key + '='):
+                    return line[len(key) + 1:]
+        return default
+
+    def _check_objects_supported(self):
+        """Raise UnsupportedRepository if history can't be read faithfully.
+
+        Only needed before reading objects; refs can still be resolved."""
+        if self._objects_supported:
+            return
+        if self._config_value('objectformat', 'sha1') != 'sha1':
+            raise UnsupportedRepository('Object format not supported')
+        for unsupported in ('shallow', os.path.join('info', 'grafts'),
+                            os.path.join('objects', 'info', 'alternates'),
+                            os.path.join('refs', 'replace')):
+            if os.path.exists(os.path.join(self.common_dir, unsupported)):
+                raise UnsupportedRepository(
+                    'Repository feature not supported: %s' % unsupported)
+        self._objects_supported = True
+
+    # ------------------------------------------------------------------
+    # Refs
+    # ------------------------------------------------------------------
+    def read_head(self):
+        """
+        Read ``HEAD``.
+
+        Returns:
+            A tuple of ``(refname, sha)``.  ``refname`` is None when HEAD is
+            detached.  ``sha`` is None when HEAD points to an unborn branch.
+        """
+        with open(os.path.join(self.git_dir, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+
+        if head.startswith('ref:'):
+            refname = head[len('ref:'):].strip()
+            return refname, self.resolve_ref(refname)
+        return None, head
+
+    def _packed_refs(self):
+        """
+        Parse ``packed-refs``.
+
+        Returns:
+            A dict mapping refname to ``(sha, peeled_sha)``.  ``peeled_sha``
+            is None when the file did not record a peeled value.
+        """
+        refs = {}
+        packed_refs_path = os.path.join(self.common_dir, 'packed-refs')
+        if not os.path.exists(packed_refs_path):
+            return refs
+
+        last_ref = None
+        with open(packed_refs_path) as packed_refs_file:
+            for line in packed_refs_file:
+                line = line.rstrip('\n')
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('^'):
+                    refs[last_ref] = (refs[last_ref][0], line[1:])
+                    continue
+                sha, last_ref = line.split(' ', 1)
+                refs[last_ref] = (sha, None)
+        return refs
+
+    def resolve_ref(self, refname, _depth=0):
+        """
+        Resolve a refname to an object id.
+
+        Parameters:
+            refname (string): A full refname, e.g. ``refs/heads/master``.
+
+        Returns:
+            The hex sha the ref points to, or None if the ref does not exist.
+        """
+        if _depth > 5:
+            raise UnsupportedRepository('Symbolic ref loop at %s' % refname)
+
+        for base_dir in (self.git_dir, self.common_dir):
+            loose_path = os.path.join(base_dir, *refname.split('/'))
+            if os.path.isfile(loose_path):
+                with open(loose_path) as ref_file:
+                    value = ref_file.read().strip()
+                if value.startswith('ref:'):
+                    return self.resolve_ref(value[len('ref:'):].strip(),
+                                            _depth + 1)
+                return value
+
+        packed = self._packed_refs().get(refname)
+        if packed is not None:
+            return packed[0]
+        return None
+
+    def tag_refs(self):
+        """
+        List every tag ref.
+
+        Returns:
+            A dict mapping tag name (without ``refs/tags/``) to a tuple of
+            ``(sha, peeled_sha)``.  ``peeled_sha`` may be None.
+        """
+        tags = {}
+        for refname, value in self._packed_refs().items():
+            if refname.startswith('refs/tags/'):
+                tags[refname[len('refs/tags/'):]] = value
+
+        tags_dir = os.path.join(self.common_dir, 'refs', 'tags')
+        for dirpath, _, filenames in os.walk(tags_dir):
+            for filename in filenames:
+                loose_path = os.path.join(dirpath, filename)
+                tag_name = os.path.relpath(loose_path, tags_dir).replace(
+                    os.sep, '/')
+                with open(loose_path) as ref_file:
+                    tags[tag_name] = (ref_file.read().strip(), None)
+        return tags
+
+    # ------------------------------------------------------------------
+    # Objects
+    # ------------------------------------------------------------------
+    def _iter_packs(self, rescan=False):
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        if rescan or not self._packs:
+            try:
+                filenames = os.listdir(pack_dir)
+            except OSError:
+                filenames = []
+            for filename in sorted(filenames):
+                if filename.endswith('.idx') and filename not in self._packs:
+                    self._packs[filename] = _Pack(
+                        os.path.join(pack_dir, filename))
+        return list(self._packs.values())
+
+    def abbreviate(self, sha):
+        """
+        Abbreviate an object id as git does.
+
+        With ``core.abbrev`` unset (or ``auto``), the length grows with the
+        number of packed objects (but is at least 7); it may also be set to
+        a number of digits or to ``no`` for full ids.  The abbreviation is
+        then extended until no other object shares it.
+
+        Parameters:
+            sha (string): The full hex object id.
+
+        Returns:
+            The abbreviated hex object id.
+        """
+        setting = self._config_value('abbrev', 'auto')
+        if setting in ('no', 'false', 'off'):
+            return sha
+        try:
+            length = max(MINIMUM_ABBREV, int(setting))
+        except ValueError:
+            count = sum(pack.num_objects for pack in self._iter_packs())
+            length = max(DEFAULT_ABBREV, (count.bit_length() + 1) // 2)
+        if length >= len(sha):
+            return sha
+
+        binsha = binascii.unhexlify(sha)
+        for pack in self._iter_packs():
+            length = max(length, pack.neighbor_prefix(binsha) + 1)
+        try:
+            loose = os.listdir(os.path.join(self.objects_dir, sha[:2]))
+        except OSError:
+            loose = []
+        for name in loose:
+            if name != sha[2:]:
+                length = max(length, 2 + _common_prefix(sha[2:], name) + 1)
+        return sha[:length]
+
+    def _find_in_packs(self, binsha):
+        for rescan in (False, True):
+            for pack in self._iter_packs(rescan=rescan):
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return pack, offset
+        return None, None
+
+    def _read_packed(self, pack, offset):
+        obj_type, data, base = pack.read_raw(offset)
+        if obj_type == OBJ_OFS_DELTA:
+            base_type, base_data = self._read_packed(pack, base)
+            return base_type, _apply_delta(base_data, data)
+        if obj_type == OBJ_REF_DELTA:
+            base_type, base_data = self.read_object(
+                binascii.hexlify(base).decode('ascii'))
+            return base_type, _apply_delta(base_data, data)
+        return obj_type, data
+
+    def read_object(self, sha):
+        """
+        Read an object from the object database.
+
+        Parameters:
+            sha (string): The hex object id.
+
+        Returns:
+            A tuple of ``(type, data)`` where ``type`` is one of the
+            ``OBJ_*`` constants and ``data`` is a bytearray.
+
+        Raises:
+            UnsupportedRepository: when the object cannot be found.
+        """
+        self._check_objects_supported()
+        loose_path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        if os.path.exists(loose_path):
+            with open(loose_path, 'rb') as loose_file:
+                raw = zlib.decompress(loose_file.read())
+            header, _, body = raw.partition(b'\x00')
+            type_name = header.split(b' ')[0]
+            return _TYPE_NAMES[type_name], bytearray(body)
+
+        pack, offset = self._find_in_packs(binascii.unhexlify(sha))
+        if pack is None:
+            raise UnsupportedRepository('Object not found: %s' % sha)
+        return self._read_packed(pack, offset)
+
+    @staticmethod
+    def _parse_headers(data):
+        """Parse the header lines of a commit or tag object."""
+        headers = []
+        for line in bytes(data).split(b'\n'):
+            if not line:
+                break
+            if line.startswith(b' '):
+                # Continuation of a multi-line header (e.g. gpgsig).
+                continue
+            key, _, value = line.partition(b' ')
+            headers.append((key.decode('ascii'), value))
+        return headers
+
+    @staticmethod
+    def _parse_timestamp(ident):
+        """Extract the unix timestamp from an author/committer line."""
+        try:
+            return int(ident.rsplit(b' ', 2)[-2])
+        except (IndexError, ValueError):
+            return 0
+
+    def commit_graph(self):
+        """
+        Get the repository's commit-graph.
+
+        Returns:
+            A ``commitgraph.CommitGraph`` instance, or None if the
+            repository has no (usable) commit-graph.
+        """
+        if not self._graph_loaded:
+            self._check_objects_supported()
+            try:
+                self._graph = commitgraph.load(self.objects_dir)
+            except commitgraph.CommitGraphError as error:
+                LOGGER.debug('Ignoring commit-graph: %s', error)
+                self._graph = None
+            self._graph_loaded = True
+        return self._graph
+
+    def commit(self, sha):
+        """
+        Parse a commit object.
+
+        Commits in the commit-graph are read from it rather than from the
+        object database.
+
+        Returns:
+            A tuple of ``(parents, commit_time)``.
+        """
+        try:
+            return self._commits[sha]
+        except KeyError:
+            pass
+
+        graph = self.commit_graph()
+        position = None if graph is None else graph.position(sha)
+        if position is not None:
+            result = (tuple(graph.sha(parent)
+                            for parent in graph.parents(position)),
+                      int(graph.commit_time[position]))
+            self._commits[sha] = result
+            return result
+
+        obj_type, data = self.read_object(sha)
+        if obj_type != OBJ_COMMIT:
+            raise UnsupportedRepository('%s is not a commit' % sha)
+
+        parents = []
+        commit_time = 0
+        for key, value in self._parse_headers(data):
+            if key == 'parent':
+                parents.append(value.decode('ascii'))
+            elif key == 'committer':
+                commit_time = self._parse_timestamp(value)
+        result = (tuple(parents), commit_time)
+        self._commits[sha] = result
+        return result
+
+    def peel(self, sha):
+        """
+        Follow annotated tags until a non-tag object is reached.
+
+        Returns:
+            A tuple of ``(sha, type, tagger_time)``.  ``tagger_time`` is the
+            time of the outermost annotated tag, or None for a lightweight
+            tag.
+        """
+        tagger_time = None
+        for _ in range(10):
+            obj_type, data = self.read_object(sha)
+            if obj_type != OBJ_TAG:
+                return sha, obj_type, tagger_time
+            headers = dict(self._parse_headers(data))
+            if tagger_time is None:
+                tagger_time = self._parse_timestamp(headers.get('tagger', b''))
+            sha = headers['object'].decode('ascii')
+        raise UnsupportedRepository('Tag chain too long at %s' % sha)
+
+    def resolve(self, name):
+        """
+        Find the commit a full object id or a ref name refers to, peeling
+        annotated tags.
+
+        Ref names are looked up as git looks them up: as given (e.g.
+        ``HEAD``), then under ``refs/``, ``refs/tags/``, ``refs/heads/``
+        and ``refs/remotes/``.
+
+        Parameters:
+            name (string): The name.
+
+        Returns:
+            The full hex sha of the commit, or None if ``name`` refers to
+            an object that isn't a commit.
+
+        Raises:
+            UnsupportedRepository: when ``name`` can't be resolved without
+                ``git``, such as an abbreviated id, a revision expression
+                or an unknown name.
+        """
+        sha = None
+        if len(name) == 40 and not name.strip(string.hexdigits):
+            sha = name.lower()
+        elif '\\' not in name and all(
+                part not in ('', '.', '..') for part in name.split('/')):
+            for pattern in _REF_RULES:
+                sha = self.resolve_ref(pattern % name)
+                if sha is not None:
+                    break
+        if sha is None:
+            raise UnsupportedRepository('Cannot resolve %r' % name)
+        sha, obj_type, _ = self.peel(sha)
+        if obj_type != OBJ_COMMIT:
+            return None
+        return sha
+
+    def tag_index(self):
+        """
+        Get the index of tags by the commit they point at.
+
+        The index is shared between readers of the same repository and only
+        rebuilt when the tags change (see ``natcap.versioner.tagindex``).
+
+        Returns:
+            A ``tagindex.TagIndex`` instance.
+        """
+        return tagindex.load(self.common_dir, self.peel)
+
+    def best_tag(self, sha, index=None):
+        """
+        Choose the tag of a commit that ``git describe --tags`` would prefer.
+
+        Annotated tags win over lightweight tags and newer annotated tags
+        win over older ones, as with git.  Remaining ties go to the highest
+        version (see ``natcap.versioner.pep440``) rather than to the first
+        name.  Tag objects are only read when several annotated tags point
+        at the commit.
+
+        Parameters:
+            sha (string): The hex sha of the commit.
+            index=None (tagindex.TagIndex or None): The tag index to use.
+                If None, ``tag_index()`` is used.
+
+        Returns:
+            The tag name, or None if the commit is not tagged.
+        """
+        if index is None:
+            index = self.tag_index()
+        entries = index.tags_for(sha)
+        annotated = [entry for entry in entries if entry.annotated]
+        if len(annotated) > 1:
+            tagger_times = [self.peel(entry.sha)[2] for entry in annotated]
+            newest = max(tagger_times)
+            annotated = [entry for entry, tagger_time
+                         in zip(annotated, tagger_times)
+                         if tagger_time == newest]
+        return pep440.highest(entry.name for entry in annotated or entries)
+
+    def tagged_commits(self):
+        """
+        Map commits to the tag that ``git describe --tags`` would prefer.
+
+        Returns:
+            A dict mapping commit sha to tag name (see ``best_tag``).
+        """
+        index = self.tag_index()
+        return dict((sha, self.best_tag(sha, index))
+                    for sha in index.commits())
+
+    # ------------------------------------------------------------------
+    # History
+    # ------------------------------------------------------------------
+    def ancestors(self, sha):
+        """
+        Collect every ancestor of ``sha``, including ``sha`` itself.
+
+        Returns:
+            A set of hex shas.
+        """
+        seen = set([sha])
+        stack = [sha]
+        while stack:
+            for parent in self.commit(stack.pop())[0]:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return seen
+
+    def _split_at_graph(self, sha):
+        """Walk the history of ``sha`` until reaching the commit-graph.
+
+        Returns:
+            A tuple of ``(outside, entries)``: the set of ancestors of
+            ``sha`` (inclusive) that are not in the commit-graph, and the
+            graph positions of the graph commits they lead to.  Since a
+            commit-graph is closed under parents, every other ancestor is
+            reachable from ``entries``."""
+        graph = self.commit_graph()
+        outside = set()
+        entries = set()
+        stack = [sha]
+        while stack:
+            current = stack.pop()
+            position = graph.position(current)
+            if position is not None:
+                entries.add(position)
+                continue
+            if current in outside:
+                continue
+            outside.add(current)
+            stack.extend(self.commit(current)[0])
+        return outside, entries
+
+    def ancestor_count(self, sha):
+        """
+        Count the commits reachable from ``sha``, inclusive, as
+        ``git rev-list --count`` does.
+
+        Returns:
+            An int.
+        """
+        if self.commit_graph() is None:
+            return len(self.ancestors(sha))
+        outside, entries = self._split_at_graph(sha)
+        return len(outside) + self.commit_graph().count_reachable(entries)
+
+    def distance(self, sha, base):
+        """
+        Count the commits reachable from ``sha`` but not from ``base``, as
+        ``git rev-list --count base..sha`` does.
+
+        Returns:
+            An int.
+        """
+        graph = self.commit_graph()
+        if graph is None:
+            return len(self.ancestors(sha) - self.ancestors(base))
+        outside, entries = self._split_at_graph(sha)
+        base_outside, base_entries = self._split_at_graph(base)
+        return (len(outside - base_outside) +
+                graph.count_exclusive(entries, base_entries))
+
+    def describe(self, sha):
+        """
+        Find the nearest tag to a commit, as ``git describe --tags`` does.
+
+        The walk is git's own: commits are visited newest first (by commit
+        time, ties in the order they were queued), each tagged commit found
+        becomes a candidate (up to MAX_CANDIDATES), and a candidate's depth
+        counts the visited commits that it doesn't reach.  Across merges
+        with skewed commit times this may count more than the commits
+        since the tag, exactly as git does, so the python and CLI backends
+        report the same version.  Of equally deep candidates, the first
+        found wins.
+
+        Parameters:
+            sha (string): The hex sha of the commit to describe.
+
+        Returns:
+            A tuple of ``(tag_name, distance)``.  ``tag_name`` is None when
+            no tag is reachable, in which case ``distance`` is the number of
+            commits reachable from ``sha``.
+        """
+        tags = self.tag_index()
+        if sha in tags:
+            return self.best_tag(sha, tags), 0
+        if not tags:
+            return None, self.ancestor_count(sha)
+
+        # Maps each queued commit to the bits of the candidates that reach
+        # it.  Candidates are lists of [commit, depth, bit].
+        flags = {sha: 0}
+        order = itertools.count()
+        queue = [(-self.commit(sha)[1], next(order), sha)]
+        candidates = []
+        gave_up_on = None
+        visited = 0
+        while queue:
+            _, _, current = heapq.heappop(queue)
+            visited += 1
+            if current in tags:
+                if len(candidates) == MAX_CANDIDATES:
+                    gave_up_on = current
+                    break
+                bit = 1 << len(candidates)
+                candidates.append([current, visited - 1, bit])
+                flags[current] |= bit
+            current_flags = flags[current]
+            for candidate in candidates:
+                if not current_flags & candidate[2]:
+                    candidate[1] += 1
+            self._queue_parents(current, flags, queue, order)
+
+        if not candidates:
+            return None, self.ancestor_count(sha)
+
+        best, depth, bit = min(candidates, key=lambda candidate: candidate[1])
+        if gave_up_on is not None:
+            heapq.heappush(queue, (-self.commit(gave_up_on)[1], next(order),
+                                   gave_up_on))
+        # Finish counting the commits the best candidate doesn't reach.
+        while queue:
+            _, _, current = heapq.heappop(queue)
+            if flags[current] & bit:
+                if all(flags[queued] & bit for _, _, queued in queue):
+                    break
+            else:
+                depth += 1
+            self._queue_parents(current, flags, queue, order)
+        return self.best_tag(best, tags), depth
+
+    def _queue_parents(self, sha, flags, queue, order):
+        """Queue the unseen parents of a commit for ``describe()``, and pass
+        its flags on to all of them."""
+        for parent in self.commit(sha)[0]:
+            if parent not in flags:
+                flags[parent] = 0
+                heapq.heappush(queue, (-self.commit(parent)[1], next(order),
+                                       parent))
+            flags[parent] |= flags[sha]
+
+    def describe_many(self, shas):
+        """
+        Describe many commits, as ``describe()`` does, sharing the work.
+
+        An untagged commit with a single parent has its parent's nearest
+        tag, one commit further away, so chains of such commits are
+        described from the nearest commit that is already described,
+        tagged, a merge or a root.  Results are memoized for the lifetime
+        of the reader, until the tags change.
+
+        Parameters:
+            shas (list): The hex shas of the commits to describe.
+
+        Returns:
+            A list of ``(tag_name, distance)`` tuples (see ``describe()``),
+            in the order of ``shas``.
+        """
+        tags = self.tag_index()
+        if self._described_fingerprint != tags.fingerprint:
+            self._described = {}
+            self._described_fingerprint = tags.fingerprint
+        described = self._described
+
+        results = []
+        for sha in shas:
+            chain = []
+            current = sha
+            while current not in described:
+                parents = self.commit(current)[0]
+                if current in tags or len(parents) != 1:
+                    described[current] = self.describe(current)
+                    break
+                chain.append(current)
+                current = parents[0]
+
+            tag_name, distance = described[current]
+            for commit in reversed(chain):
+                distance += 1
+                described[commit] = (tag_name, distance)
+            results.append(described[sha])
+        return results
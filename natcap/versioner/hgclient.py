@@ -0,0 +1,227 @@
+"""
+A minimal client for the mercurial command server.
+
+``hg serve --cmdserver pipe`` keeps a single mercurial process alive and
+accepts commands over stdin/stdout using a small binary channel protocol.
+This avoids paying for interpreter startup on every ``hg`` call.  See
+https://www.mercurial-scm.org/wiki/CommandServer for the protocol.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+from . import executors
+
+LOGGER = logging.getLogger('natcap.versioner.hgclient')
+LOGGER.setLevel(logging.ERROR)
+
+_HEADER = struct.Struct('>cI')
+_RESULT = struct.Struct('>i')
+
+
+class CommandServerError(RuntimeError):
+    """
+    Raised when the command server cannot be started or stops responding.
+    """
+    pass
+
+
+class HgCommandServer(object):
+    """
+    A running ``hg serve --cmdserver pipe`` process for one repository.
+
+    Instances are also context managers; the server is shut down on exit.
+    """
+
+    def __init__(self, repo_path, hg_executable='hg',
+                 timeout=executors.DEFAULT_TIMEOUT):
+        """
+        Start the command server.
+
+        Parameters:
+            repo_path (string): The path to the repository root.
+            hg_executable='hg' (string): The mercurial executable to run.
+            timeout=executors.DEFAULT_TIMEOUT (float or None): The number
+                of seconds to wait for each message from the server before
+                it is killed.  If None, wait forever.
+
+        Raises:
+            CommandServerError: when the server does not greet us.
+        """
+        self.repo_path = repo_path
+        self._lock = threading.Lock()
+        self._process = None
+        self._deadline = None
+
+        env = executors.hardened_environment()
+        # Errors of commands come through the 'e' channel; whatever else
+        # the server writes to stderr is discarded rather than left to fill
+        # an unread pipe (or the caller's terminal).
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                self._process = subprocess.Popen(
+                    [hg_executable, 'serve', '--cmdserver', 'pipe',
+                     '--config', 'ui.interactive=False'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, cwd=repo_path, env=env)
+            except OSError as error:
+                raise CommandServerError(
+                    'Could not start hg command server: %s' % error)
+        self._deadline = executors.ReadDeadline(self._process, timeout)
+
+        try:
+            channel, hello = self._read_channel()
+        except CommandServerError:
+            self._kill()
+            raise
+        if channel != b'o':
+            self.close()
+            raise CommandServerError(
+                'Unexpected hello from hg command server: %r' % hello)
+
+        self.capabilities = []
+        self.encoding = 'UTF-8'
+        for line in hello.decode('ascii', 'replace').split('\n'):
+            key, _, value = line.partition(': ')
+            if key == 'capabilities':
+                self.capabilities = value.split()
+            elif key == 'encoding':
+                self.encoding = value
+        if 'runcommand' not in self.capabilities:
+            self.close()
+            raise CommandServerError(
+                'hg command server does not support runcommand')
+
+    @property
+    def running(self):
+        """Whether the server process is still alive."""
+        return self._process is not None and self._process.poll() is None
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            with self._deadline:
+                chunk = self._process.stdout.read(size - len(data))
+            if not chunk:
+                if self._deadline.timed_out:
+                    raise CommandServerError(
+                        'hg command server stopped responding after %s '
+                        'seconds' % self._deadline.timeout)
+                raise CommandServerError('hg command server closed its output')
+            data += chunk
+        return data
+
+    def _write(self, data):
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except (IOError, OSError) as error:
+            raise CommandServerError(
+                'Could not write to hg command server: %s' % error)
+
+    def _read_channel(self):
+        """Read a single message.
+
+        Returns:
+            A tuple of ``(channel, data)``.  For the input channels ``I``
+            and ``L``, ``data`` is the integer number of bytes requested."""
+        channel, length = _HEADER.unpack(self._read_exactly(_HEADER.size))
+        if channel in (b'I', b'L'):
+            return channel, length
+        return channel, self._read_exactly(length)
+
+    def runcommand(self, args):
+        """
+        Run an hg command in the server.
+
+        Parameters:
+            args (list): The command-line arguments, excluding ``hg``.
+
+        Returns:
+            A tuple of ``(returncode, output, error)``, where ``output`` and
+            ``error`` are decoded strings.
+
+        Raises:
+            CommandServerError: when the server has exited, stops
+                responding or breaks the protocol.  The server is killed,
+                since it can't be trusted with another command.
+        """
+        payload = b'\0'.join(
+            [arg.encode(self.encoding) for arg in args])
+        output = []
+        error = []
+        with self._lock:
+            if not self.running:
+                raise CommandServerError('hg command server is not running')
+            try:
+                returncode = self._exchange(payload, output, error)
+            except CommandServerError:
+                self._kill()
+                raise
+
+        return (returncode,
+                b''.join(output).decode(self.encoding),
+                b''.join(error).decode(self.encoding))
+
+    def _exchange(self, payload, output, error):
+        """Send a runcommand request and collect its output and error
+        messages until the result arrives, which is returned."""
+        self._write(
+            b'runcommand\n' + struct.pack('>I', len(payload)) + payload)
+        while True:
+            channel, data = self._read_channel()
+            if channel == b'o':
+                output.append(data)
+            elif channel == b'e':
+                error.append(data)
+            elif channel == b'r':
+                return _RESULT.unpack(data)[0]
+            elif channel in (b'I', b'L'):
+                # Never provide input; an empty reply means EOF.
+                self._write(struct.pack('>I', 0))
+            elif channel.isupper():
+                raise CommandServerError(
+                    'Unsupported required channel %r' % channel)
+            # Lowercase channels (e.g. debug) are optional and ignored.
+
+    def _kill(self):
+        """Kill the server process, and shut it down."""
+        if self._process is not None:
+            try:
+                self._process.kill()
+            except OSError:
+                # Already exited.
+                pass
+        self.close()
+
+    def close(self):
+        """Shut down the server process.  Safe to call more than once."""
+        process = self._process
+        self._process = None
+        if process is None:
+            return
+        self._deadline.stop()
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            process.wait()
+        finally:
+            process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Interpreter shutdown may have torn down what close() needs.
+            pass
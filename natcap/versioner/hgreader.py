@@ -0,0 +1,948 @@
+"""
+Read mercurial repository data directly from disk, without calling ``hg``.
+
+Only the subset of the on-disk format needed for versioning is understood:
+the working directory parents in ``.hg/dirstate`` (both formats), version 1
+revlogs (inline or split, with zlib, zstd or uncompressed chunks) for the
+changelog, the manifest and the ``.hgtags`` filelog, the ``tags2-visible``
+and ``hgtagsfnodes1`` caches, ``.hgtags`` and ``localtags``.  Anything else
+(unknown requirements, shared repositories, obsolescence markers, ...)
+raises ``UnsupportedRepository`` so that callers can fall back to the ``hg``
+command-line interface.
+
+Reading zstd-compressed revisions requires the ``zstandard`` package.  When
+NumPy is installed, the changelog index is viewed as a structured array and
+the latest tag of every changeset is computed at once (see
+``LatestTagTable``).
+"""
+from __future__ import absolute_import
+import array
+import binascii
+import codecs
+import collections
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# NumPy is optional, and only imported when first needed (see
+# ``_load_numpy()``) so that importing this module stays cheap.
+_NOT_LOADED = object()
+numpy = _NOT_LOADED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = logging.getLogger('natcap.versioner.hgreader')
+LOGGER.setLevel(logging.ERROR)
+
+NULL_REV = -1
+NULL_ID = b'\0' * 20
+
+
+def _load_numpy():
+    """
+    Import NumPy on first use.
+
+    Returns:
+        The numpy module, or None if it isn't installed.
+    """
+    global numpy
+    if numpy is _NOT_LOADED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+# The requirements (from .hg/requires and .hg/store/requires) that don't
+# change how the data read here is stored.
+SUPPORTED_REQUIREMENTS = frozenset([
+    'bookmarksinstore',
+    'dirstate-v2',
+    'dotencode',
+    'fncache',
+    'generaldelta',
+    'persistent-nodemap',
+    'revlog-compression-zstd',
+    'revlogv1',
+    'share-safe',
+    'sparserevlog',
+    'store',
+])
+
+_REVLOG_VERSION = 1
+_FLAG_INLINE_DATA = 1 << 16
+_FLAG_GENERALDELTA = 1 << 17
+
+# offset and flags, compressed length, uncompressed length, delta base,
+# linkrev, parent 1, parent 2, node (then 12 bytes of padding).
+INDEX_ENTRY = struct.Struct('>Qiiiiii20s12x')
+_INDEX_DTYPE = [
+    ('offset_flags', '>u8'), ('compressed_length', '>i4'),
+    ('length', '>i4'), ('base', '>i4'), ('linkrev', '>i4'),
+    ('parent1', '>i4'), ('parent2', '>i4'), ('node', 'V20'),
+    ('padding', 'V12'),
+]
+_DELTA_HUNK = struct.Struct('>lll')
+
+_DIRSTATE_V2_MARKER = b'dirstate-v2\n'
+_FNODES_RECORD_SIZE = 24
+_FNODES_MISSING = b'\xff' * _FNODES_RECORD_SIZE
+
+# Maps a changelog path to ``(signature, LatestTagTable)``.
+_TABLE_CACHE = {}
+_TABLE_CACHE_LOCK = threading.Lock()
+
+
+class UnsupportedRepository(Exception):
+    """
+    Raised when the repository uses a feature this reader cannot handle.
+    """
+    pass
+
+
+def _decompress(chunk):
+    """Decompress a revlog chunk, based on its first byte."""
+    if not chunk:
+        return chunk
+    header = chunk[:1]
+    if header == b'x':
+        return zlib.decompress(chunk)
+    if header == b'\0':
+        return chunk
+    if header == b'u':
+        return chunk[1:]
+    if header == b'\x28':
+        if zstandard is None:
+            raise UnsupportedRepository(
+                'zstd revisions need the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(chunk)
+    raise UnsupportedRepository(
+        'Unknown revlog compression %r' % header)
+
+
+def _apply_delta(text, delta):
+    """Apply a binary delta (a list of replaced ranges) to ``text``."""
+    pieces = []
+    last = 0
+    position = 0
+    while position < len(delta):
+        start, end, length = _DELTA_HUNK.unpack_from(delta, position)
+        position += _DELTA_HUNK.size
+        pieces.append(text[last:start])
+        pieces.append(delta[position:position + length])
+        position += length
+        last = end
+    pieces.append(text[last:])
+    return b''.join(pieces)
+
+
+def _unescape_extra(text):
+    """Undo the escaping of a changeset's extra field."""
+    if b'\\0' in text:
+        # Fix up \0 without getting into trouble with \\0.
+        text = text.replace(b'\\\\', b'\\\\\n')
+        text = text.replace(b'\\0', b'\0')
+        text = text.replace(b'\n', b'')
+    return codecs.escape_decode(text)[0]
+
+
+def _read_tags(data):
+    """Parse the lines of a ``.hgtags``-style file.
+
+    Returns:
+        An ordered dict mapping tag name (bytes) to ``(node, history)``,
+        where ``node`` is the last node given for the tag and ``history``
+        the list of earlier ones."""
+    history = collections.OrderedDict()
+    for line in data.splitlines():
+        if not line:
+            continue
+        try:
+            node_hex, name = line.split(b' ', 1)
+            node = binascii.unhexlify(node_hex)
+        except (ValueError, TypeError, binascii.Error):
+            continue
+        history.setdefault(name.strip(), []).append(node)
+    return collections.OrderedDict(
+        (name, (nodes[-1], nodes[:-1])) for name, nodes in history.items())
+
+
+def _update_tags(file_tags, all_tags, tag_type=None, tag_types=None):
+    """Merge the tags of one file into ``all_tags``, as mercurial does.
+
+    A tag already in ``all_tags`` is kept if it supersedes the new one (the
+    new node is in its history but not the other way round, or both are and
+    it has the longer history).  Otherwise the new one wins."""
+    for name, node_history in file_tags.items():
+        if name not in all_tags:
+            all_tags[name] = node_history
+            if tag_type is not None:
+                tag_types[name] = tag_type
+            continue
+
+        new_node, new_history = node_history
+        old_node, old_history = all_tags[name]
+        if (old_node != new_node and new_node in old_history and
+                (old_node not in new_history or
+                 len(old_history) > len(new_history))):
+            new_node = old_node
+        elif tag_type is not None:
+            tag_types[name] = tag_type
+        new_history.extend(
+            [node for node in old_history if node not in new_history])
+        all_tags[name] = new_node, new_history
+
+
+class Revlog(object):
+    """A version 1 revlog: an index of revisions and their (delta) data."""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.data_path = index_path[:-len('.i')] + '.d'
+        try:
+            with open(index_path, 'rb') as index_file:
+                index = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            # Revlogs are created with their first revision.
+            if os.path.exists(index_path):
+                raise
+            index = b''
+        except ValueError:
+            # An empty file can't be mapped.
+            index = b''
+
+        self.inline = False
+        self.generaldelta = False
+        if index:
+            header = struct.unpack('>I', index[:4])[0]
+            if header & 0xFFFF != _REVLOG_VERSION:
+                raise UnsupportedRepository(
+                    'Revlog version %s not supported: %s' % (
+                        header & 0xFFFF, index_path))
+            if header & ~(0xFFFF | _FLAG_INLINE_DATA | _FLAG_GENERALDELTA):
+                raise UnsupportedRepository(
+                    'Revlog flags not supported: %s' % index_path)
+            self.inline = bool(header & _FLAG_INLINE_DATA)
+            self.generaldelta = bool(header & _FLAG_GENERALDELTA)
+
+        self._index = index
+        self._entry_offsets = None
+        if self.inline:
+            # Each entry is followed by its revision's data.
+            self._entry_offsets = []
+            position = 0
+            while position < len(index):
+                self._entry_offsets.append(position)
+                position += INDEX_ENTRY.size + struct.unpack(
+                    '>i', index[position + 8:position + 12])[0]
+            self.count = len(self._entry_offsets)
+        else:
+            self.count = len(index) // INDEX_ENTRY.size
+        self._parent1 = None
+        self._parent2 = None
+        self._nodes = None
+        self._node_map = None
+
+    def _load_columns(self):
+        """Decode the parent and node columns of every entry at once."""
+        if self._nodes is not None:
+            return
+        if self.inline:
+            entries = [self.entry(rev) for rev in range(self.count)]
+            self._parent1 = [entry[4] for entry in entries]
+            self._parent2 = [entry[5] for entry in entries]
+            self._nodes = [entry[6] for entry in entries]
+            return
+
+        # Entries are contiguous, so read the index as big-endian int32s;
+        # the parents are the 7th and 8th of the 16 words of each entry.
+        index = self._index[:self.count * INDEX_ENTRY.size]
+        words = array.array('i')
+        if words.itemsize != 4:
+            words = array.array('l')
+        try:
+            words.frombytes(index)
+        except AttributeError:
+            # python 2
+            words.fromstring(index)
+        if sys.byteorder == 'little':
+            words.byteswap()
+        self._parent1 = words[6::16]
+        self._parent2 = words[7::16]
+        self._nodes = [index[position:position + 20] for position
+                       in range(32, len(index), INDEX_ENTRY.size)]
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, rev):
+        """
+        Read an index entry.
+
+        Returns:
+            A tuple of ``(offset, flags, compressed_length, base, parent1,
+            parent2, node)``.
+        """
+        if self._entry_offsets is not None:
+            position = self._entry_offsets[rev]
+        else:
+            position = rev * INDEX_ENTRY.size
+        (offset_flags, compressed_length, _, base, _, parent1, parent2,
+         node) = INDEX_ENTRY.unpack_from(self._index, position)
+        if rev == 0:
+            # The first 4 bytes of the first entry are the revlog header.
+            offset_flags &= 0xFFFF
+        return (offset_flags >> 16, offset_flags & 0xFFFF, compressed_length,
+                base, parent1, parent2, node)
+
+    def parent_arrays(self):
+        """
+        Get the parents of every revision as NumPy arrays.  Requires NumPy.
+
+        Returns:
+            A tuple of two int64 arrays, ``(parent1, parent2)``, with
+            NULL_REV for missing parents.
+        """
+        numpy = _load_numpy()
+        if self.inline or not self.count:
+            self._load_columns()
+            return (numpy.array(self._parent1, dtype=numpy.int64),
+                    numpy.array(self._parent2, dtype=numpy.int64))
+        # The (memory-mapped) index is a table of fixed-size records.
+        index = numpy.frombuffer(self._index, dtype=_INDEX_DTYPE,
+                                 count=self.count)
+        parents = (index['parent1'].astype(numpy.int64),
+                   index['parent2'].astype(numpy.int64))
+        del index
+        return parents
+
+    def parents(self, rev):
+        """Get the parent revisions of ``rev`` (NULL_REV when missing)."""
+        self._load_columns()
+        return self._parent1[rev], self._parent2[rev]
+
+    def node(self, rev):
+        """Get the 20-byte node of ``rev``."""
+        if rev == NULL_REV:
+            return NULL_ID
+        self._load_columns()
+        return self._nodes[rev]
+
+    def rev(self, node):
+        """
+        Find the revision of a node.
+
+        Returns:
+            The revision number, or None if the node is not in the revlog.
+        """
+        if node == NULL_ID:
+            return NULL_REV
+        if self._node_map is None:
+            self._load_columns()
+            self._node_map = dict(
+                (node, rev) for rev, node in enumerate(self._nodes))
+        return self._node_map.get(node)
+
+    def _chunks(self, revs):
+        """Read the decompressed data of several revisions."""
+        chunks = []
+        data_file = None
+        try:
+            for rev in revs:
+                offset, flags, length = self.entry(rev)[:3]
+                if flags:
+                    raise UnsupportedRepository(
+                        'Revision flags not supported: %s' % self.index_path)
+                if self.inline:
+                    position = self._entry_offsets[rev] + INDEX_ENTRY.size
+                    chunk = self._index[position:position + length]
+                else:
+                    if data_file is None:
+                        data_file = open(self.data_path, 'rb')
+                    data_file.seek(offset)
+                    chunk = data_file.read(length)
+                chunks.append(_decompress(chunk))
+        finally:
+            if data_file is not None:
+                data_file.close()
+        return chunks
+
+    def revision(self, rev):
+        """
+        Reconstruct the full text of a revision from its delta chain.
+
+        Returns:
+            The text, as bytes.
+        """
+        chain = []
+        current = rev
+        while current != NULL_REV:
+            chain.append(current)
+            base = self.entry(current)[3]
+            if base == current:
+                break
+            current = base if self.generaldelta else current - 1
+        chain.reverse()
+
+        chunks = self._chunks(chain)
+        if current == NULL_REV:
+            # The chain starts with a delta against the empty text.
+            text = b''
+        else:
+            text = chunks.pop(0)
+        for delta in chunks:
+            text = _apply_delta(text, delta)
+        return text
+
+
+class HgReader(object):
+    """
+    Compute version data of a mercurial repository without spawning ``hg``.
+
+    A reader reflects the repository as it was when the reader was created;
+    create a new one to see later commits.
+    """
+
+    def __init__(self, repo_root):
+        self.repo_root = repo_root
+        self.hg_dir = os.path.join(repo_root, '.hg')
+        self.store_dir = os.path.join(self.hg_dir, 'store')
+
+        requirements = self._read_requirements(
+            os.path.join(self.hg_dir, 'requires'))
+        if 'share-safe' in requirements:
+            requirements |= self._read_requirements(
+                os.path.join(self.store_dir, 'requires'))
+        unsupported = requirements - SUPPORTED_REQUIREMENTS
+        if unsupported:
+            raise UnsupportedRepository(
+                'Repository requirements not supported: %s' % ', '.join(
+                    sorted(unsupported)))
+        if 'store' not in requirements:
+            raise UnsupportedRepository('Repositories without a store '
+                                        'are not supported')
+        self.requirements = requirements
+
+        obsstore_path = os.path.join(self.store_dir, 'obsstore')
+        if (os.path.exists(obsstore_path) and
+                os.path.getsize(obsstore_path) > 0):
+            # Obsolete changesets may be hidden.
+            raise UnsupportedRepository('Obsolescence markers not supported')
+
+        self.changelog = Revlog(os.path.join(self.store_dir, '00changelog.i'))
+        self._manifest = None
+        self._changesets = {}
+
+    @staticmethod
+    def _read_requirements(path):
+        try:
+            with open(path) as requires_file:
+                return set(line.strip() for line in requires_file
+                           if line.strip())
+        except (IOError, OSError):
+            return set()
+
+    # ------------------------------------------------------------------
+    # Working directory and changesets
+    # ------------------------------------------------------------------
+    def working_parent(self):
+        """
+        Find the first parent of the working directory.
+
+        Returns:
+            The revision number, NULL_REV for an empty working directory.
+        """
+        try:
+            with open(os.path.join(self.hg_dir, 'dirstate'), 'rb') as dirstate:
+                header = dirstate.read(len(_DIRSTATE_V2_MARKER) + 20)
+        except (IOError, OSError):
+            return NULL_REV
+        if header.startswith(_DIRSTATE_V2_MARKER):
+            header = header[len(_DIRSTATE_V2_MARKER):]
+        node = header[:20]
+        if len(node) < 20:
+            return NULL_REV
+
+        rev = self.changelog.rev(node)
+        if rev is None:
+            raise UnsupportedRepository(
+                'Working directory parent %s not in the changelog' %
+                binascii.hexlify(node).decode('ascii'))
+        return rev
+
+    def changeset(self, rev):
+        """
+        Parse the parts of a changeset needed for versioning.
+
+        Returns:
+            A tuple of ``(manifest_node, date, branch)``.  ``branch`` is
+            bytes.
+        """
+        try:
+            return self._changesets[rev]
+        except KeyError:
+            pass
+        if rev == NULL_REV:
+            return NULL_ID, 0.0, b'default'
+
+        lines = self.changelog.revision(rev).split(b'\n', 3)
+        date_fields = lines[2].split(b' ', 2)
+        extra = {}
+        if len(date_fields) > 2:
+            for field in date_fields[2].split(b'\0'):
+                key, _, value = _unescape_extra(field).partition(b':')
+                extra[key] = value
+        result = (binascii.unhexlify(lines[0]), float(date_fields[0]),
+                  extra.get(b'branch', b'default'))
+        self._changesets[rev] = result
+        return result
+
+    def parents(self, rev):
+        """
+        Get the parents of a changeset, as ``changectx.parents()`` does.
+
+        Returns:
+            A list of one or two revisions.  The first parent of a root
+            changeset is NULL_REV.
+        """
+        parent1, parent2 = self.changelog.parents(rev)
+        if parent2 == NULL_REV:
+            return [parent1]
+        return [parent1, parent2]
+
+    def heads(self):
+        """
+        Find the changesets without children.
+
+        Returns:
+            A list of revisions, oldest first.
+        """
+        count = len(self.changelog)
+        if _load_numpy() is not None:
+            has_child = numpy.zeros(count + 1, dtype=bool)
+            for parents in self.changelog.parent_arrays():
+                has_child[parents] = True
+            return numpy.flatnonzero(~has_child[:count]).tolist()
+
+        self.changelog._load_columns()
+        has_child = bytearray(count + 1)
+        # NULL_REV parents mark the extra item at the end.
+        for parents in (self.changelog._parent1, self.changelog._parent2):
+            for parent in parents:
+                has_child[parent] = 1
+        return [rev for rev in range(count) if not has_child[rev]]
+
+    # ------------------------------------------------------------------
+    # Tags
+    # ------------------------------------------------------------------
+    def _cached_global_tags(self):
+        """Read the global tags from ``tags2-visible`` if it's up to date.
+
+        Returns:
+            The tags (see ``_read_tags``), or None if the cache is missing or
+            stale."""
+        try:
+            with open(os.path.join(self.hg_dir, 'cache', 'tags2-visible'),
+                      'rb') as cache_file:
+                data = cache_file.read()
+        except (IOError, OSError):
+            return None
+
+        valid_line, _, tag_lines = data.partition(b'\n')
+        fields = valid_line.split()
+        # A third field is a hash of the filtered revisions; there are none
+        # without obsolescence markers, so it must be absent.
+        tip_rev = len(self.changelog) - 1
+        try:
+            if (len(fields) != 2 or int(fields[0]) != tip_rev or
+                    binascii.unhexlify(fields[1]) !=
+                    self.changelog.node(tip_rev)):
+                return None
+        except (ValueError, TypeError, binascii.Error):
+            return None
+        return _read_tags(tag_lines)
+
+    def _manifest_revlog(self):
+        if self._manifest is None:
+            self._manifest = Revlog(
+                os.path.join(self.store_dir, '00manifest.i'))
+        return self._manifest
+
+    def _hgtags_filelog(self):
+        """Open the filelog of ``.hgtags``, or return None if it has none."""
+        filename = '.hgtags.i'
+        if 'dotencode' in self.requirements:
+            filename = '~2ehgtags.i'
+        path = os.path.join(self.store_dir, 'data', filename)
+        if not os.path.exists(path):
+            return None
+        return Revlog(path)
+
+    def _hgtags_fnode(self, rev, fnodes_cache):
+        """Find the filelog node of ``.hgtags`` in a changeset.
+
+        Returns:
+            The 20-byte node, or None if the changeset has no ``.hgtags``."""
+        record = fnodes_cache[rev * _FNODES_RECORD_SIZE:
+                              (rev + 1) * _FNODES_RECORD_SIZE]
+        if (len(record) == _FNODES_RECORD_SIZE and
+                record != _FNODES_MISSING and
+                record[:4] == self.changelog.node(rev)[:4]):
+            fnode = record[4:]
+        else:
+            manifest = self._manifest_revlog()
+            manifest_rev = manifest.rev(self.changeset(rev)[0])
+            if manifest_rev is None:
+                raise UnsupportedRepository('Manifest of %s not found' % rev)
+            text = manifest.revision(manifest_rev)
+            if text.startswith(b'.hgtags\0'):
+                start = len(b'.hgtags\0')
+            else:
+                start = text.find(b'\n.hgtags\0')
+                if start < 0:
+                    return None
+                start += len(b'\n.hgtags\0')
+            fnode = binascii.unhexlify(text[start:start + 40])
+        if fnode == NULL_ID:
+            return None
+        return fnode
+
+    def global_tags(self):
+        """
+        Collect the tags committed to ``.hgtags`` on every head.
+
+        Returns:
+            A dict mapping tag name (bytes) to ``(node, history)``.
+        """
+        cached = self._cached_global_tags()
+        if cached is not None:
+            all_tags = {}
+            _update_tags(cached, all_tags)
+            return all_tags
+
+        filelog = self._hgtags_filelog()
+        if filelog is None or not len(filelog):
+            return {}
+
+        try:
+            with open(os.path.join(self.hg_dir, 'cache', 'hgtagsfnodes1'),
+                      'rb') as fnodes_file:
+                fnodes_cache = fnodes_file.read()
+        except (IOError, OSError):
+            fnodes_cache = b''
+
+        fnodes = []
+        for head in self.heads():
+            fnode = self._hgtags_fnode(head, fnodes_cache)
+            if fnode is not None and fnode not in fnodes:
+                fnodes.append(fnode)
+
+        all_tags = {}
+        for fnode in fnodes:
+            file_rev = filelog.rev(fnode)
+            if file_rev is None:
+                raise UnsupportedRepository('.hgtags revision not found')
+            text = filelog.revision(file_rev)
+            if text.startswith(b'\1\n'):
+                # Skip the copy metadata.
+                text = text[text.index(b'\1\n', 2) + 2:]
+            _update_tags(_read_tags(text), all_tags)
+        return all_tags
+
+    def tags(self):
+        """
+        Collect the tags of the repository.
+
+        Returns:
+            A tuple of ``(tags, tag_types)``.  ``tags`` maps tag name
+            (bytes) to the revision it points at; ``tag_types`` maps tag
+            name to ``'global'`` or ``'local'``.
+        """
+        all_tags = self.global_tags()
+        tag_types = dict((name, 'global') for name in all_tags)
+
+        try:
+            with open(os.path.join(self.hg_dir, 'localtags'),
+                      'rb') as localtags_file:
+                local_tags = _read_tags(localtags_file.read())
+        except (IOError, OSError):
+            local_tags = {}
+        for name in list(local_tags):
+            if self.changelog.rev(local_tags[name][0]) is None:
+                del local_tags[name]
+        _update_tags(local_tags, all_tags, 'local', tag_types)
+
+        tags = {}
+        for name, (node, _) in all_tags.items():
+            rev = self.changelog.rev(node)
+            if node != NULL_ID and rev is not None:
+                tags[name] = rev
+        return tags, tag_types
+
+    # ------------------------------------------------------------------
+    # History
+    # ------------------------------------------------------------------
+    def _ancestors(self, rev):
+        """Mark the ancestors of ``rev``, inclusive, in a bytearray."""
+        marks = bytearray(len(self.changelog))
+        stack = [rev]
+        while stack:
+            current = stack.pop()
+            if current == NULL_REV or marks[current]:
+                continue
+            marks[current] = 1
+            stack.extend(self.changelog.parents(current))
+        return marks
+
+    def count_only(self, rev, base):
+        """
+        Count the changesets in ``only(rev, base)``: the ancestors of
+        ``rev`` that aren't ancestors of ``base``.
+
+        Returns:
+            An int.
+        """
+        excluded = self._ancestors(base)
+        return sum(1 for included, excluded_mark
+                   in zip(self._ancestors(rev), excluded)
+                   if included and not excluded_mark)
+
+    def combine_latest_tags(self, rev, parent_tags, tags):
+        """
+        Find the latest tags of an untagged changeset from its parents'.
+
+        Parameters:
+            rev (int): The changeset.
+            parent_tags (list): The ``latest_tags()`` of each of the
+                changeset's ``parents()``.
+            tags (dict): The tags of the repository (see ``tags()``).
+
+        Returns:
+            A tuple like ``latest_tags()``.
+        """
+        if len(parent_tags) == 1:
+            date, distance, names = parent_tags[0]
+        elif parent_tags[0][2] == parent_tags[1][2]:
+            date, distance, names = max(parent_tags)
+        else:
+            def key(parent_tag):
+                # The fewest changes since the tag wins, then the latest
+                # tagged changeset.
+                base = tags.get(parent_tag[2][0], NULL_REV)
+                return [-self.count_only(rev, base), parent_tag[0]]
+            date, distance, names = max(parent_tags, key=key)
+        return date, distance + 1, names
+
+    def _tagged(self, tags, tag_types):
+        """Map each globally tagged revision to its sorted tag names."""
+        tagged = {}
+        for name, tag_rev in tags.items():
+            if tag_types.get(name) == 'global':
+                tagged.setdefault(tag_rev, []).append(name)
+        for names in tagged.values():
+            names.sort()
+        return tagged
+
+    def latest_tag_table(self):
+        """
+        Get the LatestTagTable of the repository.  Requires NumPy.
+
+        Tables are cached per repository until the changelog or the tags
+        change.
+
+        Returns:
+            A tuple of ``(table, tags)``, where ``tags`` is the first item
+            of ``tags()``.
+        """
+        tags, tag_types = self.tags()
+        count = len(self.changelog)
+        # The changelog is append-only, so its length and tip identify it.
+        signature = (count, self.changelog.node(count - 1),
+                     sorted(tags.items()), sorted(tag_types.items()))
+        key = os.path.abspath(self.changelog.index_path)
+        with _TABLE_CACHE_LOCK:
+            cached = _TABLE_CACHE.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1], tags
+
+        parent1, parent2 = self.changelog.parent_arrays()
+        table = LatestTagTable(parent1, parent2,
+                               self._tagged(tags, tag_types))
+        with _TABLE_CACHE_LOCK:
+            _TABLE_CACHE[key] = (signature, table)
+        return table, tags
+
+    def latest_tags(self, rev):
+        """
+        Find the latest global tags of a changeset, as the ``{latesttag}``
+        and ``{latesttagdistance}`` template keywords do.
+
+        With NumPy, the answer comes from ``latest_tag_table()``.
+
+        Returns:
+            A tuple of ``(date, distance, names)``.  ``names`` is the sorted
+            list of tag names (bytes) on the tagged changeset, ``[b'null']``
+            if no tag is reachable.
+        """
+        if _load_numpy() is not None:
+            table, tags = self.latest_tag_table()
+            return table.latest_tags(rev, self, tags)
+
+        tags, tag_types = self.tags()
+        tagged = self._tagged(tags, tag_types)
+
+        # Collect the changesets whose latest tag is needed: ancestors of
+        # rev up to the first tagged changeset on each path.  Parents have
+        # lower revision numbers than their children, so computing them in
+        # increasing order always finds the parents' values ready.
+        needed = set()
+        stack = [rev]
+        while stack:
+            current = stack.pop()
+            if current == NULL_REV or current in needed:
+                continue
+            needed.add(current)
+            if current not in tagged:
+                stack.extend(self.parents(current))
+
+        latest = {NULL_REV: (0, 0, [b'null'])}
+        for current in sorted(needed):
+            if current in tagged:
+                latest[current] = (self.changeset(current)[1], 0,
+                                   tagged[current])
+            else:
+                latest[current] = self.combine_latest_tags(
+                    current, [latest[parent]
+                              for parent in self.parents(current)], tags)
+        return latest[rev]
+
+    def describe(self):
+        """
+        Describe the working directory parent, as ``hg log -r .`` does.
+
+        Returns:
+            A dict with the ``latesttag``, ``latesttagdistance``, ``branch``
+            and ``node`` (short) template values, as strings.
+        """
+        rev = self.working_parent()
+        _, distance, names = self.latest_tags(rev)
+        return {
+            'latesttag': b':'.join(names).decode('utf-8', 'replace'),
+            'latesttagdistance': str(distance),
+            'branch': self.changeset(rev)[2].decode('utf-8', 'replace'),
+            'node': binascii.hexlify(
+                self.changelog.node(rev)[:6]).decode('ascii'),
+        }
+
+
+class LatestTagTable(object):
+    """
+    The latest tags of every changeset of a repository.  Requires NumPy.
+
+    An untagged changeset with a single parent has the latest tags of that
+    parent, one step further away.  Following such links down to the
+    nearest *anchor* (a tagged changeset, a merge or the null revision) is
+    done for every changeset at once by pointer jumping over the parent
+    columns, which leaves each changeset's anchor in ``anchors`` and its
+    distance from it in ``steps``.  The latest tags of anchors are computed
+    with mercurial's rules when first needed and memoized, so once the
+    anchors below a changeset are known, looking it up costs O(1).
+    """
+
+    def __init__(self, parent1, parent2, tagged):
+        """Link every changeset to its anchor.
+
+        Parameters:
+            parent1, parent2 (numpy.ndarray): The parent columns of the
+                changelog (see ``Revlog.parent_arrays()``).
+            tagged (dict): Maps each globally tagged revision to its sorted
+                tag names.
+        """
+        numpy = _load_numpy()
+        count = len(parent1)
+        # The null revision is stored after the last changeset.
+        self._null = count
+        parent1 = numpy.where(parent1 < 0, count, parent1)
+        parent2 = numpy.where(parent2 < 0, count, parent2)
+
+        is_tagged = numpy.zeros(count, dtype=bool)
+        if tagged:
+            is_tagged[list(tagged)] = True
+        linked = (parent2 == count) & ~is_tagged
+
+        anchors = numpy.arange(count + 1, dtype=numpy.int64)
+        anchors[:count][linked] = parent1[linked]
+        steps = numpy.zeros(count + 1, dtype=numpy.int64)
+        steps[:count][linked] = 1
+        while True:
+            jumped = anchors[anchors]
+            if numpy.array_equal(jumped, anchors):
+                break
+            steps += steps[anchors]
+            anchors = jumped
+
+        self.anchors = anchors
+        self.steps = steps
+        self._tagged = tagged
+        self._latest = {count: (0, 0, [b'null'])}
+
+    def _anchor_tags(self, anchor, reader, tags):
+        """Compute (and memoize) the latest tags of an anchor."""
+        latest = self._latest
+        stack = [anchor]
+        while stack:
+            current = stack[-1]
+            if current in latest:
+                stack.pop()
+                continue
+            if current in self._tagged:
+                latest[current] = (reader.changeset(current)[1], 0,
+                                   self._tagged[current])
+                stack.pop()
+                continue
+
+            parents = reader.parents(current)
+            missing = [int(self.anchors[parent]) for parent in parents
+                       if parent != NULL_REV and
+                       int(self.anchors[parent]) not in latest]
+            if missing:
+                stack.extend(missing)
+                continue
+            latest[current] = reader.combine_latest_tags(
+                current, [self._lookup(parent) for parent in parents], tags)
+            stack.pop()
+        return latest[anchor]
+
+    def _lookup(self, rev):
+        """Get the latest tags of a changeset whose anchor is computed."""
+        if rev == NULL_REV:
+            return self._latest[self._null]
+        date, distance, names = self._latest[int(self.anchors[rev])]
+        return date, distance + int(self.steps[rev]), names
+
+    def latest_tags(self, rev, reader, tags):
+        """
+        Find the latest tags of a changeset (see ``HgReader.latest_tags``).
+
+        Parameters:
+            rev (int): The changeset.
+            reader (HgReader): A reader of the repository, used to read the
+                changesets needed to compute anchors.
+            tags (dict): The first item of ``reader.tags()``.
+
+        Returns:
+            A tuple of ``(date, distance, names)``.
+        """
+        if rev != NULL_REV:
+            self._anchor_tags(int(self.anchors[rev]), reader, tags)
+        return self._lookup(rev)
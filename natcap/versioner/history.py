@@ -0,0 +1,148 @@
+"""
+Versions of every commit in a range of history, from a single pass.
+
+The commits are streamed oldest first from one ``git rev-list`` (or
+``hg log``) process, and the nearest tag and distance of each commit are
+derived from those of its parents as the walk goes.  The state of a commit
+is only kept until its last child has been seen, so memory depends on the
+width of the history, not on the length of the range.
+
+A tagged commit is described on its own, since ``git describe`` prefers
+annotated tags (and then the newest) over the highest version.  Any other
+commit with a single parent is one commit further from its parent's nearest
+tag.  This is what ``git describe`` reports, since every
+commit reachable from such a commit but not from the tag is either the
+commit itself or one reachable from its parent.  Merges can't be derived
+from their parents this way (``git describe`` counts every commit merged
+since the tag), so each merge is described on its own, and its distance
+always matches ``vcs_version()``.
+
+Mercurial computes ``latesttag`` and ``latesttagdistance`` (measured along
+the longest path to the tag) for every revision it logs, exactly as
+``HgRepo`` reports them for a single revision, so ``hg log`` is streamed as
+is.
+"""
+from __future__ import absolute_import
+import collections
+
+from . import executors
+
+# The arguments of the git rev-list pass, followed by the revision range.
+# Each commit is a header line (``commit <node> <children>``) followed by a
+# line of its parents and decorations, separated by \x02.
+GIT_REV_LIST_ARGS = ['rev-list', '--reverse', '--topo-order', '--children',
+                     '--format=%P%x02%D']
+
+# The arguments of the hg log pass, followed by the revset.
+HG_LOG_ARGS = ['log', '--config', 'ui.report_untrusted=False', '--template',
+               '{node}\\x02{latesttag}\\x02{latesttagdistance}\\x02'
+               '{branch}\\n', '-r']
+
+
+class Revision(collections.namedtuple(
+        'Revision', ['node', 'child_count', 'parents', 'tags'])):
+    """A commit of a rev-list: its full node id, the number of its children
+    within the range, the node ids of its parents and the tags on it."""
+    __slots__ = ()
+
+
+def stream_lines(args, cwd=None, executor=None,
+                 timeout=executors.DEFAULT_TIMEOUT):
+    """
+    Run a command and yield the lines of its output as they are written.
+
+    The command is run by an executor (see
+    ``executors.CommandExecutor.stream()``), so it is recorded and replayed
+    like any other, and it is killed if it writes nothing for ``timeout``
+    seconds or if the generator is closed early.
+
+    Parameters:
+        args (list): The program and its arguments.
+        cwd=None (string or None): The working directory for the command.
+        executor=None (executors.CommandExecutor or None): The executor to
+            run the command with.  If None, the default executor is used.
+        timeout=executors.DEFAULT_TIMEOUT (float or None): The number of
+            seconds the command may go without writing a line.
+
+    Returns:
+        A generator of decoded lines, without line endings.
+
+    Raises:
+        subprocess.CalledProcessError: when the command exits nonzero.
+        executors.CommandTimeout: when the command stops writing.
+    """
+    if executor is None:
+        executor = executors.get_default_executor()
+    return executor.stream(args, cwd=cwd, timeout=timeout)
+
+
+def parse_rev_list(lines):
+    """
+    Parse the output of ``git`` with ``GIT_REV_LIST_ARGS``.
+
+    Parameters:
+        lines (iterable): The lines of the output.
+
+    Returns:
+        A generator of Revision, in the order they were listed.
+    """
+    lines = iter(lines)
+    for header in lines:
+        if not header.startswith('commit '):
+            continue
+        ids = header.split()[1:]
+        parents, _, decorations = next(lines).partition('\x02')
+        tags = [ref.strip()[len('tag: '):] for ref in decorations.split(',')
+                if ref.strip().startswith('tag: ')]
+        yield Revision(ids[0], len(ids) - 1, parents.split(), tags)
+
+
+def walk(revisions, describe):
+    """
+    Find the nearest tag and distance of every revision.
+
+    Parameters:
+        revisions (iterable): Revision, parents before their children (see
+            ``parse_rev_list()``).
+        describe (callable): ``describe(node)`` returns the ``(tag,
+            distance)`` of a commit as ``git describe`` finds them, with a
+            tag of None (and the number of its ancestors) if no tag is
+            reachable.  It is called for each tagged commit and untagged
+            merge, and at most once for each parent outside of the range.
+
+    Returns:
+        A generator of ``(node, tag, distance)`` tuples, ``tag`` being None
+        when no tag is reachable.
+    """
+    # Maps a node to [tag, distance, children not seen yet].
+    states = {}
+    outside = {}
+    for revision in revisions:
+        parent_states = []
+        for parent in revision.parents:
+            state = states.get(parent)
+            if state is not None:
+                state[2] -= 1
+                if state[2] <= 0:
+                    del states[parent]
+            parent_states.append(state)
+
+        if revision.tags:
+            tag, distance = describe(revision.node)
+        elif len(revision.parents) == 1:
+            state = parent_states[0]
+            if state is None:
+                parent = revision.parents[0]
+                if parent not in outside:
+                    outside[parent] = describe(parent)
+                state = outside[parent]
+            tag, distance = state[0], state[1] + 1
+        elif revision.parents:
+            tag, distance = describe(revision.node)
+        else:
+            # A root commit, with no tag reachable.
+            tag, distance = None, 1
+
+        if revision.child_count:
+            states[revision.node] = [tag, distance, revision.child_count]
+        yield revision.node, tag, distance
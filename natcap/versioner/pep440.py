@@ -0,0 +1,265 @@
+"""
+Parsing, comparison and ordering of PEP 440 version strings.
+
+``parse()`` turns a version string, or a tag such as 'v2.3', into a Version
+whose ``key`` orders versions as PEP 440 does.  Parsed versions are cached
+and their strings interned, so sorting tens of thousands of tags costs one
+regular expression match per distinct tag.  Strings that aren't PEP 440
+versions (e.g. 'null' or 'release-candidate') are ordered below every
+version by ``sort_key()``, so any list of tags can be sorted.
+"""
+from __future__ import absolute_import
+import re
+
+from six.moves import intern
+
+# The version pattern of PEP 440, as used by the ``packaging`` library.
+_VERSION_PATTERN = re.compile(r"""
+    ^\s*v?
+    (?:
+        (?:(?P<epoch>[0-9]+)!)?
+        (?P<release>[0-9]+(?:\.[0-9]+)*)
+        (?P<pre>
+            [-_\.]?
+            (?P<pre_l>a|b|c|rc|alpha|beta|pre|preview)
+            [-_\.]?
+            (?P<pre_n>[0-9]+)?
+        )?
+        (?P<post>
+            (?:-(?P<post_n1>[0-9]+))
+            |
+            (?:
+                [-_\.]?
+                (?P<post_l>post|rev|r)
+                [-_\.]?
+                (?P<post_n2>[0-9]+)?
+            )
+        )?
+        (?P<dev>
+            [-_\.]?
+            (?P<dev_l>dev)
+            [-_\.]?
+            (?P<dev_n>[0-9]+)?
+        )?
+    )
+    (?:\+(?P<local>[a-z0-9]+(?:[-_\.][a-z0-9]+)*))?
+    \s*$""", re.VERBOSE | re.IGNORECASE)
+
+_PRE_LETTERS = {
+    'a': 'a', 'alpha': 'a',
+    'b': 'b', 'beta': 'b',
+    'c': 'rc', 'rc': 'rc', 'pre': 'rc', 'preview': 'rc',
+}
+_PRE_RANKS = {'a': 0, 'b': 1, 'rc': 2}
+
+# Parsed versions and sort keys by string.  Each is cleared when it grows
+# past _CACHE_SIZE.
+_CACHE = {}
+_SORT_KEYS = {}
+_CACHE_SIZE = 100000
+
+
+class InvalidVersion(ValueError):
+    """
+    Raised when a string is not a PEP 440 version.
+    """
+    pass
+
+
+class Version(object):
+    """
+    A parsed PEP 440 version.
+
+    Versions compare and hash by ``key``, so '1.0' == '1.0.0' == 'v1.0'.
+    """
+    __slots__ = ('string', 'epoch', 'release', 'pre', 'post', 'dev', 'local',
+                 'key')
+
+    def __init__(self, string):
+        """
+        Parameters:
+            string (string): The version string.
+
+        Raises:
+            InvalidVersion: when ``string`` is not a PEP 440 version.
+        """
+        match = _VERSION_PATTERN.match(string)
+        if match is None:
+            raise InvalidVersion('Not a PEP 440 version: %r' % string)
+
+        self.string = intern(str(string))
+        self.epoch = int(match.group('epoch') or 0)
+        self.release = tuple(int(part)
+                             for part in match.group('release').split('.'))
+        self.pre = None
+        if match.group('pre_l'):
+            self.pre = (_PRE_LETTERS[match.group('pre_l').lower()],
+                        int(match.group('pre_n') or 0))
+        self.post = None
+        if match.group('post'):
+            self.post = int(match.group('post_n1') or
+                            match.group('post_n2') or 0)
+        self.dev = None
+        if match.group('dev_l'):
+            self.dev = int(match.group('dev_n') or 0)
+        self.local = None
+        if match.group('local'):
+            self.local = tuple(
+                int(part) if part.isdigit() else part.lower()
+                for part in re.split(r'[-_\.]', match.group('local')))
+        self.key = self._key()
+
+    def _key(self):
+        """Build the tuple that orders versions as PEP 440 does."""
+        release = self.release
+        while len(release) > 1 and release[-1] == 0:
+            release = release[:-1]
+
+        # A dev release of a final release sorts before its pre-releases.
+        if self.pre is None and self.post is None and self.dev is not None:
+            pre = (-1,)
+        elif self.pre is None:
+            pre = (3,)
+        else:
+            pre = (_PRE_RANKS[self.pre[0]], self.pre[1])
+        post = -1 if self.post is None else self.post
+        dev = (1,) if self.dev is None else (0, self.dev)
+        # Numeric local segments sort above alphanumeric ones.
+        local = () if self.local is None else tuple(
+            (1, part, '') if isinstance(part, int) else (0, 0, part)
+            for part in self.local)
+        return (self.epoch, release, pre, post, dev, local)
+
+    @property
+    def is_prerelease(self):
+        """Whether this is a pre-release or a dev release."""
+        return self.pre is not None or self.dev is not None
+
+    def __str__(self):
+        """The normalized form of the version."""
+        parts = []
+        if self.epoch:
+            parts.append('%s!' % self.epoch)
+        parts.append('.'.join(str(part) for part in self.release))
+        if self.pre is not None:
+            parts.append('%s%s' % self.pre)
+        if self.post is not None:
+            parts.append('.post%s' % self.post)
+        if self.dev is not None:
+            parts.append('.dev%s' % self.dev)
+        if self.local is not None:
+            parts.append('+' + '.'.join(str(part) for part in self.local))
+        return ''.join(parts)
+
+    def __repr__(self):
+        return '<Version(%r)>' % self.string
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __le__(self, other):
+        return self.key <= other.key
+
+    def __gt__(self, other):
+        return self.key > other.key
+
+    def __ge__(self, other):
+        return self.key >= other.key
+
+
+def parse(string):
+    """
+    Parse a version string, using the cache of parsed versions.
+
+    Parameters:
+        string (string): The version string, optionally prefixed with 'v'.
+
+    Returns:
+        A Version instance.
+
+    Raises:
+        InvalidVersion: when ``string`` is not a PEP 440 version.
+    """
+    try:
+        return _CACHE[string]
+    except KeyError:
+        pass
+    version = Version(string)
+    if len(_CACHE) >= _CACHE_SIZE:
+        _CACHE.clear()
+    _CACHE[string] = version
+    return version
+
+
+def sort_key(string):
+    """
+    Build a key that orders any strings by the versions they name.
+
+    Strings that are not PEP 440 versions sort below every version, by
+    name.  Equal versions (e.g. '1.0' and 'v1.0') are ordered by name.
+
+    Returns:
+        A tuple.
+    """
+    try:
+        return _SORT_KEYS[string]
+    except KeyError:
+        pass
+    try:
+        key = (1, parse(string).key, string)
+    except InvalidVersion:
+        key = (0, string)
+    if len(_SORT_KEYS) >= _CACHE_SIZE:
+        _SORT_KEYS.clear()
+    _SORT_KEYS[string] = key
+    return key
+
+
+def highest(strings):
+    """
+    Choose the highest version of several strings (see ``sort_key()``).
+
+    Returns:
+        The string, or None if ``strings`` is empty.
+    """
+    strings = list(strings)
+    if not strings:
+        return None
+    return max(strings, key=sort_key)
+
+
+def increment(string):
+    """
+    Build the version of the next release after a tag.
+
+    A pre-release (e.g. '1.0rc1') is followed by the next pre-release of
+    the same kind ('1.0rc2').  Anything else is followed by incrementing
+    the last part of its release ('1.0.post2' and 'v1.0' become '1.1').
+
+    Returns:
+        The normalized version string.
+
+    Raises:
+        InvalidVersion: when ``string`` is not a PEP 440 version.
+    """
+    version = parse(string)
+    parts = []
+    if version.epoch:
+        parts.append('%s!' % version.epoch)
+    if (version.pre is not None and version.post is None and
+            version.dev is None):
+        parts.append('.'.join(str(part) for part in version.release))
+        parts.append('%s%s' % (version.pre[0], version.pre[1] + 1))
+    else:
+        release = version.release[:-1] + (version.release[-1] + 1,)
+        parts.append('.'.join(str(part) for part in release))
+    return ''.join(parts)
@@ -0,0 +1,273 @@
+"""
+Instrumentation of version resolution.
+
+Each stage of resolving a version (importing the version module, looking up
+package metadata, finding the repository, each VCS command, parsing an
+archive, ...) is timed and reported to any registered listeners as a
+``StageRecord``.  Every child process started is reported as a
+``STAGE_SUBPROCESS`` record.
+
+Collect the records of a block of code with ``profile()``::
+
+    with natcap.versioner.profiling.profile() as result:
+        natcap.versioner.get_version('natcap.invest')
+    print(result.summary())
+
+or register a callback with ``add_listener()``.  Listeners are global, so
+they also receive records from other threads.
+
+When the environment variable ``NATCAP_VERSIONER_PROFILE`` is set to ``1``,
+``get_version()`` and ``vcs_version()`` log a one-line summary of the
+stages run in the calling thread to the ``natcap.versioner.profiling``
+logger at the WARNING level.
+
+When there are no listeners, instrumentation costs two list checks per
+stage.
+"""
+from __future__ import absolute_import
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+PROFILE_ENV_VARIABLE = 'NATCAP_VERSIONER_PROFILE'
+
+STAGE_IMPORT = 'import'
+STAGE_METADATA = 'metadata'
+STAGE_DISCOVERY = 'discovery'
+STAGE_CACHE = 'cache'
+STAGE_COMMAND = 'command'
+STAGE_ARCHIVE = 'archive'
+STAGE_SUBPROCESS = 'subprocess'
+
+OUTCOME_OK = 'ok'
+OUTCOME_NOT_FOUND = 'not found'
+OUTCOME_ERROR = 'error'
+
+LOGGER = logging.getLogger('natcap.versioner.profiling')
+LOGGER.setLevel(logging.WARNING)
+
+_listeners = []
+# The listeners of logged_profile() blocks, which only receive the records
+# of their own thread.
+_local = threading.local()
+
+
+def _thread_listeners():
+    """Get the list of listeners of the current thread."""
+    try:
+        return _local.listeners
+    except AttributeError:
+        _local.listeners = []
+        return _local.listeners
+
+
+class StageRecord(collections.namedtuple(
+        'StageRecord', ['stage', 'detail', 'seconds', 'outcome'])):
+    """The timing and outcome of a single resolution stage.
+
+    ``stage`` is one of the ``STAGE_*`` constants, ``detail`` a short
+    description (such as the module imported or the command run),
+    ``seconds`` the wall time taken and ``outcome`` one of the ``OUTCOME_*``
+    constants."""
+    __slots__ = ()
+
+
+class _Stage(object):
+    """The mutable outcome of a stage in progress."""
+    __slots__ = ('outcome',)
+
+    def __init__(self):
+        self.outcome = OUTCOME_OK
+
+
+def add_listener(callback):
+    """
+    Call ``callback(record)`` with the StageRecord of every stage.
+
+    Parameters:
+        callback (callable): The function to call.
+
+    Returns:
+        None.
+    """
+    _listeners.append(callback)
+
+
+def remove_listener(callback):
+    """
+    Stop calling a callback registered with ``add_listener()``.
+
+    Parameters:
+        callback (callable): The function to stop calling.
+
+    Returns:
+        None.
+    """
+    try:
+        _listeners.remove(callback)
+    except ValueError:
+        pass
+
+
+def record(stage_name, detail, seconds, outcome=OUTCOME_OK):
+    """
+    Report a stage that was timed by the caller to every listener.
+
+    Returns:
+        None.
+    """
+    thread_listeners = getattr(_local, 'listeners', None)
+    if not _listeners and not thread_listeners:
+        return
+    stage_record = StageRecord(stage_name, detail, seconds, outcome)
+    for callback in list(_listeners) + list(thread_listeners or ()):
+        callback(stage_record)
+
+
+@contextlib.contextmanager
+def stage(stage_name, detail=None):
+    """
+    Time a stage of version resolution.
+
+    The stage's outcome is OUTCOME_OK unless the block sets ``outcome`` on
+    the yielded object, or raises (OUTCOME_ERROR).
+
+    Example:
+        with profiling.stage(profiling.STAGE_IMPORT, 'pkg.version') as s:
+            ...
+            s.outcome = profiling.OUTCOME_NOT_FOUND
+
+    Parameters:
+        stage_name (string): One of the ``STAGE_*`` constants.
+        detail=None (string or None): A short description of the stage.
+    """
+    current = _Stage()
+    if not _listeners and not getattr(_local, 'listeners', None):
+        yield current
+        return
+
+    start = time.time()
+    try:
+        yield current
+    except BaseException:
+        current.outcome = OUTCOME_ERROR
+        raise
+    finally:
+        record(stage_name, detail, time.time() - start, current.outcome)
+
+
+class Profile(object):
+    """
+    The stage records collected by ``profile()``.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.seconds = None
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, stage_record):
+        with self._lock:
+            self.records.append(stage_record)
+
+    def _finish(self):
+        self.seconds = time.time() - self._start
+
+    @property
+    def subprocess_count(self):
+        """The number of child processes started."""
+        return len([stage_record for stage_record in self.records
+                    if stage_record.stage == STAGE_SUBPROCESS])
+
+    def summary(self, label='natcap.versioner'):
+        """
+        Summarize the records on a single line.
+
+        Each stage's records are combined, in the order each stage first
+        ran, as ``<stage> [x<count>] <milliseconds>ms (<outcome>)``.
+
+        Parameters:
+            label='natcap.versioner' (string): The start of the line.
+
+        Returns:
+            A string.
+        """
+        stages = collections.OrderedDict()
+        for stage_record in self.records:
+            stages.setdefault(stage_record.stage, []).append(stage_record)
+
+        parts = []
+        for stage_name, stage_records in stages.items():
+            outcomes = []
+            for stage_record in stage_records:
+                if stage_record.outcome not in outcomes:
+                    outcomes.append(stage_record.outcome)
+            count = ''
+            if len(stage_records) > 1:
+                count = ' x%s' % len(stage_records)
+            parts.append('%s%s %.1fms (%s)' % (
+                stage_name, count,
+                sum([r.seconds for r in stage_records]) * 1000,
+                ', '.join(outcomes)))
+
+        seconds = self.seconds
+        if seconds is None:
+            seconds = time.time() - self._start
+        return '%s: %.1fms total, %s subprocesses; %s' % (
+            label, seconds * 1000, self.subprocess_count,
+            '; '.join(parts) if parts else 'no stages')
+
+
+@contextlib.contextmanager
+def profile():
+    """
+    Collect the stage records of everything run within the block.
+
+    Yields:
+        A Profile instance.  Its ``seconds`` attribute is set when the block
+        exits.
+    """
+    result = Profile()
+    add_listener(result)
+    try:
+        yield result
+    finally:
+        remove_listener(result)
+        result._finish()
+
+
+@contextlib.contextmanager
+def logged_profile(label):
+    """
+    Log a summary of the block if ``NATCAP_VERSIONER_PROFILE`` is ``1``.
+
+    Only the stages run in the current thread are summarized, and nested
+    blocks in the same thread are only summarized once, by the outermost
+    block.  The summary is logged to ``LOGGER``, whose WARNING level is
+    independent of the ERROR level of the other ``natcap.versioner``
+    loggers; records still propagate to the handlers of their parents.
+
+    Parameters:
+        label (string): The start of the summary line, e.g. the name of
+            the function being profiled.
+    """
+    if (os.environ.get(PROFILE_ENV_VARIABLE) != '1' or
+            getattr(_local, 'active', False)):
+        yield
+        return
+
+    thread_listeners = _thread_listeners()
+    result = Profile()
+    _local.active = True
+    thread_listeners.append(result)
+    try:
+        yield
+    finally:
+        thread_listeners.remove(result)
+        _local.active = False
+        result._finish()
+        LOGGER.warning(result.summary(label))
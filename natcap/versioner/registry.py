@@ -0,0 +1,285 @@
+"""
+A process-wide registry of package versions.
+
+``get_version()`` and ``get_version_info()`` look packages up here before
+importing their version module or reading their distribution metadata.
+Both the versions found and failed lookups are memoized per package, so a
+package's version module is imported (and ``sys.path`` searched for it) at
+most once per process.  The versions of every installed distribution can
+be loaded with a single metadata scan (``load_installed()``), or from a
+JSON manifest written by ``write_manifest()`` (``load_manifest()``).
+Call ``invalidate()`` after installing packages or writing version modules
+in a running process.
+
+Versions found through a VCS are not memoized here: repositories change
+while a process runs, and their snapshots are already cached (see
+``natcap.versioner.cache``).
+"""
+from __future__ import absolute_import
+import io
+import json
+import re
+import threading
+
+_NAME_SEPARATORS = re.compile(r'[-_.]+')
+
+
+def normalize_name(name):
+    """
+    Normalize a distribution name, as PEP 503 does.
+
+    Parameters:
+        name (string): The distribution name (e.g. 'natcap.invest')
+
+    Returns:
+        The normalized name (e.g. 'natcap-invest').
+    """
+    return _NAME_SEPARATORS.sub('-', name).lower()
+
+
+def _installed_distributions():
+    """Scan the metadata of every installed distribution.
+
+    Returns:
+        A dict mapping each normalized distribution name to its version."""
+    try:
+        from importlib import metadata as importlib_metadata
+    except ImportError:
+        try:
+            import importlib_metadata
+        except ImportError:
+            importlib_metadata = None
+
+    versions = {}
+    if importlib_metadata is not None:
+        for distribution in importlib_metadata.distributions():
+            name = distribution.metadata['Name']
+            if name:
+                # The first distribution on sys.path is the one imported.
+                versions.setdefault(normalize_name(name),
+                                    distribution.version)
+        return versions
+
+    import pkg_resources
+    for distribution in pkg_resources.working_set:
+        versions.setdefault(normalize_name(distribution.project_name),
+                            distribution.version)
+    return versions
+
+
+class VersionRegistry(object):
+    """
+    Memoized versions of packages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps a normalized package name to the version info loaded from a
+        # manifest.
+        self._manifest = {}
+        # Maps a version module to its version info, or None if it could
+        # not be imported.
+        self._modules = {}
+        # Maps a normalized distribution name to its version, or None if it
+        # is not installed.
+        self._distributions = {}
+        # Whether _distributions holds every installed distribution.
+        self._scanned = False
+
+    def manifest_info(self, package):
+        """
+        Get the version info of a package from the loaded manifests.
+
+        Returns:
+            A dict with at least a ``version``, or None if no manifest
+            lists the package.
+        """
+        with self._lock:
+            return self._manifest.get(normalize_name(package))
+
+    def module_info(self, full_module, load):
+        """
+        Get the version info of a version module.
+
+        Parameters:
+            full_module (string): The name of the version module.
+            load (callable): ``load(full_module)`` imports the module and
+                returns its version info, or None if it can't be imported.
+                Only called the first time the module is looked up.
+
+        Returns:
+            A dict with at least a ``version``, or None.
+        """
+        with self._lock:
+            if full_module in self._modules:
+                return self._modules[full_module]
+        info = load(full_module)
+        with self._lock:
+            return self._modules.setdefault(full_module, info)
+
+    def metadata_version(self, package, load):
+        """
+        Get the version of an installed distribution.
+
+        Parameters:
+            package (string): The distribution name.
+            load (callable): ``load(package)`` reads the distribution's
+                metadata and returns its version, or None if it is not
+                installed.  Not called after ``load_installed()``.
+
+        Returns:
+            The version string, or None.
+        """
+        key = normalize_name(package)
+        with self._lock:
+            if key in self._distributions:
+                return self._distributions[key]
+            if self._scanned:
+                return None
+        version = load(package)
+        with self._lock:
+            return self._distributions.setdefault(key, version)
+
+    def load_installed(self):
+        """
+        Load the version of every installed distribution in one scan.
+
+        Afterwards, distributions missing from the scan are known not to be
+        installed.
+
+        Returns:
+            The number of distributions found.
+        """
+        versions = _installed_distributions()
+        with self._lock:
+            self._distributions = versions
+            self._scanned = True
+        return len(versions)
+
+    def load_manifest(self, path):
+        """
+        Load package versions from a JSON manifest.
+
+        Packages listed in a manifest are never looked up any other way,
+        until they are invalidated.
+
+        Parameters:
+            path (string): The manifest, as written by ``write_manifest()``.
+                Its ``packages`` object maps each package to its version
+                string or version info dict.
+
+        Returns:
+            The number of packages loaded.
+        """
+        with io.open(path, encoding='utf-8') as manifest_file:
+            packages = json.load(manifest_file)['packages']
+        manifest = {}
+        for package, info in packages.items():
+            if not isinstance(info, dict):
+                info = {'version': info}
+            manifest[normalize_name(package)] = info
+        with self._lock:
+            self._manifest.update(manifest)
+        return len(manifest)
+
+    def invalidate(self, package=None):
+        """
+        Forget the memoized versions of a package, or of every package.
+
+        Parameters:
+            package=None (string or None): The package to forget, including
+                any manifest entry.  If None, everything is forgotten.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            if package is None:
+                self._manifest.clear()
+                self._modules.clear()
+                self._distributions.clear()
+                self._scanned = False
+                return
+
+            self._manifest.pop(normalize_name(package), None)
+            for full_module in list(self._modules):
+                if full_module.startswith(package + '.'):
+                    del self._modules[full_module]
+            self._distributions.pop(normalize_name(package), None)
+            # The scan no longer covers the package.
+            self._scanned = False
+
+
+# The registry used by get_version() and get_version_info().
+REGISTRY = VersionRegistry()
+
+
+def load_installed():
+    """
+    Load the version of every installed distribution into the registry.
+
+    Returns:
+        The number of distributions found.
+    """
+    return REGISTRY.load_installed()
+
+
+def load_manifest(path):
+    """
+    Load package versions from a JSON manifest into the registry.
+
+    Parameters:
+        path (string): See ``VersionRegistry.load_manifest()``.
+
+    Returns:
+        The number of packages loaded.
+    """
+    return REGISTRY.load_manifest(path)
+
+
+def invalidate(package=None):
+    """
+    Forget the memoized versions of a package, or of every package.
+
+    Parameters:
+        package=None (string or None): See ``VersionRegistry.invalidate()``.
+
+    Returns:
+        None.
+    """
+    REGISTRY.invalidate(package)
+
+
+def write_manifest(path, packages=None):
+    """
+    Write a JSON manifest of package versions, for ``load_manifest()``.
+
+    Parameters:
+        path (string): The file to write.
+        packages=None (list or None): The packages to record, with every
+            field ``get_version_info()`` finds for them without a VCS.
+            Packages whose version is not found are left out.  If None, the
+            version of every installed distribution is recorded.
+
+    Returns:
+        The dict of recorded packages.
+    """
+    from . import SCM_DISALLOW
+    from . import VersionNotFound
+    from . import get_version_info
+
+    if packages is None:
+        recorded = _installed_distributions()
+    else:
+        recorded = {}
+        for package in packages:
+            try:
+                recorded[package] = get_version_info(
+                    package, allow_scm=SCM_DISALLOW)
+            except VersionNotFound:
+                continue
+
+    data = json.dumps({'packages': recorded}, indent=2, sort_keys=True)
+    with io.open(path, 'w', encoding='utf-8') as manifest_file:
+        manifest_file.write(u'%s\n' % data)
+    return recorded
@@ -0,0 +1,222 @@
+"""
+Versions of subtrees of a repository, for monorepos.
+
+A subtree is versioned by the commits that touched it, rather than by the
+whole repository:
+
+    * ``node`` is the newest commit touching the subtree.
+    * ``latest_tag`` is the nearest tag of the working copy's commit (the
+      first tagged ancestor found in topological order, and the highest
+      version of its tags), as for the whole repository.
+    * ``tag_distance`` is the number of commits touching the subtree since
+      that tag: ancestors of the working copy's commit that are not
+      ancestors of the tagged commit.  With no tag, it counts every commit
+      touching the subtree, and ``latest_tag`` is 'null'.
+
+A subtree left untouched since a release is thus versioned as that release.
+A commit touches a subtree if it changes a file within it compared to its
+parent.  Merges are not counted, since the changes they bring in are counted
+on the branch they were made on.
+
+The history is read in a single pass (one ``git log`` or ``hg log``) and
+walked once for any number of subtrees.  The walk stops as soon as the
+tag, the newest commit touching each subtree and every commit since the tag
+have been seen, so versioning a subtree changed since a recent release
+doesn't read the rest of the history.  The ``git log`` output is streamed,
+and git is stopped there.
+
+Like ``{latesttag}``, local tags of mercurial (``.hg/localtags``) are
+ignored.
+"""
+from __future__ import absolute_import
+import collections
+import posixpath
+
+from . import pep440
+
+
+class Commit(collections.namedtuple(
+        'Commit', ['node', 'parents', 'tags', 'files'])):
+    """A commit of the history: its full node id, the node ids of its
+    parents, the list of tags on it and the files it changed (relative to
+    the repository root, with ``/`` separators; empty for merges)."""
+    __slots__ = ()
+
+
+# The arguments of the git log pass.  Records start with \x01, fields are
+# separated by \x02 and -z separates file names with NULs.
+GIT_LOG_ARGS = ['log', '--topo-order', '-z', '--name-only', '--no-renames',
+                '--format=%x01%H%x02%P%x02%D', 'HEAD']
+
+# The arguments of the hg log pass, with the same separators.  Tags are
+# separated by \x03.
+HG_LOG_ARGS = ['log', '-r', 'reverse(::.)', '--template',
+               '\\x01{node}\\x02{p1node}\\x02{p2node}\\x02'
+               '{join(tags, "\\x03")}\\x02{join(files, "\\x00")}']
+
+_HG_NULL_NODE = '0' * 40
+
+
+def parse_git_log(lines):
+    """
+    Parse the output of ``git`` with ``GIT_LOG_ARGS``.
+
+    Parameters:
+        lines (iterable): The lines of the output, as they are read (see
+            ``history.stream_lines()``).
+
+    Returns:
+        A generator of Commit, newest first (children before their
+        parents).
+    """
+    record = None
+    for line in lines:
+        parts = line.split('\x01')
+        if record is not None:
+            record += '\n' + parts[0]
+        for part in parts[1:]:
+            if record is not None:
+                yield _parse_git_record(record)
+            record = part
+    if record is not None:
+        yield _parse_git_record(record)
+
+
+def _parse_git_record(record):
+    """Parse a single record of ``parse_git_log()`` into a Commit."""
+    header, _, file_list = record.partition('\0')
+    node, parents, decorations = header.split('\x02')
+    tags = [ref.strip()[len('tag: '):] for ref in decorations.split(',')
+            if ref.strip().startswith('tag: ')]
+    # The NUL-terminated file names are surrounded by newlines.
+    file_list = file_list.strip('\n')
+    parents = parents.split()
+    files = [] if len(parents) > 1 else [
+        name for name in file_list.split('\0') if name]
+    return Commit(node, parents, tags, files)
+
+
+def parse_hg_log(output, local_tags=()):
+    """
+    Parse the output of ``hg`` with ``HG_LOG_ARGS``.
+
+    Parameters:
+        output (string): The output.
+        local_tags=() (iterable): The names of the local tags, which are
+            dropped as ``{latesttag}`` ignores them.
+
+    Returns:
+        A generator of Commit, newest first (children before their
+        parents).
+    """
+    ignored = set(local_tags)
+    ignored.add('tip')
+    for record in output.split('\x01')[1:]:
+        node, parent1, parent2, tags, file_list = record.split('\x02', 4)
+        parents = [parent for parent in (parent1, parent2)
+                   if parent != _HG_NULL_NODE]
+        tags = [tag for tag in tags.split('\x03')
+                if tag and tag not in ignored]
+        files = [] if len(parents) > 1 else [
+            name for name in file_list.split('\0') if name]
+        yield Commit(node, parents, tags, files)
+
+
+def normalize_subtree(subtree):
+    """
+    Normalize a subtree path relative to the repository root.
+
+    Parameters:
+        subtree (string): The path, with ``/`` or ``os.sep`` separators.
+            '' or '.' is the whole repository.
+
+    Returns:
+        The path with ``/`` separators and no trailing separator, or '' for
+        the whole repository.
+    """
+    subtree = posixpath.normpath(subtree.replace('\\', '/'))
+    if subtree == '.':
+        return ''
+    return subtree.strip('/')
+
+
+def _touches(files, subtree):
+    """Check whether any of ``files`` is within ``subtree``."""
+    if not subtree:
+        return bool(files)
+    prefix = subtree + '/'
+    for name in files:
+        if name == subtree or name.startswith(prefix):
+            return True
+    return False
+
+
+def subtree_versions(commits, subtrees):
+    """
+    Version subtrees of a history.
+
+    Ancestors are marked as the topologically ordered history is walked:
+    bit 1 marks ancestors of the newest commit and bit 2 ancestors of the
+    tagged commit.  When the tag and the newest commit touching each
+    subtree have been found, and every commit still marked is an ancestor
+    of the tag, nothing older can change a version, so the rest of
+    ``commits`` isn't read.
+
+    Parameters:
+        commits (iterable): The Commits reachable from the working copy,
+            newest first (see ``parse_git_log`` and ``parse_hg_log``).
+        subtrees (list): Paths normalized by ``normalize_subtree()``.
+
+    Returns:
+        A dict mapping each subtree to a tuple of ``(node, latest_tag,
+        tag_distance)``, or to None if no commit touched it.
+    """
+    nodes = dict((subtree, None) for subtree in subtrees)
+    distances = dict((subtree, 0) for subtree in subtrees)
+    remaining = set(subtrees)
+    tag = None
+    marks = None
+    # The number of marks that are bit 1 alone.
+    since_tag = 0
+    for commit in commits:
+        if marks is None:
+            marks = {commit.node: 1}
+            since_tag = 1
+        mark = marks.pop(commit.node, 0)
+        if mark == 1:
+            since_tag -= 1
+        if mark and tag is None and commit.tags:
+            tag = pep440.highest(commit.tags)
+            mark |= 2
+
+        if commit.files:
+            for subtree in subtrees:
+                if not _touches(commit.files, subtree):
+                    continue
+                if subtree in remaining:
+                    nodes[subtree] = commit.node
+                    remaining.discard(subtree)
+                if mark == 1:
+                    distances[subtree] += 1
+
+        if mark:
+            for parent in commit.parents:
+                old_mark = marks.get(parent, 0)
+                new_mark = old_mark | mark
+                if new_mark != old_mark:
+                    marks[parent] = new_mark
+                    if new_mark == 1:
+                        since_tag += 1
+                    elif old_mark == 1:
+                        since_tag -= 1
+        if tag is not None and not remaining and not since_tag:
+            break
+
+    versions = {}
+    for subtree, node in nodes.items():
+        if node is None:
+            versions[subtree] = None
+        else:
+            versions[subtree] = (node, 'null' if tag is None else tag,
+                                 distances[subtree])
+    return versions
@@ -0,0 +1,285 @@
+"""
+An index from commit ids to the tags that point at them.
+
+Repositories with many tags keep them in ``packed-refs``, where git also
+records the commit each annotated tag peels to (the ``^<sha>`` line after
+the tag).  The index maps ``packed-refs`` into memory, reads the tag lines
+and their peeled values without opening any tag object, merges in the
+loose tags under ``refs/tags`` and keeps the result sorted by commit id in
+a single bytes object.  Looking up a commit is then a binary search.
+
+Indexes are cached per repository and only rebuilt when ``packed-refs`` or
+a directory under ``refs/tags`` changes.
+"""
+from __future__ import absolute_import
+import binascii
+import collections
+import hashlib
+import mmap
+import os
+import re
+import threading
+
+# Matches a tag line of packed-refs, and the peeled line following it.
+_PACKED_TAG_PATTERN = re.compile(
+    br'^([0-9a-f]{40}) refs/tags/([^\n]+)\n(?:\^([0-9a-f]{40})\n)?',
+    re.MULTILINE)
+
+# With this trait, every annotated tag in packed-refs has a peeled line,
+# so a tag without one is known to be lightweight.
+_FULLY_PEELED_TRAIT = b' fully-peeled'
+
+_INDEX_CACHE = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+class TagEntry(collections.namedtuple(
+        'TagEntry', ['name', 'sha', 'annotated'])):
+    """A tag pointing at a commit.
+
+    ``name`` is the tag name without ``refs/tags/``, ``sha`` the object the
+    ref points to (the tag object for annotated tags) and ``annotated``
+    whether ``sha`` is a tag object."""
+    __slots__ = ()
+
+
+def _read_packed_tags(packed_refs_path):
+    """Read the tags of a packed-refs file.
+
+    Returns:
+        A tuple of ``(tags, fully_peeled)``.  ``tags`` is a list of
+        ``(name, sha, peeled_sha)`` tuples, where ``peeled_sha`` is None if
+        the file has no peeled line for the tag."""
+    try:
+        packed_refs_file = open(packed_refs_path, 'rb')
+    except (IOError, OSError):
+        return [], True
+
+    with packed_refs_file:
+        try:
+            data = mmap.mmap(packed_refs_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can't be mapped.
+            return [], True
+        try:
+            header_end = data.find(b'\n')
+            header = data[:header_end] if data[:1] == b'#' else b''
+            fully_peeled = _FULLY_PEELED_TRAIT in header
+            tags = [(name.decode('utf-8'), sha.decode('ascii'),
+                     peeled.decode('ascii') if peeled else None)
+                    for sha, name, peeled
+                    in _PACKED_TAG_PATTERN.findall(data)]
+        finally:
+            data.close()
+    return tags, fully_peeled
+
+
+def _read_loose_tags(tags_dir):
+    """Read the loose tag refs under ``tags_dir``.
+
+    Returns:
+        A dict mapping tag name to the sha it points to."""
+    tags = {}
+    for dirpath, _, filenames in os.walk(tags_dir):
+        for filename in filenames:
+            loose_path = os.path.join(dirpath, filename)
+            tag_name = os.path.relpath(loose_path, tags_dir).replace(
+                os.sep, '/')
+            try:
+                with open(loose_path) as ref_file:
+                    value = ref_file.read().strip()
+            except (IOError, OSError):
+                continue
+            if not value.startswith('ref:'):
+                tags[tag_name] = value
+    return tags
+
+
+def _signature(common_dir):
+    """Get a stat signature of the tags of a repository.
+
+    Every change to a tag replaces a file (through a lockfile rename), which
+    updates the modification time of ``packed-refs`` or of the directory
+    holding the loose ref.
+
+    Returns:
+        A tuple that changes whenever the tags may have changed."""
+    signature = []
+    paths = [os.path.join(common_dir, 'packed-refs')]
+    for dirpath, _, _ in os.walk(os.path.join(common_dir, 'refs', 'tags')):
+        paths.append(dirpath)
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            signature.append((path, None))
+            continue
+        signature.append((path, stat_result.st_mtime, stat_result.st_size,
+                          stat_result.st_ino))
+    return tuple(signature)
+
+
+class TagIndex(object):
+    """
+    The tags of a repository, sorted by the commit they point at.
+    """
+
+    def __init__(self, common_dir, peel):
+        """Build the index.
+
+        Parameters:
+            common_dir (string): The repository's common git directory.
+            peel (callable): ``peel(sha)`` returns ``(sha, obj_type,
+                tagger_time)`` for an object, following annotated tags (see
+                ``GitReader.peel``).  Only called, on the first lookup, for
+                loose tags and for packed tags when packed-refs is not
+                fully peeled.
+        """
+        packed_tags, fully_peeled = _read_packed_tags(
+            os.path.join(common_dir, 'packed-refs'))
+        tags = dict((name, (sha, peeled)) for name, sha, peeled
+                    in packed_tags)
+        loose_tags = _read_loose_tags(
+            os.path.join(common_dir, 'refs', 'tags'))
+        for name, sha in loose_tags.items():
+            tags[name] = (sha, None)
+
+        self.refs = dict((name, value[0]) for name, value in tags.items())
+        self.fingerprint = hashlib.sha1(''.join(
+            '%s %s\n' % item for item in sorted(self.refs.items())).encode(
+                'utf-8')).hexdigest()
+
+        self._tags = tags
+        self._unpeeled = set(loose_tags)
+        if not fully_peeled:
+            self._unpeeled.update(tags)
+        self._peel = peel
+        self._commits = None
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _sorted(self):
+        """Sort the tags by commit, peeling any tags that need it.
+
+        Peeling reads objects, so it's deferred until the first lookup;
+        ``refs`` and ``fingerprint`` are available without it.
+
+        Returns:
+            A tuple of ``(commits, entries)``: the concatenated 20-byte
+            commit ids and the TagEntry of each."""
+        with self._lock:
+            if self._entries is None:
+                entries = []
+                for name, (sha, peeled) in self._tags.items():
+                    if peeled is not None:
+                        entries.append((peeled, name, sha, True))
+                    elif name not in self._unpeeled:
+                        entries.append((sha, name, sha, False))
+                    else:
+                        commit_sha, _, tagger_time = self._peel(sha)
+                        entries.append((commit_sha, name, sha,
+                                        tagger_time is not None))
+                entries.sort()
+                self._commits = b''.join(
+                    binascii.unhexlify(entry[0]) for entry in entries)
+                self._entries = [TagEntry(name, sha, annotated)
+                                 for _, name, sha, annotated in entries]
+            return self._commits, self._entries
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _first(self, binsha):
+        """Find the position of the first entry at or after ``binsha``.
+
+        Returns:
+            A tuple of ``(position, commits, entries)``."""
+        commits, entries = self._sorted()
+        low = 0
+        high = len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if commits[20 * middle:20 * middle + 20] < binsha:
+                low = middle + 1
+            else:
+                high = middle
+        return low, commits, entries
+
+    def tags_for(self, sha):
+        """
+        Find the tags pointing at a commit.
+
+        Parameters:
+            sha (string): The hex sha of the commit.
+
+        Returns:
+            A list of TagEntry, sorted by name.  Empty if the commit is not
+            tagged.
+        """
+        binsha = binascii.unhexlify(sha)
+        position, commits, entries = self._first(binsha)
+        tags = []
+        while (position < len(entries) and
+               commits[20 * position:20 * position + 20] == binsha):
+            tags.append(entries[position])
+            position += 1
+        return tags
+
+    def __contains__(self, sha):
+        binsha = binascii.unhexlify(sha)
+        position, commits, entries = self._first(binsha)
+        return (position < len(entries) and
+                commits[20 * position:20 * position + 20] == binsha)
+
+    def commits(self):
+        """
+        List the tagged commits.
+
+        Returns:
+            A list of hex shas, in sorted order and without duplicates.
+        """
+        commits, entries = self._sorted()
+        tagged = []
+        for position in range(len(entries)):
+            binsha = commits[20 * position:20 * position + 20]
+            if not tagged or tagged[-1] != binsha:
+                tagged.append(binsha)
+        return [binascii.hexlify(binsha).decode('ascii')
+                for binsha in tagged]
+
+
+def load(common_dir, peel):
+    """
+    Get the tag index of a repository, reusing a cached one if the tags have
+    not changed since it was built.
+
+    Parameters:
+        common_dir (string): The repository's common git directory.
+        peel (callable): See ``TagIndex``.
+
+    Returns:
+        A TagIndex.
+    """
+    key = os.path.abspath(common_dir)
+    signature = _signature(key)
+    with _INDEX_CACHE_LOCK:
+        cached = _INDEX_CACHE.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    index = TagIndex(key, peel)
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[key] = (signature, index)
+    return index
+
+
+def clear_cache():
+    """
+    Forget every cached tag index.
+
+    Returns:
+        None.
+    """
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE.clear()
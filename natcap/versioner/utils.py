@@ -1,29 +1,115 @@
 from __future__ import absolute_import
-from . import parse_version
+from . import VERSION_INFO_FIELDS
+from . import parse_version_info
+import ast
 import os
+import time
+
+import six
 
 VERSION_FILE_TEMPLATE = """
 # coding: utf-8
 # file generated by natcap.versioner
 version = {version!r}
+version_info = {{
+{fields}}}
 """
 
 
+def _build_time():
+    """Get the build timestamp as an ISO 8601 UTC string.
+
+    ``SOURCE_DATE_EPOCH`` is honored so that builds can be reproducible."""
+    try:
+        timestamp = int(os.environ['SOURCE_DATE_EPOCH'])
+    except (KeyError, ValueError):
+        timestamp = time.time()
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def format_version_file(version_info):
+    """
+    Build the source of a frozen version module.
+
+    The module has a ``version`` string and a ``version_info`` dict of every
+    field in ``VERSION_INFO_FIELDS``, so ``get_version()`` and
+    ``get_version_info()`` can read them with a single import.
+
+    Parameters:
+        version_info (dict): The fields to record (see
+            ``natcap.versioner.get_version_info()``).  Missing fields are
+            recorded as None.
+
+    Returns:
+        The module source as a string.
+    """
+    fields = ''.join('    %r: %r,\n' % (field, version_info.get(field))
+                     for field in VERSION_INFO_FIELDS)
+    return VERSION_FILE_TEMPLATE.format(version=version_info['version'],
+                                        fields=fields)
+
+
+def _read_version_file(path):
+    """Read the ``version_info`` of an existing frozen version module.
+
+    The module is parsed rather than executed: only literal assignments to
+    ``version_info``, or else to ``version`` or ``__version__``, are read.
+
+    Returns:
+        The dict, or None if the file is missing or has no version."""
+    try:
+        with open(path) as version_file:
+            tree = ast.parse(version_file.read(), path)
+    except (IOError, OSError, SyntaxError, ValueError):
+        return None
+
+    values = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                try:
+                    values[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    continue
+
+    version_info = values.get('version_info')
+    if isinstance(version_info, dict):
+        return version_info
+    for name in ('version', '__version__'):
+        if isinstance(values.get(name), six.string_types):
+            return {'version': values[name]}
+    return None
+
+
 def distutils_keyword(dist, keyword, value):
     """
     This is called when the user provides a `natcap_version` keyword in their
     setup.py:setup().
+
+    Every version field is recorded in the version module (see
+    ``format_version_file()``), along with the build time.  When building
+    from a source distribution, only the version is known, so the other
+    fields are kept from the version module of the source distribution if
+    it was written for the same version.
     """
 
     if not value:
         # If the user didn't use our keyword
         return
 
-    new_version = parse_version()
-    dist.metadata.version = new_version
-
     # Assume the value is the file to write to.
     out_file = os.path.join('.', value)
+
+    version_info = parse_version_info()
+    if version_info['scm'] is None:
+        previous_info = _read_version_file(out_file)
+        if (previous_info is not None and
+                previous_info.get('version') == version_info['version']):
+            version_info.update(previous_info)
+    version_info['build_time'] = _build_time()
+    dist.metadata.version = version_info['version']
+
     with open(out_file, 'w') as version_file:
-        version_file.write(
-            VERSION_FILE_TEMPLATE.format(version=new_version))
+        version_file.write(format_version_file(version_info))
@@ -1,61 +1,494 @@
 from __future__ import absolute_import
+import binascii
+import collections
+import contextlib
+import hashlib
 import logging
 import os
 import re
+import shlex
+import struct
 import subprocess
+import zlib
 import six
 
+from . import archive
+from . import cache
+from . import executors
+from . import gitbatch
+from . import gitreader
+from . import hgclient
+from . import hgreader
+from . import pep440
+from . import history
+from . import profiling
+from . import subtree
+
 LOGGER = logging.getLogger('natcap.versioner.versioning')
 LOGGER.setLevel(logging.ERROR)
 
+BACKEND_CLI = 'query the repository through the VCS command-line tool'
+BACKEND_PYTHON = 'read the repository data directly from disk'
+BACKEND_CMDSERVER = 'send queries to a persistent mercurial command server'
+
+
+class VersionSnapshot(collections.namedtuple(
+        'VersionSnapshot',
+        ['latest_tag', 'tag_distance', 'branch', 'node', 'build_id'])):
+    """An immutable record of every version field of a repository.
+
+    Created by ``VCSQuerier.snapshot()``.  The version strings derived from
+    the fields are computed without any further calls to the VCS."""
+    __slots__ = ()
+
+    @property
+    def release_version(self):
+        """The latest tag if we're on a release tag, otherwise None."""
+        if self.tag_distance == 0:
+            return self.latest_tag
+        return None
+
+    @property
+    def version(self):
+        """The current tag if we're on a known tag, or the dev build ID."""
+        release_version = self.release_version
+        if release_version is None:
+            return 'dev%s' % self.build_id
+        return release_version
+
+    def pep440(self, branch=True, method='post'):
+        """Build the PEP440-compliant version string.
+
+        Parameters:
+            branch=True (bool): Whether to append the branch name to the
+                local version label.
+            method='post' (string): One of 'pre' or 'post'.  With 'pre',
+                the version is a pre-release of the release after the
+                latest tag (see ``pep440.increment()``).
+
+        Returns:
+            The version string."""
+        assert method in ['pre', 'post'], ('Versioning method %s '
+                                           'not valid') % method
+
+        # If we're at a tag, return the tag only.
+        if self.tag_distance == 0:
+            return self.latest_tag
+
+        template_string = "%(latesttag)s.%(method)s%(tagdist)s+n%(node)s"
+        if branch is True:
+            template_string += "-%(branch)s"
+
+        latest_tag = self.latest_tag
+        if method == 'pre':
+            latest_tag = _increment_tag(latest_tag)
+            if pep440.parse(latest_tag).pre is not None:
+                # '.pre' can't follow a pre-release, so count dev releases
+                # of the next one instead (e.g. 1.0rc2.dev3).
+                method = 'dev'
+
+        data = {
+            'tagdist': self.tag_distance,
+            'latesttag': latest_tag,
+            'node': self.node,
+            'branch': self.branch,
+            'method': method,
+        }
+        return template_string % data
+
+
+def _stat_signature(paths):
+    """Build a cheap signature of the state of a list of files.
+
+    Parameters:
+        paths (list): Paths to files or directories.  Missing paths are
+            allowed.
+
+    Returns:
+        A tuple of ``(mtime, inode, size)`` tuples (or None for missing
+        paths) that changes whenever any of the paths change."""
+    signature = []
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            signature.append(None)
+            continue
+        signature.append((getattr(stat_result, 'st_mtime_ns',
+                                  stat_result.st_mtime),
+                          stat_result.st_ino, stat_result.st_size))
+    return tuple(signature)
+
+
+def _tree_dirs(top):
+    """List a directory and every directory below it.
+
+    Parameters:
+        top (string): The directory.  It may be missing.
+
+    Returns:
+        A list of paths, starting with ``top``."""
+    paths = [top]
+    for dirpath, dirnames, _ in os.walk(top):
+        paths.extend(os.path.join(dirpath, name) for name in dirnames)
+    return paths
+
+
+# Maps a directory to its modification time and a dict of {marker: exists}
+# for the repo markers that have been checked in it.  See find_repository().
+_MARKER_CACHE = {}
+
+
+def _markers(dirpath, use_cache=True):
+    """Get the memo of the markers checked in ``dirpath``.
+
+    The memo is emptied when the modification time of the directory
+    changes, as it does when an entry is created in it or removed, or if
+    ``use_cache`` is False."""
+    try:
+        stat_result = os.stat(dirpath)
+        mtime = getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime)
+    except OSError:
+        mtime = None
+    cached = _MARKER_CACHE.get(dirpath)
+    if not use_cache or cached is None or cached[0] != mtime:
+        cached = (mtime, {})
+        _MARKER_CACHE[dirpath] = cached
+    return cached[1]
+
+
+def _has_marker(dirpath, marker, markers=None):
+    """Check whether ``marker`` exists in ``dirpath``, through the memo of
+    ``_markers()`` (which may be passed in when already fetched)."""
+    if markers is None:
+        markers = _markers(dirpath)
+    try:
+        return markers[marker]
+    except KeyError:
+        exists = os.path.exists(os.path.join(dirpath, marker))
+        markers[marker] = exists
+        return exists
+
+
+def _parent_dirs(dirpath):
+    """Yield the absolute path of ``dirpath`` and each of its parents.
+
+    The filesystem root itself is never yielded."""
+    path = os.path.abspath(dirpath)
+    while os.path.dirname(path) != path:
+        yield path
+        path = os.path.dirname(path)
+
+
+def find_repository(dirpath, use_cache=True):
+    """Find the innermost repository containing a directory.
+
+    A single walk up the directory tree checks every repository marker
+    (``.hg_archival.txt``, ``.hg``, ``.git``, which may be a file for
+    worktrees and submodules, and ``.git_archival.txt``) at each level.
+    When several markers are in the same directory, they are preferred in
+    that order.  Archive stamp files that can't be versioned (such as a
+    ``.git_archival.txt`` that ``git archive`` didn't fill in) are skipped,
+    and the walk goes on to the enclosing directories.  What is found in a
+    directory is memoized until its modification time changes.
+
+    Parameters:
+        dirpath (string): The path to start searching from.
+        use_cache=True (bool): If False, every marker is checked again
+            (and the memo updated with what is found).
+
+    Returns:
+        A tuple of ``(scm_class, repo_root)``, or ``(None, None)`` if
+        ``dirpath`` is not within a known repository."""
+    for path in _parent_dirs(dirpath):
+        markers = _markers(path, use_cache=use_cache)
+        for scm_class in DISCOVERY_ORDER:
+            if (_has_marker(path, scm_class.repo_data_location, markers) and
+                    scm_class._is_usable_root(path)):
+                return scm_class, path
+    return None, None
+
+
+def clear_discovery_cache():
+    """Forget every directory checked by ``find_repository()``.  Only
+    needed when markers may change within the resolution of directory
+    modification times."""
+    _MARKER_CACHE.clear()
+
+
+def _loads_archive(dirpath, filename):
+    """Check whether the archive stamp file ``filename`` in ``dirpath`` can
+    be parsed (see ``archive.load()``)."""
+    try:
+        archive.load(dirpath, filename)
+    except (archive.ArchiveError, IOError) as error:
+        LOGGER.debug('Skipping %s: %s', os.path.join(dirpath, filename),
+                     error)
+        return False
+    return True
+
 
 class VCSQuerier(object):
     name = 'VCS'
     is_archive = False
     repo_data_location = ''
 
-    def __init__(self, repo_path):
+    # The number of processes this querier has started, and the number
+    # started to compute the most recent snapshot (0 if it was memoized).
+    process_count = 0
+    last_process_count = 0
+
+    # The executor that runs VCS commands.  If None, the executor returned
+    # by executors.get_default_executor() is used.
+    executor = None
+
+    # The number of seconds a single VCS command may run for, or None for
+    # no limit.
+    command_timeout = executors.DEFAULT_TIMEOUT
+
+    def __init__(self, repo_path, executor=None):
+        """Initialize the querier.
+
+        Parameters:
+            repo_path (string): A path within the repository.
+            executor=None (executors.CommandExecutor or None): The executor
+                to run VCS commands with.  If None, the class attribute
+                ``executor`` is used, falling back to the default executor.
+        """
         repo_root = self._find_repo_root(repo_path)
         if not repo_root:
             raise ValueError('Not within a %s repository: %s' % (
                 self.name, repo_path))
 
         self._repo_path = repo_root
+        self._snapshot = None
+        if executor is not None:
+            self.executor = executor
 
     def _find_repo_root(self, dirpath):
         """Walk up the directory tree and locate the directory that contains
         the repo data."""
-        abs_repo_path = os.path.abspath(dirpath)
-
-        def _locate_data(path):
-            # base case: we can't go up another directory and still haven't
-            # found the repo data.
-            if os.path.dirname(path) == path:
-                return None
-            if os.path.exists(os.path.join(path, self.repo_data_location)):
+        for path in _parent_dirs(dirpath):
+            if _has_marker(path, self.repo_data_location):
                 return path
-            return _locate_data(os.path.dirname(path))
-        return _locate_data(abs_repo_path)
+        return None
+
+    @classmethod
+    def _is_usable_root(cls, dirpath):
+        """Check whether the marker of this repository type in ``dirpath``
+        can be versioned."""
+        return True
+
+    def _get_executor(self):
+        """Get the executor that runs this querier's VCS commands."""
+        if self.executor is not None:
+            return self.executor
+        return executors.get_default_executor()
 
     def _run_command(self, cmd, cwd=None):
-        """Run a subprocess.Popen command.
+        """Run a VCS command through this querier's executor.
 
-        All output to stdout, stdin and stderr will be treated as stdout,
-        captured, and returned.  Commands are executed as shell commands.
+        All output to stdout and stderr will be treated as stdout, captured,
+        and returned.  Commands are run without a shell and are stopped
+        after ``command_timeout`` seconds.
 
         Parameters:
-            cmd (string) - a python string to be executed in the shell.
+            cmd (list or string) - the program and its arguments.  A string
+                is split into arguments with ``shlex.split``.
             cwd=None (string or None) - the string path to the directory on
                 disk to use as the CWD.  If None, the current CWD will be
                 used.
 
         Returns:
-            A python bytestring of the output of the given command."""
-        p = subprocess.check_output(
-            cmd, shell=True, stdin=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=cwd)
-        return p.strip().decode('utf-8')  # output without leading/trailing newlines
+            The output of the command, without leading/trailing whitespace.
+
+        Raises:
+            subprocess.CalledProcessError: when the command exits nonzero.
+            executors.CommandTimeout: when the command times out."""
+        if isinstance(cmd, six.string_types):
+            cmd = shlex.split(cmd)
+        self.process_count += 1
+        with profiling.stage(profiling.STAGE_COMMAND, ' '.join(cmd[:2])):
+            return self._get_executor().run(
+                cmd, cwd=cwd, timeout=self.command_timeout)
+
+    def _stream_command(self, cmd):
+        """Stream the output of a VCS command through this querier's
+        executor (see ``history.stream_lines()``).
+
+        The command runs in the repository and is stopped if it writes
+        nothing for ``command_timeout`` seconds.
+
+        Returns:
+            A generator of the lines of the output."""
+        self.process_count += 1
+        return history.stream_lines(cmd, cwd=self._repo_path,
+                                    executor=self._get_executor(),
+                                    timeout=self.command_timeout)
+
+    def _state_paths(self):
+        """List the files whose stat signature changes with the version.
+
+        Returns:
+            A list of paths, or None if the version can't be cached."""
+        return None
+
+    def _state_signature(self):
+        """Get the stat signature of ``_state_paths()``, or None."""
+        paths = self._state_paths()
+        if paths is None:
+            return None
+        return _stat_signature(paths)
+
+    def _snapshot_fields(self):
+        """Query the VCS for every field of a VersionSnapshot.
+
+        Subclasses may override this to gather the fields more cheaply than
+        through their individual properties.
+
+        Returns:
+            A dict of VersionSnapshot field names to values."""
+        return {
+            'latest_tag': self.latest_tag,
+            'tag_distance': self.tag_distance,
+            'branch': self.branch,
+            'node': self.node,
+            'build_id': self.build_id,
+        }
+
+    def _cache_location(self):
+        """Get the path to the on-disk version cache for this repository.
+
+        Returns:
+            A path, or None if this repository type has no on-disk cache."""
+        return None
+
+    def _cache_key(self):
+        """Build the on-disk cache key for the repository's current state.
+
+        The key must change whenever any version field could change, and
+        must be cheap to compute (no VCS calls).
+
+        Returns:
+            A string, or None if no key can be computed."""
+        return None
+
+    def refresh(self):
+        """Discard any data cached from previous queries."""
+        self._snapshot = None
+
+    def snapshot(self):
+        """Get an immutable snapshot of every version field.
+
+        The snapshot is memoized and only recomputed when the stat signature
+        of the repository's state files (e.g. HEAD, refs, dirstate or the
+        archive metadata) changes, so repeated calls on an unchanged
+        repository cost a few ``stat()`` calls.
+
+        Returns:
+            A VersionSnapshot instance."""
+        signature = self._state_signature()
+        if (signature is not None and self._snapshot is not None and
+                self._snapshot[0] == signature):
+            self.last_process_count = 0
+            return self._snapshot[1]
+
+        self.refresh()
+        process_count = self.process_count
+        snapshot = VersionSnapshot(**self._snapshot_fields())
+        self.last_process_count = self.process_count - process_count
+        if signature is not None:
+            self._snapshot = (signature, snapshot)
+        return snapshot
+
+    def _subtree_history(self):
+        """Read the history of the working copy in a single pass.
+
+        Returns:
+            A generator of subtree.Commit, newest first.  It is closed
+            once the subtrees are versioned, so the history may be read
+            lazily."""
+        raise NotImplementedError(
+            'Subtrees of a %s can not be versioned' % self.name)
+
+    def subtree_snapshots(self, paths):
+        """Take a snapshot of each of several subtrees of the repository.
+
+        A subtree is versioned by the commits that touched it rather than by
+        the whole repository (see ``natcap.versioner.subtree``).  The history
+        is read once for all of the subtrees.
+
+        Parameters:
+            paths (list): Paths to directories (or files) within the
+                repository.
+
+        Returns:
+            A dict mapping each path (as given) to a VersionSnapshot, or to
+            None if no commit touched it.
+
+        Raises:
+            ValueError: when a path is not within the repository."""
+        subtrees = {}
+        for path in paths:
+            relpath = os.path.relpath(os.path.abspath(path), self._repo_path)
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                raise ValueError('Not within %s: %s' % (self._repo_path, path))
+            subtrees[path] = subtree.normalize_subtree(relpath)
+
+        with contextlib.closing(self._subtree_history()) as commits:
+            versions = subtree.subtree_versions(commits,
+                                                set(subtrees.values()))
+        branch = self.branch
+        snapshots = {}
+        for path, name in subtrees.items():
+            if versions[name] is None:
+                snapshots[path] = None
+                continue
+            node, latest_tag, tag_distance = versions[name]
+            node = node[:self.shortnode_len]
+            snapshots[path] = VersionSnapshot(
+                latest_tag=latest_tag, tag_distance=tag_distance,
+                branch=branch, node=node,
+                build_id='%s:%s [%s]' % (tag_distance, latest_tag, node))
+        return snapshots
+
+    def iter_versions(self, rev_range=None):
+        """Stream the version of every commit in a range of history.
+
+        The commits are read from a single VCS process, oldest first (see
+        ``natcap.versioner.history``).
+
+        Parameters:
+            rev_range=None (string or None): The range, in the VCS's own
+                syntax.  If None, every ancestor of the working copy.
+
+        Returns:
+            A generator of ``(node, version)`` tuples, where ``node`` is the
+            full commit id and ``version`` is formatted like
+            ``pep440(branch=False)``."""
+        raise NotImplementedError(
+            'The history of a %s can not be versioned' % self.name)
+
+    def _history_version(self, node, tag, distance, branch=None):
+        """Format the version of a commit found by ``iter_versions()``."""
+        node = node[:self.shortnode_len]
+        if tag is None:
+            tag = 'null'
+        return VersionSnapshot(
+            latest_tag=tag, tag_distance=distance, branch=branch, node=node,
+            build_id='%s:%s [%s]' % (distance, tag, node)).pep440(
+                branch=False)
+
+    def close(self):
+        """Release any resources (such as helper processes) held by this
+        querier.  The base class holds none."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def tag_distance(self):
@@ -81,59 +514,48 @@ class VCSQuerier(object):
     def release_version(self):
         """This function gets the release version.  Returns either the latest tag
         (if we're on a release tag) or None, if we're on a dev changeset."""
-        if self.tag_distance == 0:
-            return self.latest_tag
-        return None
+        return self.snapshot().release_version
 
     @property
     def version(self):
         """This function gets the module's version string.  This will be either the
         dev build ID (if we're on a dev build) or the current tag if we're on a
         known tag.  Either way, the return type is a string."""
-        release_version = self.release_version
-        if release_version is None:
-            return self.build_dev_id(self.build_id)
-        return release_version
+        return self.snapshot().version
 
     def build_dev_id(self, build_id=None):
         """This function builds the dev version string.  Returns a string."""
         if build_id is None:
-            build_id = self.build_id
+            build_id = self.snapshot().build_id
         return 'dev%s' % (build_id)
 
     def pep440(self, branch=True, method='post'):
-        assert method in ['pre', 'post'], ('Versioning method %s '
-                                           'not valid') % method
-
-        # If we're at a tag, return the tag only.
-        if self.tag_distance == 0:
-            return self.latest_tag
+        return self.snapshot().pep440(branch=branch, method=method)
 
-        template_string = "%(latesttag)s.%(method)s%(tagdist)s+n%(node)s"
-        if branch is True:
-            template_string += "-%(branch)s"
-
-        latest_tag = self.latest_tag
-        if method == 'pre':
-            latest_tag = _increment_tag(latest_tag)
+    def async_snapshot(self):
+        """Coroutine counterpart of ``snapshot()``.  Requires python 3.5+.
 
-        data = {
-            'tagdist': self.tag_distance,
-            'latesttag': latest_tag,
-            'node': self.node,
-            'branch': self.branch,
-            'method': method,
-        }
-        version_string = template_string % data
+        VCS commands are run with ``asyncio.create_subprocess_exec``."""
+        from . import aio
+        return aio.snapshot(self)
 
-        return version_string
+    def async_pep440(self, branch=True, method='post'):
+        """Coroutine counterpart of ``pep440()``.  Requires python 3.5+."""
+        from . import aio
+        return aio.pep440(self, branch=branch, method=method)
 
 
 class HgArchive(VCSQuerier):
     name = 'Mercurial Archive'
     shortnode_len = 12
     is_archive = True
-    repo_data_location = '.hg_archival.txt'
+    repo_data_location = archive.HG_ARCHIVAL
+
+    @classmethod
+    def _is_usable_root(cls, dirpath):
+        """Archive stamp files that are malformed or were never filled in
+        can't be versioned."""
+        return _loads_archive(dirpath, cls.repo_data_location)
 
     @property
     def build_id(self):
@@ -169,101 +591,688 @@ class HgArchive(VCSQuerier):
     def node(self):
         return _get_archive_attrs(self._repo_path)['node'][:self.shortnode_len]
 
+    def _state_paths(self):
+        return [os.path.join(self._repo_path, self.repo_data_location)]
+
+    def _snapshot_fields(self):
+        # Parse the archive file once for all fields.
+        attrs = _get_archive_attrs(self._repo_path)
+        tag_distance = attrs.get('latesttagdistance', 0)
+        latest_tag = six.text_type(attrs.get('latesttag', attrs.get('tag')))
+        node = attrs['node'][:self.shortnode_len]
+        return {
+            'latest_tag': latest_tag,
+            'tag_distance': tag_distance,
+            'branch': attrs['branch'],
+            'node': node,
+            'build_id': '%s:%s [%s]' % (tag_distance, latest_tag, node),
+        }
+
+
+class GitArchive(VCSQuerier):
+    """
+    A tree exported by ``git archive`` with a ``.git_archival.txt`` stamp
+    file (see ``archive.GIT_ARCHIVAL_TEMPLATE``) marked ``export-subst``.
+    Every field is read from the stamp file, without running git.
+    """
+    name = 'Git Archive'
+    is_archive = True
+    repo_data_location = archive.GIT_ARCHIVAL
+
+    @classmethod
+    def _is_usable_root(cls, dirpath):
+        """Archive stamp files that are malformed or were never filled in
+        can't be versioned."""
+        return _loads_archive(dirpath, cls.repo_data_location)
+
+    def _attrs(self):
+        return archive.load(self._repo_path, self.repo_data_location)
+
+    @property
+    def build_id(self):
+        return self._snapshot_fields()['build_id']
+
+    @property
+    def tag_distance(self):
+        return self._attrs()['latesttagdistance']
+
+    @property
+    def latest_tag(self):
+        return six.text_type(self._attrs()['latesttag'])
+
+    @property
+    def branch(self):
+        return self._attrs()['branch']
+
+    @property
+    def node(self):
+        # Git nodes are abbreviated as GitRepo.node abbreviates them.
+        return self._attrs()['node'][:8]
+
+    def _state_paths(self):
+        return [os.path.join(self._repo_path, self.repo_data_location)]
+
+    def _snapshot_fields(self):
+        attrs = self._attrs()
+        tag_distance = attrs['latesttagdistance']
+        latest_tag = six.text_type(attrs['latesttag'])
+        node = attrs['node'][:8]
+        # The same build id GitRepo builds from ``git describe``.
+        commit_hash = attrs['abbrev'] if tag_distance == 0 else node
+        return {
+            'latest_tag': latest_tag,
+            'tag_distance': tag_distance,
+            'branch': attrs['branch'],
+            'node': node,
+            'build_id': '%s:%s [%s]' % (tag_distance, latest_tag,
+                                        commit_hash),
+        }
+
 
 class HgRepo(VCSQuerier):
     name = 'Mercurial'
     is_archive = False
     repo_data_location = '.hg'
 
-    def _log_template(self, template_string):
-        hg_call = 'hg log -r . --config ui.report_untrusted=False'
-        cmd = (hg_call + ' --template="%s"') % template_string
+    # ASCII unit separator.  It cannot appear in tag or branch names typed by
+    # a user, so it's a safe delimiter between template fields.
+    field_separator = '\x1f'
+
+    # (attribute, template keyword) pairs fetched by _log_fields().
+    log_fields = [
+        ('latesttag', '{latesttag}'),
+        ('latesttagdistance', '{latesttagdistance}'),
+        ('branch', '{branch}'),
+        ('node', '{node|short}'),
+    ]
+
+    backend = BACKEND_CLI
+    shortnode_len = 12
+
+    def __init__(self, repo_path, backend=None, executor=None):
+        """Initialize the mercurial querier.
+
+        Parameters:
+            repo_path (string): A path within the mercurial repository.
+            backend=None (string or None): One of BACKEND_CLI,
+                BACKEND_CMDSERVER or BACKEND_PYTHON.  If BACKEND_CMDSERVER,
+                a single ``hg serve --cmdserver pipe`` process is started on
+                first use and every later query is sent to it.  The process
+                is shut down by ``close()`` or when the querier is garbage
+                collected.  If BACKEND_PYTHON, the dirstate, changelog and
+                tags are read directly from ``.hg`` and the ``hg``
+                executable is only called when the repository uses a
+                feature the reader does not support.  If None, the class
+                attribute ``backend`` is used.
+            executor=None (executors.CommandExecutor or None): See
+                ``VCSQuerier``.  The command server does not use it.
+        """
+        VCSQuerier.__init__(self, repo_path, executor=executor)
+        if backend is not None:
+            assert backend in [BACKEND_CLI, BACKEND_CMDSERVER,
+                               BACKEND_PYTHON], (
+                'Backend %s not valid') % backend
+            self.backend = backend
+        self._log_data = None
+        self._log_signature = None
+        self._server = None
+
+    def _python_log_fields(self):
+        """Compute the ``log_fields`` values by reading ``.hg`` directly.
+
+        Returns:
+            A dict like ``_log_fields()``, or None if the repository uses a
+            feature the reader does not support."""
+        names = [name for name, _ in self.log_fields]
+        try:
+            fields = hgreader.HgReader(self._repo_path).describe()
+        except (hgreader.UnsupportedRepository, IOError, OSError,
+                struct.error, zlib.error, IndexError) as error:
+            # Malformed data is left for hg to report.
+            LOGGER.debug('Falling back to hg: %s', error)
+            return None
+        if not set(names).issubset(fields):
+            # log_fields was extended with keywords the reader can't compute.
+            return None
+        return dict((name, fields[name]) for name in names)
 
+    def _log_template(self, template_string):
+        if self.backend == BACKEND_CMDSERVER:
+            try:
+                return self._log_template_cmdserver(template_string)
+            except hgclient.CommandServerError as error:
+                # The server has been killed; the next query starts a new
+                # one.
+                LOGGER.debug('Falling back to hg: %s', error)
+                self.close()
+
+        cmd = ['hg', 'log', '-r', '.', '--config', 'ui.report_untrusted=False',
+               '--template', template_string]
         return self._run_command(cmd, cwd=self._repo_path)
 
+    def _log_template_cmdserver(self, template_string):
+        if self._server is None or not self._server.running:
+            self.process_count += 1
+            with profiling.stage(profiling.STAGE_SUBPROCESS, 'hg serve'):
+                self._server = hgclient.HgCommandServer(
+                    self._repo_path, timeout=self.command_timeout)
+
+        args = ['log', '-r', '.', '--config', 'ui.report_untrusted=False',
+                '--template', template_string]
+        with profiling.stage(profiling.STAGE_COMMAND, 'hg log'):
+            returncode, output, error = self._server.runcommand(args)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, 'hg ' + ' '.join(args), output + error)
+        return output.strip()
+
+    def _subtree_history(self):
+        # The whole history is read in one pass, so the command server and
+        # the python reader offer nothing over a single hg process.
+        cmd = ['hg'] + subtree.HG_LOG_ARGS + [
+            '--config', 'ui.report_untrusted=False']
+        return subtree.parse_hg_log(
+            self._run_command(cmd, cwd=self._repo_path),
+            local_tags=self._local_tag_names())
+
+    def _local_tag_names(self):
+        """Read the names of the tags in ``.hg/localtags``."""
+        try:
+            with open(os.path.join(self._repo_path, self.repo_data_location,
+                                   'localtags'), 'rb') as tags_file:
+                data = tags_file.read()
+        except (IOError, OSError):
+            return set()
+        # Each line is '<node> <name>'.
+        names = set()
+        for line in data.splitlines():
+            name = line.partition(b' ')[2].strip()
+            if name:
+                names.add(name.decode('utf-8', 'replace'))
+        return names
+
+    def iter_versions(self, rev_range='::.'):
+        """See ``VCSQuerier.iter_versions()``.
+
+        ``rev_range`` is a revset, such as '0.1::0.2'.  Mercurial computes
+        the latest tag and distance of every revision it logs, so they match
+        ``snapshot()`` at each revision."""
+        if rev_range is None:
+            rev_range = '::.'
+        cmd = ['hg'] + history.HG_LOG_ARGS + [rev_range]
+        for line in self._stream_command(cmd):
+            node, tag, distance, branch = line.split('\x02')
+            yield node, self._history_version(node, tag, int(distance),
+                                              branch)
+
+    def close(self):
+        """Shut down the command server, if one is running."""
+        server = self._server
+        self._server = None
+        if server is not None:
+            server.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Interpreter shutdown may have torn down what close() needs.
+            pass
+
+    def _log_fields(self):
+        """Fetch every field in ``log_fields`` with a single ``hg log``.
+
+        The result is reused by all properties of this querier until the
+        stat signature of the dirstate or changelog changes.  Call
+        ``refresh()`` to force a new query.
+
+        Returns:
+            A dict mapping the attribute names in ``log_fields`` to their
+            string values."""
+        signature = self._state_signature()
+        if (self._log_data is None or signature != self._log_signature) and (
+                self.backend == BACKEND_PYTHON):
+            self._log_data = self._python_log_fields()
+            self._log_signature = signature
+        if self._log_data is None or signature != self._log_signature:
+            separator = repr(self.field_separator)[1:-1]
+            template = separator.join(
+                [keyword for _, keyword in self.log_fields])
+            values = self._log_template(template).split(self.field_separator)
+            if len(values) != len(self.log_fields):
+                raise ValueError(
+                    'Unexpected output from hg log: %r' % values)
+            self._log_data = dict(
+                zip([name for name, _ in self.log_fields], values))
+            self._log_signature = signature
+        return self._log_data
+
+    def refresh(self):
+        """Discard any data cached from previous calls to mercurial."""
+        VCSQuerier.refresh(self)
+        self._log_data = None
+
+    def _state_paths(self):
+        hg_dir = os.path.join(self._repo_path, self.repo_data_location)
+        return [
+            os.path.join(hg_dir, 'dirstate'),
+            os.path.join(hg_dir, 'localtags'),
+            os.path.join(hg_dir, 'store', '00changelog.i'),
+            os.path.join(hg_dir, 'store', '00changelog.n'),
+        ]
+
+    def _cache_location(self):
+        return os.path.join(self._repo_path, self.repo_data_location,
+                            cache.CACHE_FILENAME)
+
+    def _cache_key(self):
+        hg_dir = os.path.join(self._repo_path, self.repo_data_location)
+        try:
+            with open(os.path.join(hg_dir, 'dirstate'), 'rb') as dirstate:
+                header = dirstate.read(64)
+            # The changelog is append-only, so its size changes with every
+            # commit (and therefore every change to .hgtags).
+            changelog_size = os.path.getsize(
+                os.path.join(hg_dir, 'store', '00changelog.i'))
+        except (IOError, OSError):
+            return None
+
+        # Both dirstate formats start with the working copy's first parent.
+        v2_marker = b'dirstate-v2\n'
+        if header.startswith(v2_marker):
+            header = header[len(v2_marker):]
+        parent = binascii.hexlify(header[:20]).decode('ascii')
+
+        localtags = hashlib.sha1()
+        try:
+            with open(os.path.join(hg_dir, 'localtags'), 'rb') as tags_file:
+                localtags.update(tags_file.read())
+        except (IOError, OSError):
+            pass
+        return 'hg:%s:%s:%s' % (parent, changelog_size,
+                                localtags.hexdigest())
+
     @property
     def build_id(self):
         """Call mercurial with a template argument to get the build ID.  Returns a
         python bytestring."""
-        return self._log_template('{latesttagdistance}:{latesttag} '
-                                  '[{node|short}]')
+        return '{latesttagdistance}:{latesttag} [{node}]'.format(
+            **self._log_fields())
 
     @property
     def tag_distance(self):
         """Call mercurial with a template argument to get the distance to the latest
         tag.  Returns an int."""
-        return int(self._log_template('{latesttagdistance}'))
+        return int(self._log_fields()['latesttagdistance'])
 
     @property
     def latest_tag(self):
         """Call mercurial with a template argument to get the latest tag.  Returns a
         python bytestring."""
-        return self._log_template('{latesttag}')
+        return self._log_fields()['latesttag']
 
     @property
     def branch(self):
         """Get the current branch from hg."""
-        return self._log_template('{branch}')
+        return self._log_fields()['branch']
 
     @property
     def node(self):
-        return self._log_template('{node|short}')
+        return self._log_fields()['node']
 
 
 class GitRepo(VCSQuerier):
     name = 'Git'
     repo_data_location = '.git'
+    backend = BACKEND_CLI
+    shortnode_len = 8
 
-    def __init__(self, repo_path):
-        VCSQuerier.__init__(self, repo_path)
+    def __init__(self, repo_path, backend=None, executor=None):
+        """Initialize the git querier.
+
+        Parameters:
+            repo_path (string): A path within the git repository.
+            backend=None (string or None): One of BACKEND_CLI or
+                BACKEND_PYTHON.  If BACKEND_PYTHON, repository data is read
+                directly from ``.git`` and the ``git`` executable is only
+                called when the repository uses a feature the reader does
+                not support.  If None, the class attribute ``backend`` is
+                used.
+            executor=None (executors.CommandExecutor or None): See
+                ``VCSQuerier``.
+        """
+        VCSQuerier.__init__(self, repo_path, executor=executor)
+        if backend is not None:
+            assert backend in [BACKEND_CLI, BACKEND_PYTHON], (
+                'Backend %s not valid') % backend
+            self.backend = backend
         self._tag_distance = None
         self._latest_tag = None
         self._commit_hash = None
+        self._reader = None
+        self._batch_reader = None
 
     def _run_command(self, cmd):
         return VCSQuerier._run_command(self, cmd, self._repo_path)
 
+    def _subtree_history(self):
+        # Streamed, so that git is stopped once the versions are known.
+        cmd = ['git'] + subtree.GIT_LOG_ARGS
+        return subtree.parse_git_log(self._stream_command(cmd))
+
+    def iter_versions(self, rev_range='HEAD'):
+        """See ``VCSQuerier.iter_versions()``.
+
+        ``rev_range`` is anything ``git rev-list`` accepts as a single
+        argument, such as '0.1..0.2' (which excludes 0.1 itself)."""
+        if rev_range is None:
+            rev_range = 'HEAD'
+        cmd = ['git'] + history.GIT_REV_LIST_ARGS + [rev_range]
+        revisions = history.parse_rev_list(self._stream_command(cmd))
+        for node, tag, distance in history.walk(revisions,
+                                                self._describe_commit):
+            yield node, self._history_version(node, tag, distance)
+
+    def _describe_commit(self, sha):
+        """Find the nearest tag of a commit and its distance from it.
+
+        Returns:
+            A tuple of ``(tag, distance)``.  If no tag is reachable, ``tag``
+            is None and ``distance`` is the number of commits reachable from
+            ``sha``."""
+        if self.backend == BACKEND_PYTHON:
+            try:
+                return self._get_reader().describe(sha)
+            except (gitreader.UnsupportedRepository, IOError,
+                    OSError) as error:
+                LOGGER.debug('Falling back to git for describe: %s', error)
+
+        tag, distance, _ = self._parse_describe(self._run_command(
+            ['git', 'describe', '--tags', '--long', '--always', sha]))
+        if tag is None:
+            distance = int(self._run_command(
+                ['git', 'rev-list', '--count', sha]))
+        return tag, distance
+
+    def _get_batch_reader(self):
+        """Get the reader whose objects are read by a ``git cat-file
+        --batch`` process, starting the process on first use."""
+        reader = self._batch_reader
+        if reader is None or not reader.cat_file.running:
+            self.process_count += 1
+            with profiling.stage(profiling.STAGE_SUBPROCESS, 'git cat-file'):
+                cat_file = gitbatch.CatFile(self._repo_path,
+                                            timeout=self.command_timeout)
+            try:
+                reader = gitbatch.BatchReader(
+                    gitreader.find_git_dir(self._repo_path), cat_file)
+            except Exception:
+                cat_file.close()
+                raise
+            self._batch_reader = reader
+        return reader
+
+    def versions_for(self, commits):
+        """Get the version of each of many commits.
+
+        Objects are read through a single ``git cat-file --batch`` process,
+        which is kept open until ``close()``, or from disk with
+        BACKEND_PYTHON (where the process is only started for names that
+        need git to be understood).  Describing a commit reuses the work
+        done for its described ancestors (see
+        ``gitreader.GitReader.describe_many()``).  If git can't be run or
+        stops answering, each commit is described with ``git describe``.
+
+        Parameters:
+            commits (iterable): Commit ids, full or abbreviated, or any
+                other revision names.
+
+        Returns:
+            A list of version strings formatted like ``pep440(branch=False)``
+            at each commit, in the order of ``commits``.  The version of a
+            name that is not a commit of the repository is None."""
+        names = list(commits)
+        try:
+            if self.backend == BACKEND_PYTHON:
+                reader = self._get_reader()
+                shas = [self._python_resolve(name) for name in names]
+            else:
+                reader = self._get_batch_reader()
+                shas = [reader.resolve(name) for name in names]
+            described = iter(reader.describe_many(
+                [sha for sha in shas if sha is not None]))
+        except (gitreader.UnsupportedRepository, gitbatch.CatFileError,
+                IOError, OSError) as error:
+            LOGGER.debug('Falling back to git for describe: %s', error)
+            # A process that stopped answering is restarted on next use.
+            self.close()
+            shas = [self._resolve_commit(name) for name in names]
+            described = (self._describe_commit(sha)
+                         for sha in shas if sha is not None)
+
+        versions = []
+        for sha in shas:
+            if sha is None:
+                versions.append(None)
+            else:
+                tag, distance = next(described)
+                versions.append(self._history_version(sha, tag, distance))
+        return versions
+
+    def _python_resolve(self, name):
+        """Find the full sha of the commit ``name`` refers to, or None,
+        reading from disk unless git is needed to understand the name."""
+        try:
+            return self._get_reader().resolve(name)
+        except gitreader.UnsupportedRepository:
+            return self._get_batch_reader().resolve(name)
+
+    def _resolve_commit(self, name):
+        """Find the full sha of the commit ``name`` refers to, or None."""
+        try:
+            return self._run_command(
+                ['git', 'rev-parse', '--verify', '--quiet',
+                 '%s^{commit}' % name])
+        except subprocess.CalledProcessError:
+            return None
+
+    def close(self):
+        """Shut down the ``git cat-file`` process, if one is running."""
+        reader = self._batch_reader
+        self._batch_reader = None
+        if reader is not None:
+            reader.cat_file.close()
+
+    def _get_reader(self):
+        """Get the on-disk reader for this repository."""
+        if self._reader is None:
+            self._reader = gitreader.GitReader(
+                gitreader.find_git_dir(self._repo_path))
+        return self._reader
+
+    def _read_head(self):
+        """Read HEAD from disk, falling back to ``git rev-parse``.
+
+        Reading HEAD and its ref is only a couple of small file reads, so
+        it's done even for BACKEND_CLI.
+
+        Returns:
+            A tuple of ``(branch, sha)``.  ``branch`` is 'HEAD' when HEAD is
+            detached, as reported by ``git rev-parse --abbrev-ref HEAD``.
+
+        Raises:
+            IOError: when HEAD points to a branch with no commits."""
+        try:
+            refname, sha = self._get_reader().read_head()
+        except (gitreader.UnsupportedRepository, IOError, OSError) as error:
+            LOGGER.debug('Falling back to git for HEAD: %s', error)
+            try:
+                sha, branch = self._run_command(
+                    ['git', 'rev-parse', 'HEAD', '--abbrev-ref',
+                     'HEAD']).split()
+            except (subprocess.CalledProcessError, ValueError):
+                raise IOError('Could not detect current branch')
+            return branch, sha
+
+        if sha is None:
+            raise IOError('Could not detect current branch')
+        if refname is None:
+            return 'HEAD', sha
+        if refname.startswith('refs/heads/'):
+            refname = refname[len('refs/heads/'):]
+        return refname, sha
+
+    def _python_describe(self):
+        sha = self._read_head()[1]
+        reader = self._get_reader()
+        tag_name, distance = reader.describe(sha)
+        if tag_name is None:
+            self._set_described(None, None, reader.abbreviate(sha),
+                                count=distance)
+        else:
+            self._set_described(tag_name, distance, reader.abbreviate(sha))
+
+    @staticmethod
+    def _parse_describe(data):
+        """Parse the output of ``git describe --tags --long --always``.
+
+        Returns:
+            A tuple of ``(tag, distance, abbrev)``.  ``tag`` and
+            ``distance`` are None when no tag is reachable, in which case
+            ``--always`` makes git print just the abbreviated commit id."""
+        match = _DESCRIBE_PATTERN.match(data)
+        if match is None:
+            return None, None, data
+        return match.group(1), int(match.group(2)), match.group(3)
+
+    def _set_described(self, tag, distance, abbrev, count=None):
+        """Record a parsed describe result (see ``_parse_describe``).
+
+        ``count`` is the number of commits reachable from HEAD, and is only
+        needed when no tag is reachable."""
+        if tag is None:
+            self._latest_tag = 'null'
+            self._tag_distance = count
+            self._commit_hash = abbrev
+        elif distance == 0:
+            self._latest_tag = tag
+            self._tag_distance = 0
+            self._commit_hash = abbrev
+        else:
+            self._latest_tag = tag
+            self._tag_distance = distance
+            self._commit_hash = self.node
+
     @property
     def branch(self):
-        branch_cmd = 'git branch'
-        current_branches = self._run_command(branch_cmd)
-        for line in current_branches.split('\n'):
-            if line.startswith('* '):
-                return line.replace('* ', '').strip()
-        raise IOError('Could not detect current branch')
+        """Get the current branch, or 'HEAD' if HEAD is detached."""
+        return self._read_head()[0]
 
     def _describe_current_rev(self):
         self._tag_distance = None
         self._latest_tag = None
         self._commit_hash = None
 
-        current_branch = self.branch
+        if self.backend == BACKEND_PYTHON:
+            try:
+                return self._python_describe()
+            except gitreader.UnsupportedRepository as error:
+                LOGGER.debug('Falling back to git for describe: %s', error)
+
+        # --long always includes the distance and abbreviated node, so tags
+        # containing '-' parse unambiguously.  --always prints the node even
+        # when there are no tags, so a failure means there are no commits.
         try:
-            data = self._run_command('git describe --tags')
+            data = self._run_command(
+                ['git', 'describe', '--tags', '--long', '--always'])
         except subprocess.CalledProcessError:
+            raise IOError('Could not describe HEAD: no commits')
+
+        tag, distance, abbrev = self._parse_describe(data)
+        count = None
+        if tag is None:
             # when there are no tags
-            self._latest_tag = 'null'
+            count = self._graph_ancestor_count()
+            if count is None:
+                count = int(self._run_command(
+                    ['git', 'rev-list', '--count', 'HEAD']))
+        self._set_described(tag, distance, abbrev, count)
 
-            num_commits_cmd = 'git rev-list %s --count' % current_branch
-            self._tag_distance = self._run_command(num_commits_cmd)
+    def _graph_ancestor_count(self):
+        """Count the commits reachable from HEAD using the commit-graph.
 
-            commit_hash_cmd = 'git log -1 --pretty="format:%h"'
-            self._commit_hash = self._run_command(commit_hash_cmd)
-        else:
-            if '-' not in data:
-                # then we're at a tag
-                self._latest_tag = str(data)
-                self._tag_distance = 0
+        Counting a long history this way is much faster than
+        ``git rev-list --count``, which has to start a process.
 
-                commit_hash_cmd = 'git log -1 --pretty="format:%h"'
-                self._commit_hash = self._run_command(commit_hash_cmd)
-            else:
-                # we're not at a tag, so data has the format:
-                # data = tagname-tagdistange-commit_hash
-                tagname, tag_dist, _commit_hash = data.split('-')
-                self._tag_distance = int(tag_dist)
-                self._latest_tag = tagname
-                self._commit_hash = self.node
+        Returns:
+            The count, or None if the repository has no usable commit-graph.
+        """
+        try:
+            reader = self._get_reader()
+            if reader.commit_graph() is None:
+                return None
+            return reader.ancestor_count(self._read_head()[1])
+        except (gitreader.UnsupportedRepository, IOError, OSError) as error:
+            LOGGER.debug('Not using the commit-graph: %s', error)
+            return None
+
+    def _state_paths(self):
+        try:
+            git_dir = gitreader.find_git_dir(self._repo_path)
+        except gitreader.UnsupportedRepository:
+            return None
+        common_dir = gitreader.find_common_dir(git_dir)
+
+        head_path = os.path.join(git_dir, 'HEAD')
+        paths = [
+            head_path,
+            os.path.join(common_dir, 'packed-refs'),
+            os.path.join(common_dir, 'refs', 'heads'),
+        ]
+        # Tags may be nested (refs/tags/release/1.0).
+        paths.extend(_tree_dirs(os.path.join(common_dir, 'refs', 'tags')))
+        try:
+            with open(head_path) as head_file:
+                head = head_file.read().strip()
+        except (IOError, OSError):
+            return paths
+        if head.startswith('ref:'):
+            # Updating a branch replaces the loose ref file (and its parent
+            # directory's entry) through a lockfile rename.
+            ref_path = os.path.join(
+                common_dir, *head[len('ref:'):].strip().split('/'))
+            paths.extend([ref_path, os.path.dirname(ref_path)])
+        return paths
+
+    def _cache_location(self):
+        try:
+            return os.path.join(gitreader.find_git_dir(self._repo_path),
+                                cache.CACHE_FILENAME)
+        except gitreader.UnsupportedRepository:
+            return None
+
+    def _cache_key(self):
+        try:
+            reader = self._get_reader()
+            refname, sha = reader.read_head()
+            tags = reader.tag_index()
+        except (gitreader.UnsupportedRepository, IOError, OSError):
+            return None
+        if sha is None:
+            return None
+        return 'git:%s:%s:%s' % (refname, sha, tags.fingerprint)
+
+    def _snapshot_fields(self):
+        # Describe the current revision once for all fields.
+        self._describe_current_rev()
+        return {
+            'latest_tag': self._latest_tag,
+            'tag_distance': self._tag_distance,
+            'branch': self.branch,
+            'node': self.node,
+            'build_id': "%s:%s [%s]" % (self._tag_distance, self._latest_tag,
+                                        self._commit_hash),
+        }
 
     @property
     def build_id(self):
@@ -283,7 +1292,7 @@ class GitRepo(VCSQuerier):
 
     @property
     def node(self):
-        return self._run_command('git rev-parse HEAD').strip()[:8]
+        return self._read_head()[1][:8]
 
     @property
     def is_archive(self):
@@ -291,14 +1300,21 @@ class GitRepo(VCSQuerier):
         return False
 
 
+# The repository types checked by find_repository(), in order of preference.
+# Git repositories commit an unfilled .git_archival.txt, so .git is preferred
+# over it.
+DISCOVERY_ORDER = [HgArchive, HgRepo, GitRepo, GitArchive]
+
+_DESCRIBE_PATTERN = re.compile(r'^(.*)-([0-9]+)-g([0-9a-f]+)$')
+
+
 def _increment_tag(version_string):
-    assert len(re.findall('([0-9].?)+', version_string)) >= 1, (
-        'Version string must be a release')
+    """Build the version of the release after a tag (see
+    ``pep440.increment()``).
 
-    # increment the minor version number and not the update num.
-    tag = [int(s) for s in version_string.split('.')]
-    tag[-1] += 1
-    return '.'.join([str(i) for i in tag])
+    Raises:
+        pep440.InvalidVersion: when the tag is not a PEP 440 version."""
+    return pep440.increment(version_string)
 
 
 def _get_archive_attrs(archive_path):
@@ -307,9 +1323,10 @@ def _get_archive_attrs(archive_path):
     repo root.  If this is the case, we can fetch relevant build information
     from this file that we might normally be able to get directly from hg.
 
+    The file is only parsed again when it changes (see
+    ``archive.load()``).
+
     Parameters:
-        attr (string): The archive attr to fetch.  One of
-        "repo"|"node"|"branch"|"latesttag"|"latesttagdistance"|"changessincelatesttag"
         archive_path (string): The path to the mercurial archive.
             The .hg_archival.txt file must exist right inside this directory.
 
@@ -318,20 +1335,5 @@ def _get_archive_attrs(archive_path):
 
     Raises:
         IOError when the .hg_archival.txt file cannot be found.
-        KeyError when `attr` is not in .hg_archival.txt
     """
-    archival_filepath = os.path.join(archive_path, '.hg_archival.txt')
-    attributes = {}
-    with open(archival_filepath) as archival_file:
-        for line in archival_file:
-            attr_name, value = line.strip().split(': ')
-
-            # Try to cast the attribute to an int (since it might be a
-            # revision number).  If it doesn't cast, leave it as a string.
-            try:
-                 value = int(value)
-            except ValueError:
-                pass
-            attributes[attr_name] = value
-
-    return attributes
+    return archive.load(archive_path, archive.HG_ARCHIVAL)
@@ -20,11 +20,14 @@ setup(
     entry_points="""
         [distutils.setup_keywords]
         natcap_version = natcap.versioner.utils:distutils_keyword
+
+        [console_scripts]
+        natcap-versioner = natcap.versioner.cli:main
     """,
     zip_safe=True,
     keywords='hg mercurial git versioning natcap',
     test_suite='nose.collector',
-    install_requires=['six'],
+    install_requires=['six', 'futures; python_version < "3"'],
     classifiers=[
         'Intended Audience :: Developers',
         'Development Status :: 4 - Beta',
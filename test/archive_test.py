@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ArchiveMetadataTest(unittest.TestCase):
+    def setUp(self):
+        """Set up ``self.workspace`` as a new temp folder."""
+        from natcap.versioner import archive
+        archive.clear_cache()
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temp folder self.workspace."""
+        from natcap.versioner import archive
+        shutil.rmtree(self.workspace)
+        archive.clear_cache()
+
+    def _write(self, filename, contents):
+        """Replace ``filename`` in the workspace with ``contents``."""
+        path = os.path.join(self.workspace, filename)
+        if os.path.exists(path):
+            os.remove(path)
+        with open(path, 'w') as metadata_file:
+            metadata_file.write(contents)
+
+    def test_hg_archival(self):
+        """Versioner - Archive: values may contain ': '."""
+        from natcap.versioner import archive
+        self._write(archive.HG_ARCHIVAL,
+                    'repo: 1234\nnode: 0123456789abcdef\n'
+                    'branch: fix: a colon\nlatesttag: 0.4\n'
+                    'latesttagdistance: 12\n')
+        attrs = archive.load(self.workspace, archive.HG_ARCHIVAL)
+        self.assertEqual(attrs['branch'], 'fix: a colon')
+        self.assertEqual(attrs['latesttagdistance'], 12)
+        # Only revision counts are numbers, even if a node is all digits.
+        self.assertEqual(attrs['node'], '0123456789abcdef')
+        self.assertEqual(attrs['repo'], '1234')
+
+    def test_hg_archival_tags(self):
+        """Versioner - Archive: the highest of several tags is used."""
+        from natcap.versioner import archive
+        self._write(archive.HG_ARCHIVAL,
+                    'node: 0123456789abcdef\nbranch: default\n'
+                    'tag: 0.10\ntag: 0.9\nlatesttag: 0.2\nlatesttag: 0.3\n'
+                    'latesttagdistance: 1\nlatesttagdistance: 2\n')
+        attrs = archive.load(self.workspace, archive.HG_ARCHIVAL)
+        self.assertEqual(attrs['tag'], '0.10')
+        self.assertEqual(attrs['latesttag'], '0.3')
+        # Other fields given twice take the last value.
+        self.assertEqual(attrs['latesttagdistance'], 2)
+
+    def test_pkg_info(self):
+        """Versioner - Archive: PKG-INFO headers end at the body."""
+        from natcap.versioner import archive
+        self._write(archive.PKG_INFO,
+                    'Metadata-Version: 2.1\nName: example\n'
+                    'Version: 1.2.3\nDescription: first line\n'
+                    '        Version: 9.9\n\nVersion: 0.0\n')
+        attrs = archive.load(self.workspace, archive.PKG_INFO)
+        self.assertEqual(attrs['Version'], '1.2.3')
+        self.assertEqual(attrs['Metadata-Version'], '2.1')
+
+    def test_parsed_once(self):
+        """Versioner - Archive: files are parsed again only when changed."""
+        from natcap.versioner import archive
+        from natcap.versioner import profiling
+        self._write(archive.PKG_INFO, 'Version: 0.1\n')
+        with profiling.profile() as result:
+            for _ in range(3):
+                self.assertEqual(
+                    archive.load(self.workspace, archive.PKG_INFO)['Version'],
+                    '0.1')
+        self.assertEqual(
+            [record.stage for record in result.records].count(
+                profiling.STAGE_ARCHIVE), 1)
+
+        self._write(archive.PKG_INFO, 'Version: 0.22\n')
+        self.assertEqual(
+            archive.load(self.workspace, archive.PKG_INFO)['Version'], '0.22')
+
+    def test_missing_file(self):
+        """Versioner - Archive: a missing file raises IOError."""
+        from natcap.versioner import archive
+        with self.assertRaises(IOError):
+            archive.load(self.workspace, archive.HG_ARCHIVAL)
+
+    def test_git_archival(self):
+        """Versioner - Archive: git stamp files are parsed."""
+        from natcap.versioner import archive
+        node = '0123456789abcdef0123456789abcdef01234567'
+        self._write(archive.GIT_ARCHIVAL,
+                    'node: %s\ndescribe-name: v1.0-rc1-3-g0123456\n'
+                    'ref-names: HEAD -> main, origin/main\n' % node)
+        self.assertEqual(
+            archive.load(self.workspace, archive.GIT_ARCHIVAL),
+            {'node': node, 'latesttag': 'v1.0-rc1',
+             'latesttagdistance': 3, 'abbrev': '0123456', 'branch': 'main'})
+
+        # Without %(describe) support, a tag on the commit is still found.
+        self._write(archive.GIT_ARCHIVAL,
+                    'node: %s\ndescribe-name: $Format:%%(describe)$\n'
+                    'ref-names: tag: 0.2\n' % node)
+        attrs = archive.load(self.workspace, archive.GIT_ARCHIVAL)
+        self.assertEqual(attrs['latesttag'], '0.2')
+        self.assertEqual(attrs['latesttagdistance'], 0)
+        self.assertEqual(attrs['branch'], 'HEAD')
+
+        # Of several tags on the commit, the highest version is used.
+        self._write(archive.GIT_ARCHIVAL,
+                    'node: %s\ndescribe-name: $Format:%%(describe)$\n'
+                    'ref-names: tag: 0.10, tag: 0.9\n' % node)
+        self.assertEqual(
+            archive.load(self.workspace, archive.GIT_ARCHIVAL)['latesttag'],
+            '0.10')
+
+        # Without a tag, the version is counted from 'null'.
+        self._write(archive.GIT_ARCHIVAL,
+                    'node: %s\ndescribe-name: \n'
+                    'ref-names: HEAD -> main\n' % node)
+        attrs = archive.load(self.workspace, archive.GIT_ARCHIVAL)
+        self.assertEqual(attrs['latesttag'], 'null')
+        self.assertEqual(attrs['latesttagdistance'], 1)
+
+        # Unless git couldn't describe the commit.
+        self._write(archive.GIT_ARCHIVAL,
+                    'node: %s\ndescribe-name: $Format:%%(describe)$\n'
+                    'ref-names: HEAD -> main\n' % node)
+        with self.assertRaises(archive.ArchiveError):
+            archive.load(self.workspace, archive.GIT_ARCHIVAL)
+
+        self._write(archive.GIT_ARCHIVAL, archive.GIT_ARCHIVAL_TEMPLATE)
+        with self.assertRaises(archive.ArchiveError):
+            archive.load(self.workspace, archive.GIT_ARCHIVAL)
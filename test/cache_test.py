@@ -0,0 +1,114 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+
+def call_git(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the git repo resides.
+
+    Returns:
+        ``None``.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+class VersionCacheTest(unittest.TestCase):
+    def setUp(self):
+        """Set up ``self.repo_path`` as a git repo with a tagged commit."""
+        self.repo_path = tempfile.mkdtemp()
+        call_git('git init', self.repo_path)
+        call_git('git checkout -B master', self.repo_path)
+        self._commit('first')
+        call_git('git tag 0.1', self.repo_path)
+        self._commit('second')
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, message):
+        """Make an empty commit with ``message``."""
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "%s"' % message, self.repo_path)
+
+    def _disallow_vcs_calls(self):
+        """Make any call to the VCS fail for the rest of the test."""
+        from natcap.versioner import versioning
+
+        def _fail(*args, **kwargs):
+            raise AssertionError('VCS called: %s' % (args,))
+
+        run_command = versioning.VCSQuerier._run_command
+        versioning.VCSQuerier._run_command = _fail
+        self.addCleanup(setattr, versioning.VCSQuerier, '_run_command',
+                        run_command)
+
+    def test_cache_hit_skips_vcs(self):
+        """Versioner - Cache: unchanged checkout is served from the cache."""
+        import natcap.versioner
+        version = natcap.versioner.vcs_version(self.repo_path)
+        cache_path = os.path.join(self.repo_path, '.git',
+                                  'natcap-versioner-cache.json')
+        self.assertTrue(os.path.exists(cache_path))
+
+        self._disallow_vcs_calls()
+        self.assertEqual(natcap.versioner.vcs_version(self.repo_path),
+                         version)
+
+    def test_cache_invalidated_by_commit_and_tag(self):
+        """Versioner - Cache: new commits and tags change the key."""
+        import natcap.versioner
+        version = natcap.versioner.vcs_version(self.repo_path)
+        self.assertTrue(version.startswith('0.1.post1+n'))
+
+        self._commit('third')
+        self.assertTrue(natcap.versioner.vcs_version(
+            self.repo_path).startswith('0.1.post2+n'))
+
+        call_git('git tag 0.2', self.repo_path)
+        self.assertEqual(natcap.versioner.vcs_version(self.repo_path), '0.2')
+
+    def test_clear_cache(self):
+        """Versioner - Cache: clearing removes the cache file."""
+        import natcap.versioner
+        from natcap.versioner import cache
+        natcap.versioner.vcs_version(self.repo_path)
+
+        removed = cache.clear_cache(self.repo_path)
+        self.assertEqual(len(removed), 1)
+        self.assertFalse(os.path.exists(removed[0]))
+        self.assertEqual(cache.clear_cache(self.repo_path), [])
+
+    def test_clear_cache_cli(self):
+        """Versioner - Cache: clear-cache command removes the cache file."""
+        import natcap.versioner
+        from natcap.versioner import cli
+        natcap.versioner.vcs_version(self.repo_path)
+
+        self.assertEqual(cli.main(['clear-cache', self.repo_path]), 0)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.repo_path, '.git', 'natcap-versioner-cache.json')))
+
+    def test_corrupt_cache_ignored(self):
+        """Versioner - Cache: an unreadable cache file is replaced."""
+        import natcap.versioner
+        cache_path = os.path.join(self.repo_path, '.git',
+                                  'natcap-versioner-cache.json')
+        with open(cache_path, 'w') as cache_file:
+            cache_file.write('not json')
+
+        version = natcap.versioner.vcs_version(self.repo_path)
+        self.assertTrue(version.startswith('0.1.post1+n'))
+        self._disallow_vcs_calls()
+        self.assertEqual(natcap.versioner.vcs_version(self.repo_path),
+                         version)
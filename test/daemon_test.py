@@ -0,0 +1,264 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+
+def call_git(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the git repo resides.
+
+    Returns:
+        ``None``.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets required')
+class VersionDaemonTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a git repo and a socket path in a temp folder."""
+        from natcap.versioner import daemon
+        self.workspace = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.workspace, 'repo')
+        os.makedirs(self.repo_path)
+        call_git('git init', self.repo_path)
+        call_git('git checkout -B master', self.repo_path)
+        self._commit('first')
+        call_git('git tag 0.1', self.repo_path)
+        self._commit('second')
+
+        self.socket_path = os.path.join(self.workspace, 'versioner.sock')
+        self.environ = os.environ.get(daemon.SOCKET_ENV_VARIABLE)
+        os.environ[daemon.SOCKET_ENV_VARIABLE] = self.socket_path
+        self.servers = []
+
+    def tearDown(self):
+        """Stop the servers and remove the temp folder."""
+        from natcap.versioner import daemon
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.environ is None:
+            del os.environ[daemon.SOCKET_ENV_VARIABLE]
+        else:
+            os.environ[daemon.SOCKET_ENV_VARIABLE] = self.environ
+        shutil.rmtree(self.workspace)
+
+    def _commit(self, message):
+        """Make an empty commit with ``message``."""
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "%s"' % message, self.repo_path)
+
+    def _serve(self, use_inotify=True):
+        """Start a server on ``self.socket_path`` in a thread.
+
+        Returns:
+            The VersionServer."""
+        from natcap.versioner import daemon
+        server = daemon.VersionServer(self.socket_path,
+                                      use_inotify=use_inotify)
+        self.servers.append(server)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def _wait_for(self, version):
+        """Query the daemon until it answers ``version`` (inotify events
+        are delivered asynchronously)."""
+        from natcap.versioner import daemon
+        deadline = time.time() + 10
+        while True:
+            answer = daemon.query(self.repo_path)
+            if answer == version or time.time() > deadline:
+                self.assertEqual(answer, version)
+                return
+            time.sleep(0.05)
+
+    def _check_invalidation(self):
+        """Versions follow tags and commits."""
+        from natcap.versioner import daemon
+        version = daemon.query(self.repo_path)
+        self.assertTrue(version.startswith('0.1.post1+n'), version)
+
+        call_git('git tag 0.2', self.repo_path)
+        self._wait_for('0.2')
+        self._commit('third')
+        self._wait_for(daemon.query(self.repo_path, use_cache=False))
+        self.assertTrue(
+            daemon.query(self.repo_path).startswith('0.2.post1+n'))
+
+    def test_memoized(self):
+        """Versioner - Daemon: versions are memoized between queries."""
+        import natcap.versioner
+        from natcap.versioner import daemon
+        from natcap.versioner import profiling
+        self._serve()
+        expected = natcap.versioner.vcs_version(self.repo_path,
+                                                use_cache=False)
+        self.assertEqual(daemon.query(self.repo_path), expected)
+
+        # The server runs in this process, so its stages are recorded too.
+        with profiling.profile() as result:
+            self.assertEqual(daemon.query(
+                os.path.join(self.repo_path, '.git')), expected)
+        self.assertEqual(result.records, [])
+
+    def test_invalidated_by_inotify(self):
+        """Versioner - Daemon: changes are noticed through inotify."""
+        self._serve()
+        self._check_invalidation()
+
+    def test_invalidated_by_polling(self):
+        """Versioner - Daemon: changes are noticed without inotify."""
+        self._serve(use_inotify=False)
+        self._check_invalidation()
+
+    def test_nested_tags(self):
+        """Versioner - Daemon: tags in subdirectories of refs/tags are
+        noticed."""
+        from natcap.versioner import daemon
+        os.makedirs(os.path.join(self.repo_path, '.git', 'refs', 'tags',
+                                 'release'))
+        for use_inotify in [True, False]:
+            server = self._serve(use_inotify=use_inotify)
+            version = daemon.query(self.repo_path)
+            self.assertTrue(version.startswith('0.1.post1+n'), version)
+            call_git('git tag release/0.2', self.repo_path)
+            self._wait_for('release/0.2')
+            call_git('git tag -d release/0.2', self.repo_path)
+            server.shutdown()
+            server.server_close()
+            self.servers.remove(server)
+
+    def test_vcs_version_client(self):
+        """Versioner - Daemon: vcs_version asks the daemon first."""
+        import natcap.versioner
+        server = self._serve()
+        version = natcap.versioner.vcs_version(self.repo_path)
+        self.assertEqual(list(server._entries), [self.repo_path])
+        self.assertEqual(
+            version,
+            natcap.versioner.vcs_version(self.repo_path, use_cache=False))
+
+    def test_async_vcs_version_client(self):
+        """Versioner - Daemon: async_vcs_version asks the daemon first."""
+        import asyncio
+        import natcap.versioner
+        server = self._serve()
+        loop = asyncio.new_event_loop()
+        try:
+            version = loop.run_until_complete(
+                natcap.versioner.async_vcs_version(self.repo_path))
+        finally:
+            loop.close()
+        self.assertEqual(list(server._entries), [self.repo_path])
+        self.assertEqual(
+            version,
+            natcap.versioner.vcs_version(self.repo_path, use_cache=False))
+
+    def test_fallback(self):
+        """Versioner - Daemon: without a daemon, versions are resolved."""
+        import natcap.versioner
+        from natcap.versioner import daemon
+        with self.assertRaises(daemon.DaemonError):
+            daemon.query(self.repo_path)
+        self.assertTrue(natcap.versioner.vcs_version(
+            self.repo_path).startswith('0.1.post1+n'))
+
+        os.environ[daemon.SOCKET_ENV_VARIABLE] = ''
+        self.assertEqual(daemon.default_socket_path(), None)
+
+        # Errors are reported by the client, not the daemon.
+        os.environ[daemon.SOCKET_ENV_VARIABLE] = self.socket_path
+        self._serve()
+        with self.assertRaises(natcap.versioner.VersionNotFound):
+            natcap.versioner.vcs_version('/')
+
+    def test_single_server(self):
+        """Versioner - Daemon: one server listens on a socket."""
+        from natcap.versioner import daemon
+
+        # A socket left behind by a killed daemon is replaced.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        self._serve()
+        with self.assertRaises(daemon.DaemonError):
+            daemon.VersionServer(self.socket_path)
+
+    def test_dead_socket(self):
+        """Versioner - Daemon: a socket nothing listens on is skipped until
+        it is replaced."""
+        from natcap.versioner import daemon
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        with self.assertRaises(daemon.DaemonError):
+            daemon.query(self.repo_path)
+
+        connect = socket.socket.connect
+        connections = []
+
+        def counting_connect(client, address):
+            connections.append(address)
+            return connect(client, address)
+        socket.socket.connect = counting_connect
+        try:
+            with self.assertRaises(daemon.DaemonError):
+                daemon.query(self.repo_path)
+            self.assertEqual(connections, [])
+            self._serve()
+            del connections[:]
+            self.assertTrue(
+                daemon.query(self.repo_path).startswith('0.1.post1+n'))
+            self.assertEqual(connections, [self.socket_path])
+        finally:
+            socket.socket.connect = connect
+
+    def test_untrusted_socket(self):
+        """Versioner - Daemon: sockets others can replace are not used."""
+        import natcap.versioner
+        from natcap.versioner import daemon
+        self._serve()
+        expected = daemon.query(self.repo_path)
+        for path, mode in [(self.socket_path, 0o666),
+                           (self.workspace, 0o777)]:
+            original = os.stat(path).st_mode & 0o777
+            os.chmod(path, mode)
+            try:
+                with self.assertRaises(daemon.DaemonError):
+                    daemon.query(self.repo_path)
+                self.assertEqual(natcap.versioner.vcs_version(
+                    self.repo_path, use_cache=False), expected)
+            finally:
+                os.chmod(path, original)
+        self.assertEqual(daemon.query(self.repo_path), expected)
+
+    def test_new_repository(self):
+        """Versioner - Daemon: repositories created later are found."""
+        from natcap.versioner import daemon
+        self._serve()
+        other_path = os.path.join(self.workspace, 'other')
+        os.makedirs(other_path)
+        with self.assertRaises(daemon.DaemonError):
+            daemon.query(other_path)
+
+        call_git('git init', other_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "first"', other_path)
+        call_git('git tag 0.3', other_path)
+        self.assertEqual(daemon.query(other_path), '0.3')
@@ -0,0 +1,166 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+def call_git(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the git repo resides.
+
+    Returns:
+        ``None``.
+
+    Raises:
+        subprocess.CalledProcessError: ``command`` exited with nonzero code.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+class SubprocessExecutorTest(unittest.TestCase):
+    def test_no_shell(self):
+        """Versioner - Executors: arguments are not interpreted by a shell."""
+        from natcap.versioner import executors
+        output = executors.SubprocessExecutor().run(
+            [sys.executable, '-c', 'import sys; print(sys.argv[1])',
+             '$HOME; echo "x"'])
+        self.assertEqual(output, '$HOME; echo "x"')
+
+    def test_hardened_environment(self):
+        """Versioner - Executors: commands run with a hardened environment."""
+        from natcap.versioner import executors
+        output = executors.SubprocessExecutor(
+            environ={'PATH': os.environ.get('PATH', ''),
+                     'GIT_OPTIONAL_LOCKS': '1'}).run(
+            [sys.executable, '-c',
+             'import os; print(os.environ["GIT_OPTIONAL_LOCKS"] + '
+             'os.environ["HGPLAIN"] + os.environ["GIT_PAGER"])'])
+        self.assertEqual(output, '01cat')
+
+    def test_nonzero_exit(self):
+        """Versioner - Executors: a nonzero exit raises CalledProcessError."""
+        from natcap.versioner import executors
+        with self.assertRaises(subprocess.CalledProcessError):
+            executors.SubprocessExecutor().run(
+                [sys.executable, '-c', 'import sys; sys.exit(3)'])
+
+    def test_timeout(self):
+        """Versioner - Executors: slow commands are stopped."""
+        from natcap.versioner import executors
+        with self.assertRaises(executors.CommandTimeout):
+            executors.SubprocessExecutor().run(
+                [sys.executable, '-c', 'import time; time.sleep(30)'],
+                timeout=0.5)
+
+    def test_stream_with_stderr(self):
+        """Versioner - Executors: streaming survives a flood of stderr."""
+        from natcap.versioner import executors
+        lines = executors.SubprocessExecutor().stream(
+            [sys.executable, '-c',
+             'import sys; sys.stderr.write("x" * 1000000); print("a\\nb")'],
+            timeout=30)
+        self.assertEqual(list(lines), ['a', 'b'])
+
+    def test_stream_timeout(self):
+        """Versioner - Executors: silent streamed commands are stopped."""
+        from natcap.versioner import executors
+        lines = executors.SubprocessExecutor().stream(
+            [sys.executable, '-u', '-c',
+             'import time; print("a"); time.sleep(30)'], timeout=0.5)
+        self.assertEqual(next(lines), 'a')
+        with self.assertRaises(executors.CommandTimeout):
+            next(lines)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        """Set up ``self.repo_path`` as a new temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def test_record_and_replay_git(self):
+        """Versioner - Executors: replay a recorded git transcript."""
+        import natcap.versioner
+        from natcap.versioner import executors, versioning
+
+        call_git('git init', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "initial commit"', self.repo_path)
+        call_git('git tag 0.4', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "second commit"', self.repo_path)
+
+        recorder = executors.RecordingExecutor()
+        expected = versioning.GitRepo(
+            self.repo_path, executor=recorder).pep440(branch=False)
+        transcript_path = os.path.join(self.repo_path, 'transcript.json')
+        recorder.save(transcript_path)
+        self.assertTrue(recorder.transcript)
+
+        replay = executors.ReplayExecutor(transcript_path)
+        previous = executors.set_default_executor(replay)
+        old_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = ''  # git can't be found while replaying
+        try:
+            version = natcap.versioner.vcs_version(
+                self.repo_path, use_cache=False)
+        finally:
+            os.environ['PATH'] = old_path
+            executors.set_default_executor(previous)
+        self.assertEqual(version, expected)
+        self.assertEqual(replay.replayed,
+                         [entry['args'] for entry in recorder.transcript])
+
+    def test_replay_hg(self):
+        """Versioner - Executors: replay a hand-written hg transcript."""
+        from natcap.versioner import executors, versioning
+        os.makedirs(os.path.join(self.repo_path, '.hg'))
+        template = '\\x1f'.join(
+            [keyword for _, keyword in versioning.HgRepo.log_fields])
+        replay = executors.ReplayExecutor([{
+            'args': ['hg', 'log', '-r', '.', '--config',
+                     'ui.report_untrusted=False', '--template', template],
+            'returncode': 0,
+            'output': '\x1f'.join(['1.2', '3', 'default', 'abcdef012345']),
+        }])
+        repo = versioning.HgRepo(self.repo_path, executor=replay)
+        self.assertEqual(repo.pep440(), '1.2.post3+nabcdef012345-default')
+
+    def test_replay_stream(self):
+        """Versioner - Executors: streamed commands are replayed too."""
+        from natcap.versioner import executors
+        replay = executors.ReplayExecutor([{
+            'args': ['git', 'rev-list', 'HEAD'],
+            'returncode': 0,
+            'output': 'abc\ndef',
+        }])
+        self.assertEqual(list(replay.stream(['git', 'rev-list', 'HEAD'])),
+                         ['abc', 'def'])
+
+    def test_replay_missing_command(self):
+        """Versioner - Executors: unrecorded commands raise ReplayError."""
+        from natcap.versioner import executors
+        with self.assertRaises(executors.ReplayError):
+            executors.ReplayExecutor([]).run(['git', 'status'])
+
+    def test_replay_failure(self):
+        """Versioner - Executors: recorded failures are raised again."""
+        from natcap.versioner import executors
+        replay = executors.ReplayExecutor([
+            {'args': ['git', 'describe'], 'returncode': 128,
+             'output': 'fatal: no names found'}])
+        with self.assertRaises(subprocess.CalledProcessError):
+            replay.run(['git', 'describe'])
@@ -58,3 +58,15 @@ class GenericVCSTest(unittest.TestCase):
         repo = versioning.VCSQuerier('.')
         with self.assertRaises(NotImplementedError):
             repo.node
+
+    def test_snapshot_immutable(self):
+        """Versioner: check version snapshots cannot be modified."""
+        from natcap.versioner import versioning
+        snapshot = versioning.VersionSnapshot(
+            latest_tag='0.1', tag_distance=2, branch='default',
+            node='abcdef', build_id='2:0.1 [abcdef]')
+        with self.assertRaises(AttributeError):
+            snapshot.latest_tag = '0.2'
+        self.assertEqual(snapshot.release_version, None)
+        self.assertEqual(snapshot.version, 'dev2:0.1 [abcdef]')
+        self.assertEqual(snapshot.pep440(), '0.1.post2+nabcdef-default')
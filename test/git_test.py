@@ -1,11 +1,19 @@
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
 import unittest
 import re
 
 
+def _touch_later(path):
+    """Move the modification time of ``path`` a second ahead, so a change
+    is seen on filesystems with coarse timestamps."""
+    stat_result = os.stat(path)
+    os.utime(path, (stat_result.st_atime, stat_result.st_mtime + 1))
+
+
 def call_git(command, repo_dir):
     """
     Make a call to the shell via ``subprocess.check_call``.
@@ -196,3 +204,795 @@ class GitTest(unittest.TestCase):
         # identifies.
         natcap.versioner.get_version('sys', root=self.repo_path,
                                      allow_scm=natcap.versioner.SCM_ALLOW)
+
+    def test_snapshot_memoized(self):
+        """Versioner - Git: snapshot is reused while the repo is unchanged."""
+        repo = self._set_up_sample_repo()
+        snapshot = repo.snapshot()
+        self.assertEqual(snapshot.latest_tag, '0.1')
+        self.assertEqual(snapshot.tag_distance, 1)
+        self.assertEqual(snapshot.branch, 'master')
+        self.assertEqual(snapshot.pep440(branch=False), repo.pep440(
+            branch=False))
+        self.assertIs(repo.snapshot(), snapshot)
+
+    def test_snapshot_invalidated(self):
+        """Versioner - Git: snapshot is recomputed when HEAD moves."""
+        repo = self._set_up_sample_repo()
+        self.assertEqual(repo.snapshot().tag_distance, 1)
+
+        call_git('git checkout 0.1', self.repo_path)
+        self.assertEqual(repo.snapshot().tag_distance, 0)
+        self.assertEqual(repo.pep440(), '0.1')
+
+        call_git('git checkout master', self.repo_path)
+        call_git('git tag 0.2', self.repo_path)
+        self.assertEqual(repo.pep440(), '0.2')
+
+    def test_detached_head_branch(self):
+        """Versioner - Git: detached HEAD is reported as branch 'HEAD'."""
+        repo = self._set_up_sample_repo()
+        call_git('git checkout 0.1', self.repo_path)
+        self.assertEqual(repo.branch, 'HEAD')
+        self.assertEqual(repo.pep440(), '0.1')
+
+    def test_process_count(self):
+        """Versioner - Git: resolving a version starts at most two gits."""
+        for tag in [True, False]:
+            self.tearDown()
+            self.setUp()
+            repo = self._set_up_sample_repo(tag=tag)
+            repo.pep440(branch=True)
+            self.assertTrue(repo.last_process_count <= 2,
+                            repo.last_process_count)
+
+            # Detached HEAD must not need a branch listing either.
+            call_git('git checkout HEAD~1', self.repo_path)
+            repo.pep440(branch=True)
+            self.assertTrue(repo.last_process_count <= 2,
+                            repo.last_process_count)
+
+            # Memoized snapshots don't start any processes.
+            repo.pep440(branch=True)
+            self.assertEqual(repo.last_process_count, 0)
+
+    def test_tag_with_dash(self):
+        """Versioner - Git: tags containing '-' are parsed correctly."""
+        repo = self._set_up_sample_repo(tag=False)
+        call_git('git tag v1.0-rc1 HEAD~1', self.repo_path)
+        self.assertEqual(repo.latest_tag, 'v1.0-rc1')
+        self.assertEqual(repo.tag_distance, 1)
+
+    def test_async_pep440(self):
+        """Versioner - Git: check coroutine PEP440 matches pep440()."""
+        import asyncio
+        from natcap.versioner import versioning
+        for tag in [True, False]:
+            self.tearDown()
+            self.setUp()
+            repo = self._set_up_sample_repo(tag=tag)
+            for branch in [True, False]:
+                loop = asyncio.new_event_loop()
+                version = loop.run_until_complete(
+                    repo.async_pep440(branch=branch))
+                loop.close()
+                self.assertEqual(
+                    version,
+                    versioning.GitRepo(self.repo_path).pep440(branch=branch))
+
+
+class GitPythonBackendTest(GitTest):
+    def _set_up_sample_repo(self, tag=True):
+        """Create the sample repo, queried through the python backend.
+
+        Parameters:
+            tag=True (bool): whether to include a tag in the repo.
+
+        Returns:
+            ``natcap.versioner.versioning.GitRepo`` instance."""
+        from natcap.versioner import versioning
+        GitTest._set_up_sample_repo(self, tag=tag)
+        return versioning.GitRepo(self.repo_path,
+                                  backend=versioning.BACKEND_PYTHON)
+
+    def _assert_matches_cli(self, repo):
+        """Assert the python backend reports the same data as git."""
+        from natcap.versioner import versioning
+        cli_repo = versioning.GitRepo(self.repo_path,
+                                      backend=versioning.BACKEND_CLI)
+        self.assertEqual(repo.latest_tag, cli_repo.latest_tag)
+        self.assertEqual(int(repo.tag_distance), int(cli_repo.tag_distance))
+        self.assertEqual(repo.node, cli_repo.node)
+        self.assertEqual(repo.branch, cli_repo.branch)
+
+    def test_packed_repo(self):
+        """Versioner - Git python: read refs and objects from packs."""
+        repo = self._set_up_sample_repo()
+        call_git('git gc --aggressive', self.repo_path)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo_path, '.git', 'refs', 'tags', '0.1')))
+        self._assert_matches_cli(repo)
+
+    def test_annotated_tag(self):
+        """Versioner - Git python: annotated tags are peeled to commits."""
+        repo = self._set_up_sample_repo(tag=False)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'tag -a 0.2 -m "annotated" HEAD~2', self.repo_path)
+        self.assertEqual(repo.latest_tag, '0.2')
+        self.assertEqual(repo.tag_distance, 2)
+        call_git('git pack-refs --all', self.repo_path)
+        self._assert_matches_cli(repo)
+
+    def test_detached_head(self):
+        """Versioner - Git python: detached HEAD matches git."""
+        repo = self._set_up_sample_repo()
+        call_git('git checkout 0.1', self.repo_path)
+        self._assert_matches_cli(repo)
+
+    def test_merge_depth(self):
+        """Versioner - Git python: merges are described as git does."""
+        from natcap.versioner import versioning
+        commit = ('GIT_COMMITTER_DATE="%s +0000" git '
+                  '-c user.name="Example Name" '
+                  '-c user.email="name@example.com" ')
+        call_git('git init', self.repo_path)
+        call_git(commit % 1500000600 + 'commit --allow-empty -m "base"',
+                 self.repo_path)
+        call_git('git checkout -b side', self.repo_path)
+        call_git(commit % 1500000900 + 'commit --allow-empty -m "side"',
+                 self.repo_path)
+        call_git('git checkout -', self.repo_path)
+        # The tagged commit is older than its parent, so git walks past
+        # the parent before the tag reaches it, and counts it.
+        call_git(commit % 1500000100 + 'commit --allow-empty -m "tagged"',
+                 self.repo_path)
+        call_git('git tag 0.2', self.repo_path)
+        call_git(commit % 1500001000 + 'merge --no-ff side -m "merge"',
+                 self.repo_path)
+
+        repo = versioning.GitRepo(self.repo_path,
+                                  backend=versioning.BACKEND_PYTHON)
+        self.assertEqual(repo.latest_tag, '0.2')
+        self.assertEqual(repo.tag_distance, 3)
+        self._assert_matches_cli(repo)
+        cli_repo = versioning.GitRepo(self.repo_path,
+                                      backend=versioning.BACKEND_CLI)
+        self.assertEqual(repo.build_id, cli_repo.build_id)
+        self.assertEqual(repo.pep440(), cli_repo.pep440())
+
+    def test_unsupported_repo_falls_back(self):
+        """Versioner - Git python: unsupported features fall back to git."""
+        repo = self._set_up_sample_repo()
+        open(os.path.join(self.repo_path, '.git', 'shallow'), 'w').close()
+        self._assert_matches_cli(repo)
+
+
+class GitManyTest(unittest.TestCase):
+    def setUp(self):
+        """Set up two sample repos in a new temp folder."""
+        self.workspace = tempfile.mkdtemp()
+        self.repo_paths = []
+        for tag in ['0.1', '0.2']:
+            repo_path = os.path.join(self.workspace, tag)
+            os.makedirs(os.path.join(repo_path, 'subdir'))
+            call_git('git init', repo_path)
+            call_git('git -c user.name="Example Name" '
+                     '-c user.email="name@example.com" '
+                     'commit --allow-empty -m "initial commit"', repo_path)
+            call_git('git tag %s' % tag, repo_path)
+            self.repo_paths.append(repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.workspace."""
+        shutil.rmtree(self.workspace)
+
+    def _check_many(self, executor):
+        """Check versions of repos and subdirectories via ``executor``."""
+        import natcap.versioner
+        roots = self.repo_paths + [
+            os.path.join(path, 'subdir') for path in self.repo_paths]
+        versions = natcap.versioner.vcs_version_many(
+            roots, max_workers=2, executor=executor)
+        self.assertEqual(versions, {
+            roots[0]: '0.1',
+            roots[1]: '0.2',
+            roots[2]: '0.1',
+            roots[3]: '0.2',
+        })
+
+    def test_many_thread(self):
+        """Versioner - Git many: versions resolved in threads."""
+        import natcap.versioner
+        self._check_many(natcap.versioner.EXECUTOR_THREAD)
+
+    def test_many_process(self):
+        """Versioner - Git many: versions resolved in processes."""
+        import natcap.versioner
+        self._check_many(natcap.versioner.EXECUTOR_PROCESS)
+
+    def test_many_dedupes_repos(self):
+        """Versioner - Git many: each repository is queried once."""
+        import natcap.versioner
+        queried = []
+        vcs_version = natcap.versioner.vcs_version
+
+        def _recording_vcs_version(root, *args, **kwargs):
+            queried.append(root)
+            return vcs_version(root, *args, **kwargs)
+
+        natcap.versioner.vcs_version = _recording_vcs_version
+        try:
+            natcap.versioner.vcs_version_many(
+                [self.repo_paths[0],
+                 os.path.join(self.repo_paths[0], 'subdir'),
+                 os.path.join(self.repo_paths[0], 'subdir', '..')])
+        finally:
+            natcap.versioner.vcs_version = vcs_version
+        self.assertEqual(queried, [os.path.abspath(self.repo_paths[0])])
+
+    def test_many_errors(self):
+        """Versioner - Git many: errors follow on_error."""
+        import natcap.versioner
+        versions = natcap.versioner.vcs_version_many(
+            [self.repo_paths[0], '/'],
+            on_error=natcap.versioner.ERROR_RETURN)
+        self.assertEqual(versions, {self.repo_paths[0]: '0.1',
+                                    '/': 'UNKNOWN'})
+
+        with self.assertRaises(natcap.versioner.VersionNotFound):
+            natcap.versioner.vcs_version_many(
+                [self.repo_paths[0], '/'],
+                on_error=natcap.versioner.ERROR_RAISE)
+
+    def test_async_vcs_version(self):
+        """Versioner - Git many: versions resolved by coroutines."""
+        import asyncio
+        import natcap.versioner
+
+        loop = asyncio.new_event_loop()
+        versions = loop.run_until_complete(asyncio.gather(*[
+            loop.create_task(natcap.versioner.async_vcs_version(
+                path, use_cache=False)) for path in self.repo_paths]))
+        self.assertEqual(versions, ['0.1', '0.2'])
+        with self.assertRaises(natcap.versioner.VersionNotFound):
+            loop.run_until_complete(natcap.versioner.async_vcs_version('/'))
+        loop.close()
+
+    def test_async_reads_off_loop(self):
+        """Versioner - Git many: coroutines read files in worker threads."""
+        import asyncio
+        import threading
+        import natcap.versioner
+        from natcap.versioner import cache
+        from natcap.versioner import versioning
+
+        threads = []
+        lookup = cache.lookup
+        find_repository = versioning.find_repository
+
+        def recording(function):
+            def wrapper(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return function(*args, **kwargs)
+            return wrapper
+        cache.lookup = recording(lookup)
+        versioning.find_repository = recording(find_repository)
+        try:
+            loop = asyncio.new_event_loop()
+            self.assertEqual(loop.run_until_complete(
+                natcap.versioner.async_vcs_version(self.repo_paths[0])),
+                '0.1')
+            loop.close()
+        finally:
+            cache.lookup = lookup
+            versioning.find_repository = find_repository
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+class GitDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a git repo nested in a mercurial repo in a temp folder."""
+        from natcap.versioner import versioning
+        versioning.clear_discovery_cache()
+        self.workspace = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workspace, '.hg'))
+        self.repo_path = os.path.join(self.workspace, 'inner')
+        os.makedirs(os.path.join(self.repo_path, 'subdir'))
+        call_git('git init', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "initial commit"', self.repo_path)
+        call_git('git tag 0.3', self.repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.workspace."""
+        from natcap.versioner import versioning
+        shutil.rmtree(self.workspace)
+        versioning.clear_discovery_cache()
+
+    def test_innermost_repo(self):
+        """Versioner - Git discovery: the innermost repo is found."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        self.assertEqual(
+            versioning.find_repository(
+                os.path.join(self.repo_path, 'subdir')),
+            (versioning.GitRepo, self.repo_path))
+        self.assertEqual(
+            versioning.find_repository(self.workspace),
+            (versioning.HgRepo, self.workspace))
+        self.assertEqual(
+            natcap.versioner.vcs_version(
+                os.path.join(self.repo_path, 'subdir'), use_cache=False),
+            '0.3')
+
+    def test_worktree(self):
+        """Versioner - Git discovery: a .git file (worktree) is found."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        worktree = os.path.join(self.workspace, 'worktree')
+        call_git('git worktree add --detach %s' % worktree, self.repo_path)
+        self.assertEqual(versioning.find_repository(worktree),
+                         (versioning.GitRepo, worktree))
+        self.assertEqual(
+            natcap.versioner.vcs_version(worktree, use_cache=False), '0.3')
+
+    def test_discovery_memoized(self):
+        """Versioner - Git discovery: directory checks are memoized."""
+        from natcap.versioner import versioning
+        subdir = os.path.join(self.repo_path, 'subdir')
+        versioning.find_repository(subdir)
+
+        # Markers created or removed after a directory was checked are seen
+        # as the modification time of the directory changes.
+        hg_path = os.path.join(subdir, '.hg')
+        os.makedirs(hg_path)
+        _touch_later(subdir)
+        self.assertEqual(versioning.find_repository(subdir),
+                         (versioning.HgRepo, subdir))
+        os.rmdir(hg_path)
+        _touch_later(subdir)
+        self.assertEqual(versioning.find_repository(subdir),
+                         (versioning.GitRepo, self.repo_path))
+
+
+
+class GitArchiveTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a repo with an export-subst stamp file in a temp folder."""
+        from natcap.versioner import archive
+        self.repo_path = tempfile.mkdtemp()
+        call_git('git init', self.repo_path)
+        call_git('git checkout -B master', self.repo_path)
+        with open(os.path.join(self.repo_path, '.git_archival.txt'),
+                  'w') as stamp_file:
+            stamp_file.write(archive.GIT_ARCHIVAL_TEMPLATE)
+        with open(os.path.join(self.repo_path, '.gitattributes'),
+                  'w') as attributes_file:
+            attributes_file.write('.git_archival.txt export-subst\n')
+        git_commit = ('git -c user.name="Example Name" '
+                      '-c user.email="name@example.com" commit ')
+        call_git('git add .git_archival.txt .gitattributes', self.repo_path)
+        call_git(git_commit + '-m "initial commit"', self.repo_path)
+        call_git('git tag 0.1', self.repo_path)
+        call_git(git_commit + '--allow-empty -m "second commit"',
+                 self.repo_path)
+        call_git(git_commit + '--allow-empty -m "third commit"',
+                 self.repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _archive(self, rev):
+        """Export ``rev`` with ``git archive`` and extract it.
+
+        Returns:
+            The path to the extracted tree."""
+        import tarfile
+        call_git('git archive --format=tar --prefix=archive/ '
+                 '-o archive.tar %s' % rev, self.repo_path)
+        tar_path = os.path.join(self.repo_path, 'archive.tar')
+        with tarfile.open(tar_path) as tar:
+            tar.extractall(self.repo_path)
+        os.remove(tar_path)
+        return os.path.join(self.repo_path, 'archive')
+
+    def test_matches_repo(self):
+        """Versioner - Git archive: the stamp matches the repository."""
+        from natcap.versioner import versioning
+        archive_path = self._archive('HEAD')
+        with open(os.path.join(archive_path, '.git_archival.txt')) as stamp:
+            if '$Format:' in stamp.read():
+                self.skipTest('git is too old to fill in %(describe)')
+        archive = versioning.GitArchive(archive_path)
+        self.assertTrue(archive.is_archive)
+        self.assertEqual(archive.snapshot(),
+                         versioning.GitRepo(self.repo_path).snapshot())
+        self.assertEqual(archive.tag_distance, 2)
+        self.assertEqual(archive.branch, 'master')
+        self.assertEqual(archive.process_count, 0)
+
+    def test_at_tag(self):
+        """Versioner - Git archive: an archive of a tag needs no git."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        from natcap.versioner import versioning
+        archive_path = self._archive('0.1')
+        versioning.clear_discovery_cache()
+        self.assertEqual(versioning.find_repository(archive_path),
+                         (versioning.GitArchive, archive_path))
+        with profiling.profile() as result:
+            self.assertEqual(natcap.versioner.vcs_version(archive_path),
+                             '0.1')
+        self.assertEqual(result.subprocess_count, 0)
+
+    def test_unfilled_stamp(self):
+        """Versioner - Git archive: repositories prefer .git to the stamp."""
+        from natcap.versioner import archive
+        from natcap.versioner import versioning
+        versioning.clear_discovery_cache()
+        self.assertEqual(versioning.find_repository(self.repo_path),
+                         (versioning.GitRepo, self.repo_path))
+        with self.assertRaises(archive.ArchiveError):
+            versioning.GitArchive(self.repo_path).snapshot()
+
+    def test_unexpanded_stamp(self):
+        """Versioner - Git archive: an unfilled stamp is not a version."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        # A subdirectory copied out of the repository, stamp and all.
+        copy_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, copy_path)
+        subdir_path = os.path.join(copy_path, 'src')
+        os.makedirs(subdir_path)
+        shutil.copy(os.path.join(self.repo_path, '.git_archival.txt'),
+                    copy_path)
+        versioning.clear_discovery_cache()
+        for root in [copy_path, subdir_path]:
+            self.assertEqual(natcap.versioner.vcs_version(
+                root, on_error=natcap.versioner.ERROR_RETURN,
+                use_cache=False), 'UNKNOWN')
+            with self.assertRaises(natcap.versioner.VersionNotFound):
+                natcap.versioner.vcs_version(root)
+            with self.assertRaises(natcap.versioner.VersionNotFound):
+                natcap.versioner.get_version('natcap.nonexistent_package',
+                                             root=root)
+
+    def test_unexpanded_stamp_in_repo(self):
+        """Versioner - Git archive: an unfilled stamp in a subdirectory
+        doesn't hide the repository."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        copy_path = os.path.join(self.repo_path, 'copy')
+        subdir_path = os.path.join(copy_path, 'src')
+        os.makedirs(subdir_path)
+        shutil.copy(os.path.join(self.repo_path, '.git_archival.txt'),
+                    copy_path)
+        expected = natcap.versioner.vcs_version(self.repo_path,
+                                                use_cache=False)
+        for root in [copy_path, subdir_path]:
+            self.assertEqual(versioning.find_repository(root),
+                             (versioning.GitRepo, self.repo_path))
+            self.assertEqual(
+                natcap.versioner.vcs_version(root, use_cache=False),
+                expected)
+
+
+class GitCommitGraphTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a repo with merges and a commit-graph in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_git('git init', self.repo_path)
+        call_git('git checkout -B master', self.repo_path)
+        for name in ['first', 'second']:
+            self._commit(name)
+        call_git('git tag 0.1', self.repo_path)
+
+        # An ordinary merge and an octopus merge, so that the graph needs
+        # its EDGE chunk.
+        for branch in ['one', 'two', 'three']:
+            call_git('git checkout -q -b %s 0.1' % branch, self.repo_path)
+            self._commit(branch)
+            self._commit(branch + ' again')
+        call_git('git checkout -q master', self.repo_path)
+        self._commit('third')
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'merge -q --no-edit one', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'merge -q --no-edit two three', self.repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, message):
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit -q --allow-empty -m "%s"' % message, self.repo_path)
+
+    def _git_output(self, command):
+        return subprocess.check_output(
+            command, shell=True, cwd=self.repo_path).decode('utf-8').strip()
+
+    def _check_reader(self):
+        """Compare the reader's counts with git's."""
+        from natcap.versioner import gitreader
+        reader = gitreader.GitReader(os.path.join(self.repo_path, '.git'))
+        self.assertNotEqual(reader.commit_graph(), None)
+        head = reader.read_head()[1]
+        self.assertEqual(
+            reader.ancestor_count(head),
+            int(self._git_output('git rev-list --count HEAD')))
+        self.assertEqual(
+            reader.distance(head, self._git_output('git rev-parse one')),
+            int(self._git_output('git rev-list --count one..HEAD')))
+        tag, distance, _ = self._git_output(
+            'git describe --tags --long').rsplit('-', 2)
+        self.assertEqual(reader.describe(head), (tag, int(distance)))
+
+    def test_single_graph(self):
+        """Versioner - Git commit-graph: counts match git."""
+        call_git('git commit-graph write --reachable', self.repo_path)
+        self._check_reader()
+
+    def test_split_chain(self):
+        """Versioner - Git commit-graph: split chains are read."""
+        call_git('git commit-graph write --reachable --split',
+                 self.repo_path)
+        self._commit('fourth')
+        call_git('git commit-graph write --reachable --split=no-merge',
+                 self.repo_path)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.repo_path, '.git', 'objects', 'info', 'commit-graph')))
+        self._check_reader()
+
+    def test_commits_outside_graph(self):
+        """Versioner - Git commit-graph: new commits are read as objects."""
+        call_git('git commit-graph write --reachable', self.repo_path)
+        self._commit('fourth')
+        call_git('git tag 0.2', self.repo_path)
+        self._commit('fifth')
+        self._check_reader()
+
+    def test_without_numpy(self):
+        """Versioner - Git commit-graph: columns decode without NumPy."""
+        from natcap.versioner import commitgraph
+        call_git('git commit-graph write --reachable', self.repo_path)
+        numpy = commitgraph.numpy
+        commitgraph.numpy = None
+        try:
+            self._check_reader()
+        finally:
+            commitgraph.numpy = numpy
+
+    def test_numpy_imported_lazily(self):
+        """Versioner - Git commit-graph: importing doesn't import NumPy."""
+        import sys
+        import natcap.versioner
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(natcap.versioner.__file__))))
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, natcap.versioner.commitgraph; '
+             'print("numpy" in sys.modules)'], cwd=root)
+        self.assertEqual(output.strip(), b'False')
+
+    def test_no_tags_single_process(self):
+        """Versioner - Git commit-graph: untagged count needs no rev-list."""
+        from natcap.versioner import versioning
+        call_git('git tag -d 0.1', self.repo_path)
+        call_git('git commit-graph write --reachable', self.repo_path)
+        repo = versioning.GitRepo(self.repo_path)
+        self.assertEqual(repo.tag_distance,
+                         int(self._git_output('git rev-list --count HEAD')))
+        self.assertEqual(repo.process_count, 1)
+
+
+class GitTagIndexTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a repo with packed and loose tags in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_git('git init', self.repo_path)
+        for name in ['first', 'second', 'third']:
+            call_git('git -c user.name="Example Name" '
+                     '-c user.email="name@example.com" '
+                     'commit -q --allow-empty -m "%s"' % name, self.repo_path)
+        call_git('git tag 0.1 HEAD~2', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'tag -a 0.2 -m "annotated" HEAD~1', self.repo_path)
+        call_git('git pack-refs --all', self.repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _git_output(self, command):
+        return subprocess.check_output(
+            command, shell=True, cwd=self.repo_path).decode('utf-8').strip()
+
+    def _reader(self):
+        from natcap.versioner import gitreader
+        return gitreader.GitReader(os.path.join(self.repo_path, '.git'))
+
+    def test_packed_tags_not_peeled(self):
+        """Versioner - Git tag index: packed tags need no tag objects."""
+        reader = self._reader()
+        reader.peel = None  # peeling would fail
+        index = reader.tag_index()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(
+            index.tags_for(self._git_output('git rev-parse HEAD~1')),
+            [('0.2', self._git_output('git rev-parse 0.2'), True)])
+        self.assertTrue(self._git_output('git rev-parse HEAD~2') in index)
+        self.assertFalse(self._git_output('git rev-parse HEAD') in index)
+        self.assertEqual(reader.describe(self._git_output(
+            'git rev-parse HEAD')), ('0.2', 1))
+
+    def test_loose_tags_merged(self):
+        """Versioner - Git tag index: loose tags are added and override."""
+        from natcap.versioner import tagindex
+        first = self._reader().tag_index()
+        call_git('git tag -f 0.1 HEAD', self.repo_path)
+        call_git('git tag 0.3 HEAD~2', self.repo_path)
+
+        index = self._reader().tag_index()
+        self.assertFalse(index is first)
+        self.assertNotEqual(index.fingerprint, first.fingerprint)
+        head = self._git_output('git rev-parse HEAD')
+        self.assertEqual([entry.name for entry in index.tags_for(head)],
+                         ['0.1'])
+        self.assertEqual(
+            [entry.name for entry in index.tags_for(
+                self._git_output('git rev-parse HEAD~2'))], ['0.3'])
+        self.assertTrue(self._reader().tag_index() is index)
+
+        tagindex.clear_cache()
+        self.assertFalse(self._reader().tag_index() is index)
+
+    def test_annotated_preferred(self):
+        """Versioner - Git tag index: tag choice matches git describe."""
+        call_git('git tag 0.2-light HEAD~1', self.repo_path)
+        call_git('git tag 0.0 HEAD~1', self.repo_path)
+        reader = self._reader()
+        head = self._git_output('git rev-parse HEAD')
+        tag, distance, _ = self._git_output(
+            'git describe --tags --long').rsplit('-', 2)
+        self.assertEqual(reader.describe(head), (tag, int(distance)))
+        self.assertEqual(tag, '0.2')
+
+    def test_highest_version_preferred(self):
+        """Versioner - Git tag index: equal tags go to the highest version."""
+        call_git('git tag 0.9 HEAD', self.repo_path)
+        call_git('git tag 0.10 HEAD', self.repo_path)
+        reader = self._reader()
+        head = self._git_output('git rev-parse HEAD')
+        self.assertEqual(reader.describe(head), ('0.10', 0))
+
+
+class GitBatchVersionsTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a repo with a merge and an annotated tag in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_git('git init', self.repo_path)
+        call_git('git checkout -B master', self.repo_path)
+        self._commit('first')
+        self._commit('second')
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'tag -a 0.1 -m "annotated"', self.repo_path)
+        call_git('git checkout -q -b feature', self.repo_path)
+        self._commit('feature')
+        self._commit('feature again')
+        call_git('git checkout -q master', self.repo_path)
+        self._commit('third')
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'merge -q --no-edit feature', self.repo_path)
+        self._commit('fourth')
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, message):
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit -q --allow-empty -m "%s"' % message, self.repo_path)
+
+    def _git_output(self, command):
+        return subprocess.check_output(
+            command, shell=True, cwd=self.repo_path).decode('utf-8').strip()
+
+    def _described_version(self, sha):
+        """Format the version of ``sha`` from ``git describe``."""
+        tag, distance, _ = self._git_output(
+            'git describe --tags --long %s' % sha).rsplit('-', 2)
+        if distance == '0':
+            return tag
+        return '%s.post%s+n%s' % (tag, distance, sha[:8])
+
+    def test_matches_describe(self):
+        """Versioner - Git batch: versions match git describe."""
+        from natcap.versioner import versioning
+        # Every commit since the tag (git describe can't describe the first
+        # one).
+        shas = self._git_output('git rev-list --all --not 0.1~1').split()
+        with versioning.GitRepo(self.repo_path) as repo:
+            # Oldest first, then again newest first from the memo.
+            self.assertEqual(
+                repo.versions_for(reversed(shas)),
+                [self._described_version(sha) for sha in reversed(shas)])
+            self.assertEqual(
+                repo.versions_for(shas),
+                [self._described_version(sha) for sha in shas])
+            self.assertEqual(repo.process_count, 1)
+
+    def test_names(self):
+        """Versioner - Git batch: abbreviations, tags and unknown commits."""
+        from natcap.versioner import versioning
+        head = self._git_output('git rev-parse HEAD')
+        with versioning.GitRepo(self.repo_path) as repo:
+            self.assertEqual(
+                repo.versions_for([head[:10], '0.1', 'f' * 40, 'HEAD:']),
+                [self._described_version(head), '0.1', None, None])
+
+    def test_tags_changed(self):
+        """Versioner - Git batch: new tags are noticed."""
+        from natcap.versioner import versioning
+        head = self._git_output('git rev-parse HEAD')
+        with versioning.GitRepo(self.repo_path) as repo:
+            self.assertEqual(repo.versions_for([head]),
+                             [self._described_version(head)])
+            call_git('git tag 0.2 HEAD~1', self.repo_path)
+            self.assertEqual(repo.versions_for([head]),
+                             ['0.2.post1+n%s' % head[:8]])
+
+    def test_python_backend(self):
+        """Versioner - Git batch: the python backend reads from disk."""
+        from natcap.versioner import versioning
+        shas = self._git_output('git rev-list --all --not 0.1~1').split()
+        with versioning.GitRepo(
+                self.repo_path, backend=versioning.BACKEND_PYTHON) as repo:
+            self.assertEqual(
+                repo.versions_for(shas + ['0.1']),
+                [self._described_version(sha) for sha in shas] + ['0.1'])
+            self.assertEqual(repo.process_count, 0)
+            # Abbreviations and unknown objects need git.
+            self.assertEqual(
+                repo.versions_for([shas[0][:10], 'HEAD:', 'f' * 40]),
+                [self._described_version(shas[0]), None, None])
+            self.assertEqual(repo.process_count, 1)
+
+    def test_unresponsive_git(self):
+        """Versioner - Git batch: a hung cat-file falls back to git."""
+        if sys.platform == 'win32':
+            self.skipTest('Needs a shell script as git')
+        from natcap.versioner import gitbatch, gitreader, versioning
+        hung_git = os.path.join(self.repo_path, 'hung-git')
+        with open(hung_git, 'w') as script:
+            script.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(hung_git, 0o755)
+        head = self._git_output('git rev-parse HEAD')
+        with versioning.GitRepo(self.repo_path) as repo:
+            cat_file = gitbatch.CatFile(self.repo_path, hung_git, timeout=0.5)
+            repo._batch_reader = gitbatch.BatchReader(
+                gitreader.find_git_dir(self.repo_path), cat_file)
+            self.assertEqual(repo.versions_for([head[:10]]),
+                             [self._described_version(head)])
+            self.assertFalse(cat_file.running)
+
+    def test_untagged(self):
+        """Versioner - Git batch: without tags, commits are counted."""
+        from natcap.versioner import versioning
+        call_git('git tag -d 0.1', self.repo_path)
+        head = self._git_output('git rev-parse HEAD')
+        count = self._git_output('git rev-list --count HEAD')
+        with versioning.GitRepo(self.repo_path) as repo:
+            self.assertEqual(repo.versions_for([head]),
+                             ['null.post%s+n%s' % (count, head[:8])])
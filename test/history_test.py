@@ -0,0 +1,247 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+
+def call_vcs(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the repo resides.
+
+    Returns:
+        ``None``.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+class WalkTest(unittest.TestCase):
+    def test_walk(self):
+        """Versioner - History: tags and distances follow the parents."""
+        from natcap.versioner import history
+        revisions = [
+            history.Revision('root', 1, [], []),
+            history.Revision('tagged', 2, ['root'], ['0.1']),
+            history.Revision('main', 1, ['tagged'], []),
+            history.Revision('side1', 1, ['tagged'], []),
+            history.Revision('side2', 1, ['side1'], []),
+            history.Revision('merge', 0, ['main', 'side2'], []),
+        ]
+        # Like git describe, a merge counts every commit since the tag.
+        described = {'tagged': ('0.1', 0), 'merge': ('0.1', 4)}
+        self.assertEqual(list(history.walk(revisions, described.get)), [
+            ('root', None, 1),
+            ('tagged', '0.1', 0),
+            ('main', '0.1', 1),
+            ('side1', '0.1', 1),
+            ('side2', '0.1', 2),
+            ('merge', '0.1', 4),
+        ])
+
+    def test_constant_memory(self):
+        """Versioner - History: states are dropped after the last child."""
+        from natcap.versioner import history
+        described = []
+
+        def describe(node):
+            described.append(node)
+            return '1.0', 5
+
+        def revisions():
+            parent = 'boundary'
+            for index in range(10000):
+                node = 'n%s' % index
+                yield history.Revision(node, 1, [parent], [])
+                parent = node
+
+        versions = history.walk(revisions(), describe)
+        for node, tag, distance in versions:
+            # The generator's frame holds only the latest state.
+            states = versions.gi_frame.f_locals['states']
+            self.assertLessEqual(len(states), 1)
+        self.assertEqual((tag, distance), ('1.0', 10005))
+        self.assertEqual(described, ['boundary'])
+
+    def test_merge_described(self):
+        """Versioner - History: merges are described on their own."""
+        from natcap.versioner import history
+        described = []
+
+        def describe(node):
+            described.append(node)
+            return '0.1', 5
+
+        revisions = [
+            history.Revision('merge', 1, ['untagged', 'tagged'], []),
+            history.Revision('child', 0, ['merge'], []),
+        ]
+        self.assertEqual(list(history.walk(revisions, describe)),
+                         [('merge', '0.1', 5), ('child', '0.1', 6)])
+        self.assertEqual(described, ['merge'])
+
+
+class GitHistoryTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a git repo with two tags in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        self.commit_time = 1500000000
+        call_vcs('git init', self.repo_path)
+        call_vcs('git checkout -B master', self.repo_path)
+        self._commit('first')
+        call_vcs('git tag 0.1', self.repo_path)
+        self._commit('second')
+        self._commit('third')
+        call_vcs('git tag 0.2', self.repo_path)
+        self._commit('fourth')
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _git_as_committer(self):
+        """Start a git command line that commits a second after the last
+        commit, so that the history doesn't depend on the clock."""
+        self.commit_time += 1
+        return ('GIT_COMMITTER_DATE="%s +0000" '
+                'GIT_AUTHOR_DATE="%s +0000" '
+                'git -c user.name="Example Name" '
+                '-c user.email="name@example.com" ' % (
+                    self.commit_time, self.commit_time))
+
+    def _commit(self, message):
+        """Make an empty commit with ``message``."""
+        call_vcs(self._git_as_committer() +
+                 'commit --allow-empty -m "%s"' % message, self.repo_path)
+
+    def _merge(self, branch):
+        """Merge ``branch`` into the checked out branch."""
+        call_vcs(self._git_as_committer() +
+                 'merge --no-ff -m "merge %s" %s' % (branch, branch),
+                 self.repo_path)
+
+    def _checked_out_versions(self, nodes):
+        """Version each of ``nodes`` by checking it out."""
+        import natcap.versioner
+        versions = []
+        for node in nodes:
+            call_vcs('git checkout %s' % node, self.repo_path)
+            versions.append(natcap.versioner.vcs_version(
+                self.repo_path, use_cache=False))
+        call_vcs('git checkout master', self.repo_path)
+        return versions
+
+    def test_matches_vcs_version(self):
+        """Versioner - History: versions match checking each commit out."""
+        import natcap.versioner
+        nodes, versions = zip(*natcap.versioner.iter_versions(
+            self.repo_path))
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(versions[0], '0.1')
+        self.assertEqual(versions[2], '0.2')
+        self.assertEqual(list(versions), self._checked_out_versions(nodes))
+
+    def test_branched_history(self):
+        """Versioner - History: merge distances match git describe."""
+        from natcap.versioner import versioning
+        call_vcs('git checkout -b side 0.1', self.repo_path)
+        self._commit('side one')
+        call_vcs('git checkout -b other HEAD', self.repo_path)
+        self._commit('other one')
+        self._commit('other two')
+        call_vcs('git checkout side', self.repo_path)
+        self._commit('side two')
+        self._merge('other')
+        call_vcs('git checkout master', self.repo_path)
+        self._commit('fifth')
+        self._merge('side')
+        self._commit('sixth')
+
+        for backend in [versioning.BACKEND_CLI, versioning.BACKEND_PYTHON]:
+            repo = versioning.GitRepo(self.repo_path, backend=backend)
+            nodes, versions = zip(*repo.iter_versions())
+            self.assertEqual(len(nodes), 12)
+            self.assertEqual(list(versions),
+                             self._checked_out_versions(nodes))
+
+    def test_annotated_tag_preferred(self):
+        """Versioner - History: tagged commits are described as git does."""
+        from natcap.versioner import versioning
+        call_vcs(self._git_as_committer() + 'tag -a 1.0 -m "annotated"',
+                 self.repo_path)
+        call_vcs('git tag 2.0', self.repo_path)
+        for backend in [versioning.BACKEND_CLI, versioning.BACKEND_PYTHON]:
+            repo = versioning.GitRepo(self.repo_path, backend=backend)
+            nodes, versions = zip(*repo.iter_versions())
+            self.assertEqual(versions[-1], '1.0')
+            self.assertEqual(list(versions),
+                             self._checked_out_versions(nodes))
+
+    def test_range(self):
+        """Versioner - History: a range starts after its first tag."""
+        from natcap.versioner import versioning
+        for backend in [versioning.BACKEND_CLI, versioning.BACKEND_PYTHON]:
+            repo = versioning.GitRepo(self.repo_path, backend=backend)
+            versions = list(repo.iter_versions('0.1..0.2'))
+            self.assertEqual([version for _, version in versions],
+                             ['0.1.post1+n%s' % versions[0][0][:8], '0.2'])
+
+    def test_untagged(self):
+        """Versioner - History: without tags, commits are counted."""
+        import natcap.versioner
+        call_vcs('git tag -d 0.1 0.2', self.repo_path)
+        nodes, versions = zip(*natcap.versioner.iter_versions(
+            self.repo_path, 'HEAD~1..HEAD'))
+        self.assertEqual(list(versions), self._checked_out_versions(nodes))
+
+    def test_not_a_repository(self):
+        """Versioner - History: only repositories have a history."""
+        import natcap.versioner
+        with self.assertRaises(natcap.versioner.VersionNotFound):
+            natcap.versioner.iter_versions('/')
+
+    def test_closed_early(self):
+        """Versioner - History: closing the generator stops git."""
+        from natcap.versioner import history
+        lines = history.stream_lines(['git', 'log', '--oneline'],
+                                     cwd=self.repo_path)
+        self.assertTrue(next(lines))
+        lines.close()
+
+
+class MercurialHistoryTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a mercurial repo with a tag in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_vcs('hg init', self.repo_path)
+        self._commit('first')
+        call_vcs('hg tag -u "Example Name" 0.1', self.repo_path)
+        self._commit('second')
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, message):
+        """Commit a change to a file with ``message``."""
+        with open(os.path.join(self.repo_path, 'file.txt'), 'a') as out:
+            out.write('%s\n' % message)
+        call_vcs('hg commit -A -u "Example Name" -m "%s"' % message,
+                 self.repo_path)
+
+    def test_matches_snapshot(self):
+        """Versioner - History: hg versions match each revision."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        versions = list(natcap.versioner.iter_versions(self.repo_path))
+        self.assertEqual(len(versions), 3)
+        self.assertEqual(versions[0][1], '0.1')
+        for node, version in versions:
+            call_vcs('hg update -r %s' % node, self.repo_path)
+            repo = versioning.HgRepo(self.repo_path)
+            self.assertEqual(version, repo.pep440(branch=False))
@@ -51,12 +51,16 @@ class GetVersionTest(unittest.TestCase):
         Parameters:
             package (string): The package name to clean.
 
+        The package's memoized versions are invalidated too.
+
         Returns:
             None.
         """
+        from natcap.versioner import registry
         for modname in list(sys.modules.keys()):
             if modname.startswith(package):
                 del sys.modules[modname]
+        registry.invalidate(package)
 
     def test_get_version_from_version_module(self):
         """Versioner - Interface: Check version loaded from module."""
@@ -121,6 +125,113 @@ class GetVersionTest(unittest.TestCase):
                 del sys.frozen
 
 
+class FrozenManifestTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a git repo with a package in ``self.workspace``."""
+        import subprocess
+        self.workspace = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workspace, '_frozen_pkg'))
+        with open(os.path.join(self.workspace, '_frozen_pkg', '__init__.py'),
+                  'w'):
+            pass
+        for command in ['git init', 'git checkout -B master',
+                        'git -c user.name="Example Name" '
+                        '-c user.email="name@example.com" '
+                        'commit --allow-empty -m "initial commit"',
+                        'git tag 1.0',
+                        'git -c user.name="Example Name" '
+                        '-c user.email="name@example.com" '
+                        'commit --allow-empty -m "second commit"']:
+            subprocess.check_call(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                shell=True, cwd=self.workspace)
+        self.cwd = os.getcwd()
+        os.chdir(self.workspace)
+        sys.path.insert(0, self.workspace)
+
+    def tearDown(self):
+        """Remove the workspace and the package imported from it."""
+        os.chdir(self.cwd)
+        sys.path.remove(self.workspace)
+        GetVersionTest.clean_fake_module('_frozen_pkg')
+        shutil.rmtree(self.workspace)
+
+    def _build(self):
+        """Write the version module as ``setup.py`` would.
+
+        Returns:
+            The version recorded in the distribution metadata."""
+        from natcap.versioner import utils
+
+        class FakeMetadata(object):
+            version = None
+
+        class FakeDistribution(object):
+            metadata = FakeMetadata()
+
+        dist = FakeDistribution()
+        utils.distutils_keyword(dist, 'natcap_version',
+                                '_frozen_pkg/version.py')
+        return dist.metadata.version
+
+    def test_frozen_manifest(self):
+        """Versioner - Interface: every field is read from the manifest."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        expected = natcap.versioner._vcs_version_info(self.workspace)
+        self.assertEqual(self._build(), expected['version'])
+
+        with profiling.profile() as result:
+            version_info = natcap.versioner.get_version_info('_frozen_pkg')
+            version = natcap.versioner.get_version('_frozen_pkg')
+        build_time = version_info['build_time']
+        self.assertEqual(dict(version_info, build_time=None), expected)
+        self.assertTrue(version.startswith('1.0.post1+n'))
+        self.assertEqual(version, expected['version'])
+        self.assertTrue(build_time.endswith('Z'))
+        self.assertEqual(result.subprocess_count, 0)
+        self.assertNotIn(profiling.STAGE_COMMAND,
+                         [record.stage for record in result.records])
+
+    def test_sdist_keeps_fields(self):
+        """Versioner - Interface: sdist builds keep the recorded fields."""
+        import natcap.versioner
+        os.environ['SOURCE_DATE_EPOCH'] = '0'
+        try:
+            version = self._build()
+            with open('PKG-INFO', 'w') as pkginfo:
+                pkginfo.write('Name: _frozen_pkg\nVersion: %s\n' % version)
+            self._build()
+        finally:
+            del os.environ['SOURCE_DATE_EPOCH']
+
+        version_info = natcap.versioner.get_version_info('_frozen_pkg')
+        self.assertEqual(version_info['scm'], 'Git')
+        self.assertEqual(version_info['tag_distance'], 1)
+        self.assertEqual(version_info['build_time'], '1970-01-01T00:00:00Z')
+
+    def test_version_file_not_executed(self):
+        """Versioner - Interface: version files are parsed, not run."""
+        from natcap.versioner import utils
+        path = os.path.join('_frozen_pkg', 'version.py')
+        with open(path, 'w') as module:
+            module.write("import os\nos.mkdir('executed')\n"
+                         "__version__ = '0.3'\n")
+        self.assertEqual(utils._read_version_file(path), {'version': '0.3'})
+        self.assertFalse(os.path.exists('executed'))
+
+    def test_plain_version_module(self):
+        """Versioner - Interface: old version modules only have a version."""
+        import natcap.versioner
+        with open(os.path.join('_frozen_pkg', 'version.py'), 'w') as module:
+            module.write("version = '0.3'\n")
+        version_info = natcap.versioner.get_version_info('_frozen_pkg')
+        self.assertEqual(version_info['version'], '0.3')
+        self.assertEqual(version_info['node'], None)
+        self.assertEqual(sorted(version_info),
+                         sorted(natcap.versioner.VERSION_INFO_FIELDS))
+
+
 class PKGINFOTest(unittest.TestCase):
     def setUp(self):
         """Set up test by setting ``self.workspace``."""
@@ -146,3 +257,58 @@ class PKGINFOTest(unittest.TestCase):
         import natcap.versioner
         with self.assertRaises(natcap.versioner.VersionNotFound):
             natcap.versioner.parse_version(root='/')
+
+
+class ImportTest(unittest.TestCase):
+    def _run_python(self, code):
+        """Run ``code`` in a fresh interpreter with the package importable.
+
+        Parameters:
+            code (string): The python source to execute.
+
+        Returns:
+            The stripped string output of the interpreter."""
+        import subprocess
+        package_root = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_root] + [path for path in [env.get('PYTHONPATH')]
+                              if path])
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], cwd=tempfile.gettempdir(),
+            env=env)
+        return output.decode('utf-8').strip()
+
+    def test_import_skips_pkg_resources(self):
+        """Versioner - Import: natcap.versioner doesn't use pkg_resources."""
+        # The natcap namespace is declared with pkg_resources, so block it
+        # once the namespace is imported.
+        output = self._run_python(
+            'import sys; import natcap; '
+            'sys.modules["pkg_resources"] = None; '
+            'import natcap.versioner; print("imported")')
+        self.assertEqual(output, 'imported')
+
+    def test_version_is_lazy(self):
+        """Versioner - Import: __version__ is not computed at import."""
+        if sys.version_info < (3, 7):
+            self.skipTest('Module __getattr__ requires python 3.7')
+        output = self._run_python(
+            'import natcap.versioner; '
+            'print("__version__" in vars(natcap.versioner))')
+        self.assertEqual(output, 'False')
+
+    def test_version_computed_on_access(self):
+        """Versioner - Import: __version__ is available on access."""
+        import natcap.versioner
+        version = natcap.versioner.get_version('natcap.versioner')
+        self.assertEqual(natcap.versioner.__version__, version)
+
+    def test_metadata_version(self):
+        """Versioner - Interface: version loaded from package metadata."""
+        import natcap.versioner
+        self.assertEqual(natcap.versioner._metadata_version('six'),
+                         __import__('six').__version__)
+        self.assertIs(natcap.versioner._metadata_version(
+            'natcap.not-a-real-package'), None)
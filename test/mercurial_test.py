@@ -4,6 +4,7 @@ import subprocess
 import tempfile
 import os
 import re
+import sys
 import zipfile
 
 
@@ -226,6 +227,76 @@ class MercurialTest(unittest.TestCase):
         natcap.versioner.get_version('sys', root=self.repo_path,
                                      allow_scm=natcap.versioner.SCM_ALLOW)
 
+    def test_snapshot_memoized(self):
+        """Versioner - Hg: snapshot is reused while the repo is unchanged."""
+        repo = self._set_up_sample_repo()
+        snapshot = repo.snapshot()
+        self.assertEqual(snapshot.latest_tag, '0.1')
+        self.assertEqual(snapshot.branch, 'default')
+        self.assertIs(repo.snapshot(), snapshot)
+
+    def test_snapshot_invalidated(self):
+        """Versioner - Hg: snapshot is recomputed after an update."""
+        repo = self._set_up_sample_repo()
+        self.assertEqual(repo.snapshot().tag_distance, 1)
+        call_hg('hg up -r 0.1 -R {repo}'.format(repo=self.repo_path))
+        self.assertEqual(repo.snapshot().tag_distance, 0)
+        self.assertEqual(repo.pep440(), '0.1')
+
+    def test_vcs_version_cached(self):
+        """Versioner - Hg: check repeat versions come from the cache."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        self._set_up_sample_repo()
+        version = natcap.versioner.vcs_version(self.repo_path)
+
+        run_command = versioning.VCSQuerier._run_command
+
+        def _fail(*args, **kwargs):
+            raise AssertionError('VCS called: %s' % (args,))
+        versioning.VCSQuerier._run_command = _fail
+        try:
+            self.assertEqual(natcap.versioner.vcs_version(self.repo_path),
+                             version)
+        finally:
+            versioning.VCSQuerier._run_command = run_command
+
+        call_hg('hg up -r 0.1 -R {repo}'.format(repo=self.repo_path))
+        self.assertEqual(natcap.versioner.vcs_version(self.repo_path), '0.1')
+
+    def test_async_pep440(self):
+        """Versioner - Hg: check coroutine PEP440 matches pep440()."""
+        import asyncio
+        repo = self._set_up_sample_repo()
+        loop = asyncio.new_event_loop()
+        version = loop.run_until_complete(repo.async_pep440())
+        loop.close()
+        self.assertEqual(version, type(repo)(repo._repo_path).pep440())
+
+    def test_pep440_single_hg_invocation(self):
+        """Versioner - Hg: check PEP440 version needs one call to hg."""
+        from natcap.versioner import versioning
+        self._set_up_sample_repo()
+        repo = versioning.HgRepo(self.repo_path)
+
+        commands = []
+        run_command = repo._run_command
+
+        def _counting_run_command(cmd, cwd=None):
+            commands.append(cmd)
+            return run_command(cmd, cwd=cwd)
+        repo._run_command = _counting_run_command
+
+        pep440_version = repo.pep440(branch=True)
+        self.assertTrue(pep440_version.startswith('0.1.post1+n'))
+        self.assertTrue(pep440_version.endswith('-default'))
+        self.assertEqual(len(commands), 1)
+
+        call_hg('hg up -r 0.1 -R {repo}'.format(repo=self.repo_path))
+        repo.refresh()
+        self.assertEqual(repo.pep440(), '0.1')
+        self.assertEqual(len(commands), 2)
+
 
 class MercurialArchiveTest(MercurialTest):
     def _set_up_sample_repo(self, archive_rev=None):
@@ -273,9 +344,327 @@ class MercurialArchiveTest(MercurialTest):
         repo = self._set_up_sample_repo(archive_rev='0.1')
         self.assertEqual(repo.pep440(), '0.1')
 
+    def test_snapshot_invalidated(self):
+        """Versioner - Hg Archive: snapshot follows the archival file."""
+        repo = self._set_up_sample_repo()
+        self.assertEqual(repo.snapshot().tag_distance, 1)
+
+        archival_path = os.path.join(self.archive_path, '.hg_archival.txt')
+        with open(archival_path) as archival_file:
+            lines = [line for line in archival_file
+                     if not line.startswith('latesttag')]
+        lines.append('tag: 0.5\n')
+        os.remove(archival_path)
+        with open(archival_path, 'w') as archival_file:
+            archival_file.writelines(lines)
+
+        self.assertEqual(repo.snapshot().tag_distance, 0)
+        self.assertEqual(repo.pep440(), '0.5')
+
     def test_vcs_version(self):
         """Versioner - Hg Archive: check vcs_version at tag."""
         import natcap.versioner
         repo = self._set_up_sample_repo('0.1')
         version = natcap.versioner.vcs_version(self.archive_path)
         self.assertEqual(version, repo.pep440(branch=False))
+
+
+class MercurialCommandServerTest(MercurialTest):
+    def _set_up_sample_repo(self):
+        """Create the sample repo, queried through the hg command server.
+
+        Returns:
+            ``natcap.versioner.versioning.HgRepo`` instance."""
+        from natcap.versioner import versioning
+        MercurialTest._set_up_sample_repo(self)
+        repo = versioning.HgRepo(self.repo_path,
+                                 backend=versioning.BACKEND_CMDSERVER)
+        self.addCleanup(repo.close)
+        return repo
+
+    def test_server_reused(self):
+        """Versioner - Hg cmdserver: one server serves repeated queries."""
+        repo = self._set_up_sample_repo()
+        self.assertEqual(repo.latest_tag, '0.1')
+        server = repo._server
+        self.assertTrue(server.running)
+
+        call_hg('hg up -r 0.1 -R {repo}'.format(repo=self.repo_path))
+        repo.refresh()
+        self.assertEqual(repo.pep440(), '0.1')
+        self.assertIs(repo._server, server)
+
+    def test_close(self):
+        """Versioner - Hg cmdserver: close() shuts the server down."""
+        repo = self._set_up_sample_repo()
+        repo.node
+        server = repo._server
+        repo.close()
+        self.assertFalse(server.running)
+        self.assertIs(repo._server, None)
+
+    def test_context_manager(self):
+        """Versioner - Hg cmdserver: querier closes on context exit."""
+        from natcap.versioner import versioning
+        MercurialTest._set_up_sample_repo(self)
+        with versioning.HgRepo(
+                self.repo_path,
+                backend=versioning.BACKEND_CMDSERVER) as repo:
+            self.assertEqual(repo.branch, 'default')
+            server = repo._server
+        self.assertFalse(server.running)
+
+    def test_command_error(self):
+        """Versioner - Hg cmdserver: failing commands raise an error."""
+        import subprocess
+        repo = self._set_up_sample_repo()
+        with self.assertRaises(subprocess.CalledProcessError):
+            repo._log_template('{')
+
+    def _hung_server(self, greet):
+        """Write a fake hg that stops answering, after greeting if
+        ``greet``.
+
+        Returns:
+            The path to the fake hg executable."""
+        fake_hg = os.path.join(self.repo_path, 'hung-hg')
+        with open(fake_hg, 'w') as script:
+            script.write('#!%s\n' % sys.executable)
+            script.write('import struct, sys, time\n')
+            if greet:
+                script.write(
+                    'hello = b"capabilities: runcommand\\nencoding: UTF-8"\n'
+                    'out = getattr(sys.stdout, "buffer", sys.stdout)\n'
+                    'out.write(struct.pack(">cI", b"o", len(hello)) + hello)\n'
+                    'out.flush()\n')
+            script.write('time.sleep(30)\n')
+        os.chmod(fake_hg, 0o755)
+        return fake_hg
+
+    def test_unresponsive_server(self):
+        """Versioner - Hg cmdserver: a hung server is killed."""
+        if sys.platform == 'win32':
+            self.skipTest('Needs a script as hg')
+        from natcap.versioner import hgclient
+        MercurialTest._set_up_sample_repo(self)
+        with self.assertRaises(hgclient.CommandServerError):
+            hgclient.HgCommandServer(
+                self.repo_path, self._hung_server(greet=False), timeout=0.5)
+
+    def test_unresponsive_server_falls_back(self):
+        """Versioner - Hg cmdserver: hg is run when the server hangs."""
+        if sys.platform == 'win32':
+            self.skipTest('Needs a script as hg')
+        from natcap.versioner import hgclient
+        repo = self._set_up_sample_repo()
+        server = hgclient.HgCommandServer(
+            self.repo_path, self._hung_server(greet=True), timeout=0.5)
+        repo._server = server
+        self.assertEqual(repo.latest_tag, '0.1')
+        self.assertFalse(server.running)
+
+
+class MercurialCorruptTest(unittest.TestCase):
+    def setUp(self):
+        """Set up an hg repo with a truncated changelog in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_hg('hg init {0}'.format(self.repo_path))
+        with open(os.path.join(self.repo_path, 'scratchfile'), 'w') as out:
+            out.write('foo\n')
+        call_hg('hg commit -A -u "Example Name" -m "first" -R {0}'.format(
+            self.repo_path))
+        call_hg('hg tag -u "Example Name" 0.1 -R {0}'.format(self.repo_path))
+        # Cut the second index entry short.
+        changelog_path = os.path.join(
+            self.repo_path, '.hg', 'store', '00changelog.i')
+        with open(changelog_path, 'r+b') as changelog:
+            changelog.truncate(70)
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def test_no_version(self):
+        """Versioner - Hg: unreadable repository data is not a version."""
+        import natcap.versioner
+        from natcap.versioner import versioning
+        for backend in [versioning.BACKEND_PYTHON, versioning.BACKEND_CLI]:
+            previous_backend = versioning.HgRepo.backend
+            versioning.HgRepo.backend = backend
+            try:
+                self.assertEqual(natcap.versioner.vcs_version(
+                    self.repo_path, on_error=natcap.versioner.ERROR_RETURN,
+                    use_cache=False), 'UNKNOWN')
+                with self.assertRaises(natcap.versioner.VersionNotFound):
+                    natcap.versioner.vcs_version(self.repo_path,
+                                                 use_cache=False)
+            finally:
+                versioning.HgRepo.backend = previous_backend
+
+
+class MercurialAsyncTest(unittest.TestCase):
+    def setUp(self):
+        """Set up an empty hg repo in a temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+        call_hg('hg init {0}'.format(self.repo_path))
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def test_unexpected_output(self):
+        """Versioner - Hg async: malformed hg log output is an error."""
+        import asyncio
+        from natcap.versioner import aio
+        from natcap.versioner import versioning
+        repo = versioning.HgRepo(self.repo_path,
+                                 backend=versioning.BACKEND_CLI)
+
+        loop = asyncio.new_event_loop()
+
+        def run(repo, args):
+            output = loop.create_future()
+            output.set_result('not enough fields')
+            return output
+
+        original_run = aio._run
+        aio._run = run
+        try:
+            with self.assertRaises(ValueError):
+                loop.run_until_complete(aio.snapshot(repo))
+        finally:
+            loop.close()
+            aio._run = original_run
+
+
+class MercurialPythonBackendTest(MercurialTest):
+    def _set_up_sample_repo(self):
+        """Create the sample repo, queried through the python backend.
+
+        Returns:
+            ``natcap.versioner.versioning.HgRepo`` instance."""
+        from natcap.versioner import versioning
+        MercurialTest._set_up_sample_repo(self)
+        return versioning.HgRepo(self.repo_path,
+                                 backend=versioning.BACKEND_PYTHON)
+
+    def _assert_matches_cli(self, repo):
+        """Assert the python backend reports the same data as hg."""
+        from natcap.versioner import versioning
+        repo.refresh()
+        cli_repo = versioning.HgRepo(self.repo_path,
+                                     backend=versioning.BACKEND_CLI)
+        self.assertEqual(repo.snapshot(), cli_repo.snapshot())
+
+    def test_no_hg_process(self):
+        """Versioner - Hg python: versions are read without running hg."""
+        repo = self._set_up_sample_repo()
+        self.assertEqual(repo.latest_tag, '0.1')
+        self.assertEqual(repo.tag_distance, 1)
+        self.assertEqual(repo.process_count, 0)
+        self._assert_matches_cli(repo)
+
+    def test_branches_and_merges(self):
+        """Versioner - Hg python: latest tags across merges match hg."""
+        repo = self._set_up_sample_repo()
+        hg = 'hg -R {repo} --config ui.merge=internal:union '.format(
+            repo=self.repo_path)
+
+        def commit(filename, message):
+            with open(os.path.join(self.repo_path, filename), 'a') as file_a:
+                file_a.write(message + '\n')
+            call_hg(hg + 'commit -A -m "%s"' % message)
+
+        call_hg(hg + 'branch feature')
+        commit('feature_file', 'on feature')
+        call_hg(hg + 'tag 0.2-feature')
+        commit('feature_file', 'more feature')
+        call_hg(hg + 'update default')
+        commit('scratchfile', 'on default')
+        call_hg(hg + 'tag 0.3')
+        call_hg(hg + 'tag --local local-only')
+        call_hg(hg + 'tag --remove 0.1')
+        call_hg(hg + 'merge feature')
+        call_hg(hg + 'commit -m "merge feature"')
+        self._assert_matches_cli(repo)
+
+        # Without the tags caches, tags are read from .hgtags on each head.
+        shutil.rmtree(os.path.join(self.repo_path, '.hg', 'cache'))
+        self._assert_matches_cli(repo)
+        for revision in ['0', '0.2-feature', 'feature', '-2']:
+            call_hg(hg + 'update -r %s' % revision)
+            shutil.rmtree(os.path.join(self.repo_path, '.hg', 'cache'),
+                          ignore_errors=True)
+            self._assert_matches_cli(repo)
+        self.assertEqual(repo.process_count, 0)
+
+    def test_without_numpy(self):
+        """Versioner - Hg python: latest tags are walked without NumPy."""
+        from natcap.versioner import hgreader
+        numpy = hgreader.numpy
+        hgreader.numpy = None
+        try:
+            self.test_branches_and_merges()
+        finally:
+            hgreader.numpy = numpy
+
+    def test_numpy_imported_lazily(self):
+        """Versioner - Hg python: importing doesn't import NumPy."""
+        import sys
+        import natcap.versioner
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(natcap.versioner.__file__))))
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, natcap.versioner.hgreader; '
+             'print("numpy" in sys.modules)'], cwd=root)
+        self.assertEqual(output.strip(), b'False')
+
+    def test_latest_tag_table(self):
+        """Versioner - Hg python: the latest tag table is cached."""
+        from natcap.versioner import hgreader
+        if hgreader._load_numpy() is None:
+            self.skipTest('NumPy is not installed')
+        self._set_up_sample_repo()
+        reader = hgreader.HgReader(self.repo_path)
+        table = reader.latest_tag_table()[0]
+        self.assertIs(hgreader.HgReader(self.repo_path).latest_tag_table()[0],
+                      table)
+
+        numpy = hgreader.numpy
+        hgreader.numpy = None
+        try:
+            walked = [reader.latest_tags(rev)
+                      for rev in range(len(reader.changelog))]
+        finally:
+            hgreader.numpy = numpy
+        self.assertEqual([reader.latest_tags(rev)
+                          for rev in range(len(reader.changelog))], walked)
+
+        call_hg('hg -R {repo} tag 0.2'.format(repo=self.repo_path))
+        reader = hgreader.HgReader(self.repo_path)
+        self.assertIsNot(reader.latest_tag_table()[0], table)
+        self.assertEqual(reader.latest_tags(len(reader.changelog) - 1)[2],
+                         [b'0.2'])
+
+    def test_empty_repo(self):
+        """Versioner - Hg python: an empty repository matches hg."""
+        from natcap.versioner import versioning
+        call_hg('hg init {tempdir}'.format(tempdir=self.repo_path))
+        repo = versioning.HgRepo(self.repo_path,
+                                 backend=versioning.BACKEND_PYTHON)
+        self._assert_matches_cli(repo)
+        self.assertEqual(repo.latest_tag, 'null')
+        self.assertEqual(repo.process_count, 0)
+
+    def test_unsupported_repo_falls_back(self):
+        """Versioner - Hg python: unsupported features fall back to hg."""
+        from natcap.versioner import hgreader
+        repo = self._set_up_sample_repo()
+        supported = hgreader.SUPPORTED_REQUIREMENTS
+        hgreader.SUPPORTED_REQUIREMENTS = frozenset()
+        try:
+            self.assertEqual(repo.latest_tag, '0.1')
+        finally:
+            hgreader.SUPPORTED_REQUIREMENTS = supported
+        self.assertEqual(repo.process_count, 1)
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+
+class PEP440Test(unittest.TestCase):
+    def test_ordering(self):
+        """Versioner - PEP 440: versions sort as PEP 440 specifies."""
+        from natcap.versioner import pep440
+        ordered = [
+            '1.0.dev0', '1.0a1.dev2', '1.0a1', '1.0b2', '1.0rc1',
+            '1.0rc1.post1', '1.0', '1.0+abc', '1.0+5', '1.0.post1.dev3',
+            '1.0.post1', '1.1.dev1', '1.1', '1.10', '1!0.1',
+        ]
+        shuffled = list(ordered)
+        random.Random(0).shuffle(shuffled)
+        self.assertEqual(sorted(shuffled, key=pep440.sort_key), ordered)
+
+    def test_normalization(self):
+        """Versioner - PEP 440: spellings of a version are equal."""
+        from natcap.versioner import pep440
+        self.assertEqual(pep440.parse('v1.0'), pep440.parse('1.0.0'))
+        self.assertEqual(pep440.parse('1.0-RC.1'), pep440.parse('1.0rc1'))
+        self.assertEqual(pep440.parse('1.0-1'), pep440.parse('1.0.post1'))
+        self.assertEqual(str(pep440.parse('V1.0Alpha2-dev')),
+                         '1.0a2.dev0')
+        self.assertEqual(len(set([pep440.parse('1.0'),
+                                  pep440.parse('1.0.0')])), 1)
+
+    def test_cached(self):
+        """Versioner - PEP 440: parsed versions are shared."""
+        from natcap.versioner import pep440
+        self.assertTrue(pep440.parse('2.3') is pep440.parse('2.3'))
+        self.assertTrue(pep440.parse('2.3').is_prerelease is False)
+        self.assertTrue(pep440.parse('2.3b1').is_prerelease)
+
+    def test_invalid(self):
+        """Versioner - PEP 440: other strings sort below versions."""
+        from natcap.versioner import pep440
+        with self.assertRaises(pep440.InvalidVersion):
+            pep440.parse('release-candidate')
+        self.assertEqual(
+            sorted(['0.1', 'null', 'beta', '0.0.1'], key=pep440.sort_key),
+            ['beta', 'null', '0.0.1', '0.1'])
+        self.assertEqual(pep440.highest(['null', '0.9', '0.10', 'v0.8']),
+                         '0.10')
+        self.assertEqual(pep440.highest([]), None)
+
+    def test_increment(self):
+        """Versioner - PEP 440: the next release follows the tag."""
+        from natcap.versioner import pep440
+        for tag, expected in [('1.0', '1.1'), ('1.0rc1', '1.0rc2'),
+                              ('v2.3', '2.4'), ('1!2.0', '1!2.1'),
+                              ('1.0.dev3', '1.1'), ('1.0a', '1.0a1')]:
+            self.assertEqual(pep440.increment(tag), expected)
+            self.assertTrue(pep440.parse(expected) > pep440.parse(tag))
@@ -0,0 +1,187 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+
+def call_git(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the git repo resides.
+
+    Returns:
+        ``None``.
+
+    Raises:
+        subprocess.CalledProcessError: ``command`` exited with nonzero code.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+class _RecordingHandler(logging.Handler):
+    """Keep the messages of every record logged."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        """Set up ``self.repo_path`` as a new temp folder."""
+        self.repo_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _set_up_git_repo(self):
+        call_git('git init', self.repo_path)
+        call_git('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit --allow-empty -m "initial commit"', self.repo_path)
+        call_git('git tag 0.1', self.repo_path)
+
+    def test_vcs_version_stages(self):
+        """Versioner - Profiling: vcs_version stages and subprocesses."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        self._set_up_git_repo()
+
+        with profiling.profile() as result:
+            version = natcap.versioner.vcs_version(self.repo_path)
+        self.assertEqual(version, '0.1')
+        stages = [record.stage for record in result.records]
+        self.assertEqual(stages[0], profiling.STAGE_DISCOVERY)
+        self.assertIn(profiling.STAGE_CACHE, stages)
+        self.assertIn(profiling.STAGE_COMMAND, stages)
+        self.assertEqual(result.subprocess_count,
+                         stages.count(profiling.STAGE_COMMAND))
+        self.assertTrue(result.seconds >= 0)
+
+        # The second call is answered by the on-disk cache.
+        with profiling.profile() as result:
+            natcap.versioner.vcs_version(self.repo_path)
+        self.assertEqual(result.subprocess_count, 0)
+        self.assertTrue('0 subprocesses' in result.summary())
+
+    def test_get_version_stages(self):
+        """Versioner - Profiling: get_version import and metadata stages."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        self._set_up_git_repo()
+
+        with profiling.profile() as result:
+            natcap.versioner.get_version(
+                'natcap_versioner_no_such_package', root=self.repo_path)
+        outcomes = dict((record.stage, record.outcome)
+                        for record in result.records)
+        self.assertEqual(outcomes[profiling.STAGE_IMPORT],
+                         profiling.OUTCOME_NOT_FOUND)
+        self.assertEqual(outcomes[profiling.STAGE_METADATA],
+                         profiling.OUTCOME_NOT_FOUND)
+        self.assertEqual(outcomes[profiling.STAGE_DISCOVERY],
+                         profiling.OUTCOME_OK)
+
+    def test_archive_stage(self):
+        """Versioner - Profiling: archive parsing is recorded."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        with open(os.path.join(self.repo_path, '.hg_archival.txt'),
+                  'w') as archival_file:
+            archival_file.write('repo: 1234\nnode: abcdef0123456789\n'
+                                'branch: default\ntag: 0.2\n')
+
+        with profiling.profile() as result:
+            self.assertEqual(natcap.versioner.vcs_version(self.repo_path),
+                             '0.2')
+        self.assertIn(profiling.STAGE_ARCHIVE,
+                      [record.stage for record in result.records])
+        self.assertEqual(result.subprocess_count, 0)
+
+    def test_listener(self):
+        """Versioner - Profiling: callbacks receive stage records."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        records = []
+        profiling.add_listener(records.append)
+        try:
+            natcap.versioner.vcs_version(
+                '/', on_error=natcap.versioner.ERROR_RETURN)
+        finally:
+            profiling.remove_listener(records.append)
+        self.assertEqual(
+            [(record.stage, record.outcome) for record in records],
+            [(profiling.STAGE_DISCOVERY, profiling.OUTCOME_NOT_FOUND)])
+
+    def test_errors_recorded(self):
+        """Versioner - Profiling: stages that raise are recorded as errors."""
+        from natcap.versioner import profiling
+        with profiling.profile() as result:
+            with self.assertRaises(ValueError):
+                with profiling.stage(profiling.STAGE_COMMAND, 'fail'):
+                    raise ValueError('failed')
+        self.assertEqual(result.records[0].outcome, profiling.OUTCOME_ERROR)
+
+    def test_environment_variable(self):
+        """Versioner - Profiling: NATCAP_VERSIONER_PROFILE logs a summary."""
+        import natcap.versioner
+        from natcap.versioner import profiling
+        self._set_up_git_repo()
+
+        logger = logging.getLogger('natcap.versioner')
+        level = logger.level
+        handler = _RecordingHandler()
+        logger.addHandler(handler)
+        os.environ[profiling.PROFILE_ENV_VARIABLE] = '1'
+        try:
+            natcap.versioner.get_version(
+                'natcap_versioner_no_such_package', root=self.repo_path)
+            # The logger's level is left as it was.
+            self.assertEqual(logger.level, level)
+        finally:
+            del os.environ[profiling.PROFILE_ENV_VARIABLE]
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        # Only the outermost call (get_version) is summarized.
+        self.assertEqual(len(handler.messages), 1)
+        self.assertTrue(handler.messages[0].startswith('get_version('))
+        self.assertTrue('discovery' in handler.messages[0])
+        self.assertEqual(len(handler.messages[0].splitlines()), 1)
+
+    def test_logged_profile_per_thread(self):
+        """Versioner - Profiling: summaries only count their own thread."""
+        import threading
+        from natcap.versioner import profiling
+
+        handler = _RecordingHandler()
+        profiling.LOGGER.addHandler(handler)
+        os.environ[profiling.PROFILE_ENV_VARIABLE] = '1'
+        try:
+            with profiling.logged_profile('outer'):
+                # No global listener is registered for the summary.
+                self.assertEqual(profiling._listeners, [])
+                with profiling.stage(profiling.STAGE_COMMAND, 'here'):
+                    pass
+                thread = threading.Thread(target=lambda: profiling.record(
+                    profiling.STAGE_COMMAND, 'elsewhere', 0.0))
+                thread.start()
+                thread.join()
+        finally:
+            del os.environ[profiling.PROFILE_ENV_VARIABLE]
+            profiling.LOGGER.removeHandler(handler)
+
+        self.assertEqual(len(handler.messages), 1)
+        self.assertTrue(handler.messages[0].startswith('outer'))
+        self.assertTrue('command 0.' in handler.messages[0])
+        self.assertFalse('command x2' in handler.messages[0])
@@ -0,0 +1,105 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+class VersionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        """Set up ``self.workspace`` and forget every memoized version."""
+        from natcap.versioner import registry
+        registry.invalidate()
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the workspace, the fake package and memoized versions."""
+        from natcap.versioner import registry
+        for modname in ['_reg_pkg', '_reg_pkg.version']:
+            sys.modules.pop(modname, None)
+        shutil.rmtree(self.workspace)
+        registry.invalidate()
+
+    @staticmethod
+    def _set_version(version_str, **fields):
+        """Make ``_reg_pkg.version`` importable with a version."""
+        class SampleVersionModule(object):
+            version = version_str
+            version_info = dict(fields, version=version_str)
+
+        sys.modules['_reg_pkg'] = object()
+        sys.modules['_reg_pkg.version'] = SampleVersionModule()
+
+    def test_memoized(self):
+        """Versioner - Registry: version modules are imported once."""
+        import natcap.versioner
+        from natcap.versioner import registry
+        self._set_version('1.0')
+        self.assertEqual(natcap.versioner.get_version('_reg_pkg'), '1.0')
+        self._set_version('2.0')
+        self.assertEqual(natcap.versioner.get_version('_reg_pkg'), '1.0')
+
+        registry.invalidate('_reg_pkg')
+        self.assertEqual(natcap.versioner.get_version('_reg_pkg'), '2.0')
+
+    def test_negative_lookup(self):
+        """Versioner - Registry: failed lookups are memoized."""
+        import natcap.versioner
+        from natcap.versioner import registry
+        for _ in range(2):
+            with self.assertRaises(natcap.versioner.VersionNotFound):
+                natcap.versioner.get_version(
+                    '_reg_pkg', allow_scm=natcap.versioner.SCM_DISALLOW)
+            self._set_version('1.0')
+
+        registry.invalidate('_reg_pkg')
+        self.assertEqual(natcap.versioner.get_version(
+            '_reg_pkg', allow_scm=natcap.versioner.SCM_DISALLOW), '1.0')
+
+    def test_load_installed(self):
+        """Versioner - Registry: one scan finds every distribution."""
+        import natcap.versioner
+        from natcap.versioner import registry
+        self.assertTrue(registry.load_installed() > 0)
+        six_version = natcap.versioner._metadata_version('six')
+
+        def fail(package):
+            raise AssertionError('metadata of %s was read' % package)
+
+        self.assertEqual(registry.REGISTRY.metadata_version('Six', fail),
+                         six_version)
+        self.assertEqual(
+            registry.REGISTRY.metadata_version('_not_installed', fail), None)
+
+    def test_manifest(self):
+        """Versioner - Registry: manifests override version modules."""
+        import natcap.versioner
+        from natcap.versioner import registry
+        manifest_path = os.path.join(self.workspace, 'versions.json')
+        self._set_version('1.0', node='abcdef12')
+        recorded = registry.write_manifest(manifest_path,
+                                           ['_reg_pkg', '_not_installed'])
+        self.assertEqual(list(recorded), ['_reg_pkg'])
+
+        self._set_version('2.0')
+        registry.invalidate()
+        self.assertEqual(registry.load_manifest(manifest_path), 1)
+        version_info = natcap.versioner.get_version_info('_reg-pkg')
+        self.assertEqual(version_info['version'], '1.0')
+        self.assertEqual(version_info['node'], 'abcdef12')
+
+        registry.invalidate('_reg_pkg')
+        self.assertEqual(natcap.versioner.get_version('_reg_pkg'), '2.0')
+
+    def test_manifest_cli(self):
+        """Versioner - Registry: the CLI writes installed versions."""
+        import natcap.versioner
+        from natcap.versioner import cli
+        from natcap.versioner import registry
+        manifest_path = os.path.join(self.workspace, 'versions.json')
+        self.assertEqual(cli.main(['manifest', manifest_path]), 0)
+        registry.load_manifest(manifest_path)
+        self.assertEqual(natcap.versioner.get_version('six'),
+                         natcap.versioner._metadata_version('six'))
+        self.assertEqual(registry.REGISTRY.manifest_info('six')['version'],
+                         natcap.versioner._metadata_version('six'))
@@ -0,0 +1,204 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+
+def call_vcs(command, repo_dir):
+    """
+    Make a call to the shell via ``subprocess.check_call``.
+
+    Parameters:
+        command (string): The command to issue.
+        repo_dir (string): The directory where the repo resides.
+
+    Returns:
+        ``None``.
+    """
+    subprocess.check_call(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, shell=True, cwd=repo_dir)
+
+
+class SubtreeVersionsTest(unittest.TestCase):
+    def test_stops_after_tag(self):
+        """Versioner - Subtree: history older than the tag isn't read."""
+        from natcap.versioner import subtree
+        read = []
+
+        def commits():
+            for commit in [
+                    subtree.Commit('merge', ['main', 'side'], [], []),
+                    subtree.Commit('main', ['tagged'], [], ['a/x.py']),
+                    subtree.Commit('side', ['tagged'], [], ['b/x.py']),
+                    subtree.Commit('tagged', ['root'], ['0.1'], ['a/x.py']),
+                    subtree.Commit('root', [], [], ['c/x.py'])]:
+                read.append(commit.node)
+                yield commit
+
+        self.assertEqual(subtree.subtree_versions(commits(), ['a', 'b']), {
+            'a': ('main', '0.1', 1),
+            'b': ('side', '0.1', 1),
+        })
+        self.assertEqual(read, ['merge', 'main', 'side', 'tagged'])
+
+        # A subtree only touched before the tag needs the whole history.
+        del read[:]
+        self.assertEqual(subtree.subtree_versions(commits(), ['c']),
+                         {'c': ('root', '0.1', 0)})
+        self.assertEqual(len(read), 5)
+
+
+class GitSubtreeTest(unittest.TestCase):
+    def setUp(self):
+        """Set up a git monorepo with subprojects ``a`` and ``b``.
+
+        History (newest first)::
+
+            merge feature
+            |  \\
+            |   change a (feature)
+            change b
+            change a, tag 0.1
+            change b
+            change a
+        """
+        self.repo_path = tempfile.mkdtemp()
+        call_vcs('git init', self.repo_path)
+        call_vcs('git checkout -B master', self.repo_path)
+        self._commit('a', 'first a')
+        self._commit('b', 'first b')
+        self._commit('a', 'second a')
+        call_vcs('git tag 0.1', self.repo_path)
+        call_vcs('git checkout -b feature', self.repo_path)
+        self._commit('a', 'feature a')
+        call_vcs('git checkout master', self.repo_path)
+        self._commit('b', 'second b')
+        call_vcs('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'merge --no-edit feature', self.repo_path)
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, subproject, message):
+        """Change a file of ``subproject`` and commit it."""
+        directory = os.path.join(self.repo_path, subproject)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'module.py'), 'a') as module:
+            module.write('# %s\n' % message)
+        call_vcs('git add %s' % subproject, self.repo_path)
+        call_vcs('git -c user.name="Example Name" '
+                 '-c user.email="name@example.com" '
+                 'commit -m "%s"' % message, self.repo_path)
+
+    def _git(self, command):
+        """Get the stripped output of a git command."""
+        return subprocess.check_output(
+            command, shell=True, cwd=self.repo_path).decode('utf-8').strip()
+
+    def test_subtree_snapshots(self):
+        """Versioner - Subtree: subprojects are versioned by their commits."""
+        from natcap.versioner import versioning
+        repo = versioning.GitRepo(self.repo_path)
+        path_a = os.path.join(self.repo_path, 'a')
+        path_b = os.path.join(self.repo_path, 'b')
+        snapshots = repo.subtree_snapshots([path_a, path_b, self.repo_path])
+        self.assertEqual(repo.process_count, 1)
+
+        node_a = self._git('git log -1 --format=%H feature -- a')
+        self.assertEqual(snapshots[path_a].node, node_a[:8])
+        self.assertEqual(snapshots[path_a].latest_tag, '0.1')
+        self.assertEqual(snapshots[path_a].tag_distance, 1)
+
+        node_b = self._git('git log -1 --format=%H master -- b')
+        self.assertEqual(snapshots[path_b].node, node_b[:8])
+        self.assertEqual(snapshots[path_b].tag_distance, 1)
+        self.assertEqual(snapshots[path_b].pep440(branch=False),
+                         '0.1.post1+n%s' % node_b[:8])
+
+        # Merges don't count, so the root is versioned by one of the merged
+        # commits.
+        self.assertIn(snapshots[self.repo_path].node,
+                      [node_a[:8], node_b[:8]])
+        self.assertEqual(snapshots[self.repo_path].tag_distance, 2)
+        self.assertEqual(snapshots[self.repo_path].branch, 'master')
+
+    def test_subtree_version(self):
+        """Versioner - Subtree: untouched and tagged subtrees."""
+        import natcap.versioner
+        call_vcs('git checkout 0.1', self.repo_path)
+        os.makedirs(os.path.join(self.repo_path, 'empty'))
+        versions = natcap.versioner.subtree_versions(
+            [os.path.join(self.repo_path, 'a'),
+             os.path.join(self.repo_path, 'b'),
+             os.path.join(self.repo_path, 'empty')],
+            on_error=natcap.versioner.ERROR_RETURN)
+        # Both subtrees are unchanged since the release.
+        self.assertEqual(versions[os.path.join(self.repo_path, 'a')], '0.1')
+        self.assertEqual(versions[os.path.join(self.repo_path, 'b')], '0.1')
+        self.assertEqual(versions[os.path.join(self.repo_path, 'empty')],
+                         'UNKNOWN')
+
+        with self.assertRaises(natcap.versioner.VersionNotFound):
+            natcap.versioner.subtree_version(
+                os.path.join(self.repo_path, 'empty'))
+
+    def test_no_tags(self):
+        """Versioner - Subtree: without tags, touching commits are counted."""
+        import natcap.versioner
+        call_vcs('git tag -d 0.1', self.repo_path)
+        version = natcap.versioner.subtree_version(
+            os.path.join(self.repo_path, 'b'))
+        self.assertTrue(version.startswith('null.post2+n'), version)
+
+
+class MercurialSubtreeTest(unittest.TestCase):
+    def setUp(self):
+        """Set up an hg monorepo with subprojects ``a`` and ``b``."""
+        self.repo_path = tempfile.mkdtemp()
+        call_vcs('hg init', self.repo_path)
+        self._commit('a', 'first a')
+        call_vcs('hg tag -u "Example Name" 0.1', self.repo_path)
+        self._commit('b', 'first b')
+        self._commit('a', 'second a')
+        self._commit('b', 'second b')
+
+    def tearDown(self):
+        """Remove the temp folder self.repo_path."""
+        shutil.rmtree(self.repo_path)
+
+    def _commit(self, subproject, message):
+        """Change a file of ``subproject`` and commit it."""
+        directory = os.path.join(self.repo_path, subproject)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'module.py'), 'a') as module:
+            module.write('# %s\n' % message)
+        call_vcs('hg commit -A -u "Example Name" -m "%s"' % message,
+                 self.repo_path)
+
+    def test_subtree_snapshots(self):
+        """Versioner - Subtree: hg subprojects are versioned by commits."""
+        from natcap.versioner import versioning
+        repo = versioning.HgRepo(self.repo_path)
+        path_a = os.path.join(self.repo_path, 'a')
+        snapshots = repo.subtree_snapshots([path_a])
+        self.assertEqual(snapshots[path_a].latest_tag, '0.1')
+        self.assertEqual(snapshots[path_a].tag_distance, 1)
+        self.assertEqual(len(snapshots[path_a].node), 12)
+        self.assertEqual(snapshots[path_a].branch, 'default')
+
+    def test_local_tags_ignored(self):
+        """Versioner - Subtree: hg local tags are ignored like latesttag."""
+        from natcap.versioner import versioning
+        call_vcs('hg tag -l 0.9', self.repo_path)
+        repo = versioning.HgRepo(self.repo_path)
+        path_a = os.path.join(self.repo_path, 'a')
+        snapshot = repo.subtree_snapshots([path_a])[path_a]
+        self.assertEqual(repo.latest_tag, '0.1')
+        self.assertEqual(snapshot.latest_tag, '0.1')
+        self.assertEqual(snapshot.tag_distance, 1)
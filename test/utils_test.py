@@ -19,3 +19,33 @@ class TagIncrementTest(unittest.TestCase):
         from natcap.versioner import versioning
         version = '1'
         self.assertEqual(versioning._increment_tag(version), '2')
+
+    def test_prefixed_version(self):
+        """Versioner - Utils: verify 'v' prefixes are dropped."""
+        from natcap.versioner import versioning
+        self.assertEqual(versioning._increment_tag('v2.3'), '2.4')
+
+    def test_prerelease_version(self):
+        """Versioner - Utils: verify pre-releases increment their number."""
+        from natcap.versioner import versioning
+        self.assertEqual(versioning._increment_tag('1.0rc1'), '1.0rc2')
+        self.assertEqual(versioning._increment_tag('1.0.post2'), '1.1')
+
+    def test_pre_method_after_prerelease(self):
+        """Versioner - Utils: verify 'pre' versions after a pre-release."""
+        from natcap.versioner import pep440
+        from natcap.versioner import versioning
+        snapshot = versioning.VersionSnapshot(
+            latest_tag='1.0rc1', tag_distance=3, branch='default',
+            node='abcdef12', build_id='3:1.0rc1 [abcdef12]')
+        version = snapshot.pep440(branch=False, method='pre')
+        self.assertEqual(version, '1.0rc2.dev3+nabcdef12')
+        self.assertTrue(pep440.parse('1.0rc1') < pep440.parse(version) <
+                        pep440.parse('1.0rc2'))
+
+    def test_invalid_version(self):
+        """Versioner - Utils: verify non-versions can't be incremented."""
+        from natcap.versioner import pep440
+        from natcap.versioner import versioning
+        with self.assertRaises(pep440.InvalidVersion):
+            versioning._increment_tag('null')